@@ -0,0 +1,318 @@
+"""Asyncio versions of the product search and product management calls.
+
+The functions of `main.py` and `find_products.py` block their thread.
+The coroutines here run on the asyncio Vision clients, download images
+with aiohttp and upload them with the GCS JSON API, so a single event
+loop keeps thousands of operations in flight:
+
+    async with AsyncSession('beni-ai-engine', 'us-east1') as session:
+        with deadline(5):
+            gcs_uri = await upload_image(session, 'beni-ai-engine', img_url)
+            await create_product(session, product_id, title, description, 'apparel', labels)
+            await add_product_to_product_set(session, product_id, 'BENI_CLOTH')
+            await create_reference_image(session, product_id, reference_image_id, gcs_uri)
+
+Deadlines: `deadline(seconds)` bounds every call made in its block, in the
+same task or the tasks it starts. Each call gets the time left as its RPC
+or HTTP timeout, so the deadline also reaches the server, and is cancelled
+locally when it runs out, raising DeadlineExceeded. A `timeout` argument
+can only shorten the deadline.
+
+Cancellation: cancelling a task cancels the RPC or HTTP request it is
+waiting on.
+"""
+import asyncio
+import contextlib
+import contextvars
+import itertools
+import time
+
+import google.auth
+import google.auth.transport.requests
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from google.api_core import exceptions
+from google.cloud import vision
+
+from find_products import product_search_context
+from main import image_blob_name
+from session import get_session
+from tracing import traced
+
+# Absolute time.monotonic() deadline of the calls of the current context.
+_deadline = contextvars.ContextVar('async_api_deadline', default=None)
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """Bound the calls of the block to `seconds` from now, or less if an outer deadline is sooner."""
+    current = _deadline.get()
+    new = time.monotonic() + seconds
+    token = _deadline.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining(timeout=None):
+    """Seconds left for a call: the sooner of `timeout` and the current deadline, None without either.
+
+    Raises DeadlineExceeded when the deadline has already passed.
+    """
+    current = _deadline.get()
+    if current is None:
+        return timeout
+    left = current - time.monotonic()
+    if left <= 0:
+        raise exceptions.DeadlineExceeded('Deadline exceeded before the call')
+    return left if timeout is None else min(timeout, left)
+
+
+async def _bounded(coroutine, timeout):
+    """Await a call, cancelling it when `timeout` runs out."""
+    if timeout is None:
+        return await coroutine
+    try:
+        return await asyncio.wait_for(coroutine, timeout)
+    except asyncio.TimeoutError:
+        raise exceptions.DeadlineExceeded('Deadline of {:.3f}s exceeded'.format(timeout))
+
+
+class GcsAsyncClient(object):
+    """Media uploads to the GCS JSON API over a shared aiohttp session.
+
+    Credentials come from the environment, like `storage.Client`, and are
+    refreshed in the default executor when they expire.
+    """
+
+    UPLOAD_URL = 'https://storage.googleapis.com/upload/storage/v1/b/{}/o'
+    SCOPES = ('https://www.googleapis.com/auth/devstorage.read_write',)
+
+    def __init__(self, http, credentials=None):
+        self.http = http
+        self._credentials = credentials
+        self._lock = None
+
+    async def _token(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            if self._credentials is None:
+                self._credentials, _ = await loop.run_in_executor(
+                    None, lambda: google.auth.default(scopes=self.SCOPES))
+            if not self._credentials.valid:
+                await loop.run_in_executor(
+                    None, self._credentials.refresh, google.auth.transport.requests.Request())
+            return self._credentials.token
+
+    async def upload(self, bucket_name, blob_name, data, content_type, timeout=None):
+        """Store `data` as a blob in a single request, return the object resource."""
+        headers = {'Authorization': 'Bearer ' + await self._token(), 'Content-Type': content_type}
+        params = {'uploadType': 'media', 'name': blob_name}
+        async with self.http.post(self.UPLOAD_URL.format(bucket_name), params=params, data=data, headers=headers,
+                                  timeout=ClientTimeout(total=timeout)) as response:
+            if response.status >= 400:
+                raise exceptions.from_http_status(response.status, await response.text())
+            return await response.json()
+
+
+class AsyncSession(object):
+    """Asyncio clients for one project and location, shared by every call.
+
+    The ImageAnnotator calls are spread over a pool of `channels` clients,
+    each with its own gRPC channel, since a channel multiplexes a limited
+    number of concurrent streams. HTTP downloads and GCS uploads share one
+    aiohttp session of at most `max_connections` connections. Clients are
+    created on first use, on the running loop, which they are bound to,
+    and closed by `close`. Resource paths are built here rather than by the
+    sync clients of the VisionSession, which would be created on the loop.
+    Args:
+        project_id: Id of the project.
+        location: A compute region name.
+        channels: ImageAnnotator clients used in turn.
+        max_connections: Concurrent HTTP connections.
+        session: VisionSession providing the services, defaults to the
+            process-wide one.
+    """
+
+    def __init__(self, project_id, location, channels=4, max_connections=256, session=None):
+        self.session = session or get_session(project_id, location)
+        self.services = self.session.services
+        self.channels = channels
+        self.max_connections = max_connections
+        self.location_path = self.session.location_path
+        self._image_annotator_pool = []
+        self._image_annotator_clients = None
+        self._product_search_client = None
+        self._http = None
+        self._storage = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def image_annotator_client(self):
+        """Next client of the ImageAnnotator pool."""
+        if self._image_annotator_clients is None:
+            self._image_annotator_pool = [self.services.image_annotator_async_client() for _ in range(self.channels)]
+            self._image_annotator_clients = itertools.cycle(self._image_annotator_pool)
+        return next(self._image_annotator_clients)
+
+    @property
+    def product_search_client(self):
+        if self._product_search_client is None:
+            self._product_search_client = self.services.product_search_async_client()
+        return self._product_search_client
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = ClientSession(connector=TCPConnector(limit=self.max_connections))
+        return self._http
+
+    @property
+    def storage(self):
+        if self._storage is None:
+            self._storage = self.services.storage_async_client(self.http)
+        return self._storage
+
+    def product_set_path(self, product_set_id):
+        return f"{self.location_path}/productSets/{product_set_id}"
+
+    def product_path(self, product_id):
+        return f"{self.location_path}/products/{product_id}"
+
+    async def close(self):
+        """Close the gRPC channels and the HTTP connections."""
+        clients = self._image_annotator_pool
+        if self._product_search_client is not None:
+            clients = clients + [self._product_search_client]
+        for client in clients:
+            await client.transport.close()
+        self._image_annotator_pool = []
+        self._image_annotator_clients = None
+        self._product_search_client = None
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+            self._storage = None
+
+    async def fetch_image(self, img_url, timeout=None):
+        """Download an image URL.
+        Returns:
+            A tuple (content, content_type), or None when the URL is not an image.
+        """
+        timeout = remaining(timeout)
+        async with self.http.get(img_url, timeout=ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+            # check if URL contains an image
+            if not response.content_type.startswith('image'):
+                return None
+            return await response.read(), response.content_type
+
+
+@traced('async.get_similar_products_file')
+async def get_similar_products_file(session, product_set_id, product_category, file_path, filter, max_results,
+                                    normalize=None, timeout=None):
+    """Search similar products to image, see `find_products.get_similar_products_file`.
+    Args:
+        session: AsyncSession to use.
+        product_set_id: Id of the product set.
+        product_category: Category of the product.
+        file_path: Local file path of the image to be searched.
+        filter: Condition to be applied on the labels.
+        max_results: The maximum number of results (matches) to return.
+        normalize: Optional callable mapping the image bytes to (content, content_type),
+                   run in the default executor.
+        timeout: Seconds the search may take, within the current deadline.
+    Returns:
+        The `vision.ProductSearchResults.Result`s.
+    """
+    loop = asyncio.get_running_loop()
+
+    def read_image():
+        with open(file_path, 'rb') as image_file:
+            content = image_file.read()
+        return normalize(content)[0] if normalize is not None else content
+
+    content = await loop.run_in_executor(None, read_image)
+    feature = vision.Feature(type_=vision.Feature.Type.PRODUCT_SEARCH)
+    if max_results:
+        feature.max_results = max_results
+    request = vision.AnnotateImageRequest(
+        image=vision.Image(content=content),
+        features=[feature],
+        image_context=product_search_context(session, product_set_id, product_category, filter))
+    timeout = remaining(timeout)
+    response = await _bounded(session.image_annotator_client().batch_annotate_images(
+        requests=[request], timeout=timeout), timeout)
+    image_response = response.responses[0]
+    if image_response.error.code:
+        raise exceptions.from_grpc_status(image_response.error.code, image_response.error.message)
+    return image_response.product_search_results.results
+
+
+@traced('async.create_product')
+async def create_product(session, product_id, product_display_name, product_description, product_category,
+                         product_labels, timeout=None):
+    """Create one product, see `main.create_product`."""
+    product = vision.Product(
+        display_name=product_display_name,
+        description=product_description,
+        product_category=product_category,
+        product_labels=product_labels)
+    timeout = remaining(timeout)
+    return await _bounded(session.product_search_client.create_product(
+        parent=session.location_path, product=product, product_id=product_id, timeout=timeout), timeout)
+
+
+@traced('async.add_product_to_product_set')
+async def add_product_to_product_set(session, product_id, product_set_id, timeout=None):
+    """Add a product to a product set, see `main.add_product_to_product_set`."""
+    timeout = remaining(timeout)
+    await _bounded(session.product_search_client.add_product_to_product_set(
+        name=session.product_set_path(product_set_id), product=session.product_path(product_id),
+        timeout=timeout), timeout)
+
+
+@traced('async.create_reference_image')
+async def create_reference_image(session, product_id, reference_image_id, gcs_uri, timeout=None):
+    """Create a reference image, see `main.create_reference_image`."""
+    timeout = remaining(timeout)
+    return await _bounded(session.product_search_client.create_reference_image(
+        parent=session.product_path(product_id), reference_image=vision.ReferenceImage(uri=gcs_uri),
+        reference_image_id=reference_image_id, timeout=timeout), timeout)
+
+
+@traced('async.upload_image')
+async def upload_image(session, bucket_name, img_url, normalize=None, timeout=None):
+    """Copy an image URL into GCS, see `main.upload_image`.
+
+    Unlike the sync version, failures are raised rather than printed.
+    Args:
+        session: AsyncSession to use.
+        bucket_name: Bucket where the image is stored.
+        img_url: URL of the image.
+        normalize: Optional callable mapping image bytes to (content, content_type),
+                   run in the default executor.
+        timeout: Seconds the download and upload may take together, within
+                 the current deadline.
+    Returns:
+        The gs:// URI of the image, or None when the URL is not an image.
+    """
+    # The download and the upload share one budget.
+    with deadline(timeout) if timeout is not None else contextlib.nullcontext():
+        image = await session.fetch_image(img_url)
+        if image is None:
+            return None
+        content, content_type = image
+        if normalize is not None:
+            content, content_type = await asyncio.get_running_loop().run_in_executor(None, normalize, content)
+        blob_name = image_blob_name(img_url)
+        upload_timeout = remaining()
+        await _bounded(session.storage.upload(bucket_name, blob_name, content, content_type, upload_timeout),
+                       upload_timeout)
+    return 'gs://' + bucket_name + '/' + blob_name
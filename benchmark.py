@@ -0,0 +1,274 @@
+"""Latency and recall benchmark of product searches.
+
+Cases are declared in a JSON spec, a list of objects with `name`, `image`
+(relative to the spec), and optional `filter`, `expected` (ids of the
+products that should be found) and `max_results`. The test case CSV
+(`test_cases_images.csv`) also works: every image is searched and
+expected to find its own product.
+
+Each case is searched `warmup` times untimed, then `repetitions` times
+spread over `concurrency` threads. The report, printed and optionally
+written as JSON, has p50/p95/p99 latency, throughput and recall@k per
+case. With --baseline, the report is compared with a saved one and the
+exit status is 1 on regressions.
+
+    python benchmark.py beni-test-cases/benchmark_cases.json --backend local \\
+        --index-dir local_index/BENI_TEST_CASES --repetitions 20 --concurrency 4 --output report.json
+    python benchmark.py beni-test-cases/test_cases_images.csv --backend vision --baseline report.json
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from csv import DictReader
+
+import numpy as np
+
+
+def load_cases(spec_path):
+    """Load benchmark cases from a JSON spec or a test case CSV.
+    Returns:
+        List of dicts with name, image (an absolute path), filter,
+        expected (list of product ids) and max_results.
+    """
+    base_dir = os.path.dirname(os.path.abspath(spec_path))
+    if spec_path.endswith('.csv'):
+        with open(spec_path, 'r') as read_obj:
+            specs = [{'name': row['title'], 'image': row['image_url'], 'expected': [row['beni_product_id']]}
+                     for row in DictReader(read_obj)]
+    else:
+        with open(spec_path, 'r') as spec_file:
+            specs = json.load(spec_file)
+    cases = []
+    for spec in specs:
+        cases.append({
+            'name': spec.get('name') or spec['image'],
+            'image': os.path.join(base_dir, spec['image']),
+            'filter': spec.get('filter'),
+            'expected': list(spec.get('expected') or []),
+            'max_results': spec.get('max_results'),
+        })
+    return cases
+
+
+def recall_at_k(product_search_results, expected, k):
+    """Share of the expected products found in the first k results, None without expectations."""
+    if not expected:
+        return None
+    found = {result.product.name.split('/')[-1] for result in product_search_results.results[:k]}
+    return len(found.intersection(expected)) / len(expected)
+
+
+def run_case(backend, case, product_set_id, product_category='apparel', warmup=1, repetitions=10, concurrency=1,
+             k=4, normalize=None):
+    """Benchmark one case.
+    Args:
+        backend: SearchBackend answering the searches.
+        case: Case as returned by `load_cases`.
+        product_set_id: Id of the product set.
+        product_category: Category of the products.
+        warmup: Untimed searches before the measured ones.
+        repetitions: Measured searches.
+        concurrency: Threads the measured searches are spread over.
+        k: Results recall is computed on. Searches ask for every result,
+            like `test-case.py`, unless the case sets `max_results`.
+        normalize: Optional callable applied to the image before searching.
+    Returns:
+        A tuple with the statistics of the case and the results of its last search.
+    """
+    with open(case['image'], 'rb') as image_file:
+        content = image_file.read()
+    if normalize is not None:
+        content, _ = normalize(content)
+
+    def search():
+        return backend.product_search(content, product_set_id, product_category, case['filter'],
+                                      case['max_results'])
+
+    # A failing warmup is reported with the case instead of ending the suite.
+    warmup_errors = []
+    for _ in range(warmup):
+        try:
+            search()
+        except Exception as e:
+            warmup_errors.append(str(e))
+
+    latencies = []
+    errors = []
+    recalls = []
+    last = [None]
+    lock = threading.Lock()
+
+    def timed(_):
+        started = time.perf_counter()
+        try:
+            product_search_results = search()
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        elapsed = time.perf_counter() - started
+        recall = recall_at_k(product_search_results, case['expected'], k)
+        with lock:
+            latencies.append(elapsed)
+            if recall is not None:
+                recalls.append(recall)
+            last[0] = product_search_results
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(repetitions)))
+    wall_time = time.perf_counter() - started
+
+    milliseconds = np.array(latencies) * 1000
+    stats = {
+        'name': case['name'],
+        'filter': case['filter'],
+        'calls': len(latencies),
+        'errors': len(errors),
+        'warmup_errors': len(warmup_errors),
+        'p50_ms': float(np.percentile(milliseconds, 50)) if len(latencies) else None,
+        'p95_ms': float(np.percentile(milliseconds, 95)) if len(latencies) else None,
+        'p99_ms': float(np.percentile(milliseconds, 99)) if len(latencies) else None,
+        'mean_ms': float(milliseconds.mean()) if len(latencies) else None,
+        'throughput': len(latencies) / wall_time if wall_time else 0.0,
+        'recall_at_k': float(np.mean(recalls)) if recalls else None,
+    }
+    if errors or warmup_errors:
+        stats['first_error'] = (errors or warmup_errors)[0]
+    return stats, last[0]
+
+
+def run_suite(backend, cases, product_set_id, product_category='apparel', warmup=1, repetitions=10,
+              concurrency=1, k=4, normalize=None, on_result=None):
+    """Benchmark every case and build the report.
+
+    `on_result`, if given, is called with each case and the results of its
+    last search.
+    """
+    report = {
+        'backend': type(backend).__name__,
+        'product_set_id': product_set_id,
+        'k': k,
+        'warmup': warmup,
+        'repetitions': repetitions,
+        'concurrency': concurrency,
+        'cases': [],
+    }
+    all_recalls = []
+    for case in cases:
+        stats, product_search_results = run_case(backend, case, product_set_id, product_category, warmup,
+                                                 repetitions, concurrency, k, normalize)
+        report['cases'].append(stats)
+        if stats['recall_at_k'] is not None:
+            all_recalls.append(stats['recall_at_k'])
+        if on_result is not None:
+            on_result(case, product_search_results)
+    p95s = [stats['p95_ms'] for stats in report['cases'] if stats['p95_ms'] is not None]
+    report['summary'] = {
+        'cases': len(cases),
+        'errors': sum(stats['errors'] for stats in report['cases']),
+        'worst_p95_ms': max(p95s) if p95s else None,
+        'mean_recall_at_k': float(np.mean(all_recalls)) if all_recalls else None,
+    }
+    return report
+
+
+def compare(report, baseline, tolerance=0.2, recall_tolerance=0.0):
+    """List the regressions of a report against a baseline report.
+
+    A case regresses when its p95 latency grew by more than `tolerance`
+    (a fraction), its recall dropped by more than `recall_tolerance`, or it
+    has errors the baseline did not have. Cases missing from either report
+    are ignored.
+    """
+    baseline_cases = {stats['name']: stats for stats in baseline['cases']}
+    regressions = []
+    for stats in report['cases']:
+        previous = baseline_cases.get(stats['name'])
+        if previous is None:
+            continue
+        if stats['p95_ms'] is not None and previous['p95_ms']:
+            if stats['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+                regressions.append('{}: p95 {:.1f} ms -> {:.1f} ms'.format(
+                    stats['name'], previous['p95_ms'], stats['p95_ms']))
+        if stats['recall_at_k'] is not None and previous['recall_at_k'] is not None:
+            if stats['recall_at_k'] < previous['recall_at_k'] - recall_tolerance:
+                regressions.append('{}: recall@k {:.2f} -> {:.2f}'.format(
+                    stats['name'], previous['recall_at_k'], stats['recall_at_k']))
+        if stats['errors'] > previous['errors']:
+            regressions.append('{}: {} errors, baseline had {}'.format(
+                stats['name'], stats['errors'], previous['errors']))
+    return regressions
+
+
+def print_report(report):
+    print('{:<32} {:>6} {:>9} {:>9} {:>9} {:>9} {:>7}'.format(
+        'case', 'calls', 'p50 ms', 'p95 ms', 'p99 ms', 'calls/s', 'recall'))
+    for stats in report['cases']:
+        if not stats['calls']:
+            print('{:<32} {:>6} all {} calls failed: {}'.format(
+                stats['name'][:32], 0, stats['errors'], stats.get('first_error')))
+            continue
+        recall = '{:.2f}'.format(stats['recall_at_k']) if stats['recall_at_k'] is not None else '-'
+        print('{:<32} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f} {:>7}'.format(
+            stats['name'][:32], stats['calls'], stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            stats['throughput'], recall))
+
+
+def make_backend(args):
+    if args.backend == 'local':
+        from local_search import LocalSearchEngine
+
+        return LocalSearchEngine(args.index_dir, args.project_id, args.location)
+    from find_products import VisionSearchBackend
+    from session import get_session
+
+    return VisionSearchBackend(get_session(args.project_id, args.location))
+
+
+def add_arguments(parser):
+    """Add the suite options shared by the scripts running benchmarks."""
+    parser.add_argument('--backend', default='vision', choices=['vision', 'local'])
+    parser.add_argument('--index-dir', help='local backend: directory written by local_search.py build')
+    parser.add_argument('--project-id', default='beni-ai-engine')
+    parser.add_argument('--location', default='us-east1')
+    parser.add_argument('--product-set-id', default='BENI_TEST_CASES')
+    parser.add_argument('--product-category', default='apparel')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repetitions', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--k', type=int, default=4, help='results recall is computed on')
+    parser.add_argument('--output', help='write the report to this JSON file')
+    parser.add_argument('--baseline', help='compare with this JSON report, exit with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='p95 growth tolerated, as a fraction')
+
+
+def main(args, cases, on_result=None):
+    """Run a suite from parsed `add_arguments` options and return the exit status."""
+    if args.backend == 'local' and not args.index_dir:
+        raise SystemExit('--index-dir is required with the local backend')
+    report = run_suite(make_backend(args), cases, args.product_set_id, args.product_category, args.warmup,
+                       args.repetitions, args.concurrency, args.k, on_result=on_result)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            regressions = compare(report, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION {}'.format(regression))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('spec', help='JSON spec or test case CSV')
+    add_arguments(parser)
+    args = parser.parse_args()
+    sys.exit(main(args, load_cases(args.spec)))
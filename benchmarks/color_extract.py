@@ -0,0 +1,104 @@
+"""Speed and palette agreement of the dominant color extractors.
+
+The NumPy k-means extractor of colors.py is timed against colorgram and
+ColorThief (quality=1) on the same images, and optionally against the
+Vision `image_properties` RPC. Agreement is the proportion-weighted
+CIELAB distance from each color of the NumPy palette to the closest color
+of the other palette (lower is closer), plus whether both agree on the
+CSS3 name of the dominant color.
+
+    python -m benchmarks.color_extract beni-test-cases/*.jpg beni-test-cases/*.jpeg
+    python -m benchmarks.color_extract beni-test-cases/*.jpg --vision --processes 4
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'beni-test-cases'))
+
+import color_image  # noqa: E402
+import colors  # noqa: E402
+
+
+def _colorgram(img_url):
+    return [(tuple(color.rgb), color.proportion) for color in color_image.colorgram.extract(img_url, 8)]
+
+
+def _color_thief(img_url):
+    palette_color = color_image.ColorThief(img_url).get_palette(quality=1)
+    # ColorThief gives no proportions, weight its colors equally.
+    return [(rgb, 1 / len(palette_color)) for rgb in palette_color]
+
+
+def _vision(img_url):
+    client = color_image.vision.ImageAnnotatorClient()
+    with open(img_url, 'rb') as image_file:
+        image = color_image.vision.Image(content=image_file.read())
+    dominant_colors = client.image_properties(image=image).image_properties_annotation.dominant_colors
+    return [((int(color.color.red), int(color.color.green), int(color.color.blue)), color.pixel_fraction)
+            for color in dominant_colors.colors]
+
+
+def palette_distance(reference, other):
+    """Proportion-weighted CIELAB distance from `reference` colors to the closest `other` color."""
+    if not reference or not other:
+        return float('nan')
+    reference_lab = colors.rgb_to_lab([rgb for rgb, _ in reference])
+    other_lab = colors.rgb_to_lab([rgb for rgb, _ in other])
+    weights = np.array([proportion for _, proportion in reference])
+    closest = np.sqrt(((reference_lab[:, None, :] - other_lab[None, :, :]) ** 2).sum(axis=2)).min(axis=1)
+    return float((closest * weights).sum() / weights.sum())
+
+
+def _dominant_name(palette):
+    if not palette:
+        return None
+    rgb, _ = max(palette, key=lambda color: color[1])
+    return colors.get_color_index('css3').name_of(rgb)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--vision', action='store_true', help='also call the Vision image_properties RPC')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                        help='processes used to time the batch API')
+    args = parser.parse_args()
+
+    methods = [('colorgram', _colorgram), ('colorthief', _color_thief)]
+    if args.vision:
+        methods.append(('vision', _vision))
+    times = {name: [] for name in ['numpy'] + [name for name, _ in methods]}
+    distances = {name: [] for name, _ in methods}
+    agreements = {name: 0 for name, _ in methods}
+
+    for img_url in args.images:
+        started = time.perf_counter()
+        reference = colors.extract_palette(img_url)
+        times['numpy'].append(time.perf_counter() - started)
+        line = '{:<32} numpy {:>7.1f} ms'.format(os.path.basename(img_url)[:32], times['numpy'][-1] * 1000)
+        for name, method in methods:
+            started = time.perf_counter()
+            palette = method(img_url)
+            times[name].append(time.perf_counter() - started)
+            distances[name].append(palette_distance(reference, palette))
+            agreements[name] += _dominant_name(reference) == _dominant_name(palette)
+            line += ' | {} {:>7.1f} ms dE {:>5.1f}'.format(name, times[name][-1] * 1000, distances[name][-1])
+        print(line)
+
+    print()
+    print('{:<12} {:>10} {:>10} {:>14}'.format('method', 'ms/image', 'mean dE', 'same dominant'))
+    for name, elapsed in times.items():
+        if name == 'numpy':
+            print('{:<12} {:>10.1f}'.format(name, np.mean(elapsed) * 1000))
+        else:
+            print('{:<12} {:>10.1f} {:>10.1f} {:>13.0%}'.format(
+                name, np.mean(elapsed) * 1000, np.nanmean(distances[name]), agreements[name] / len(args.images)))
+
+    started = time.perf_counter()
+    colors.extract_palettes(args.images, max_workers=args.processes)
+    elapsed = time.perf_counter() - started
+    print('numpy batch, {} processes: {:.1f} ms/image'.format(args.processes, elapsed * 1000 / len(args.images)))
@@ -0,0 +1,123 @@
+"""Ingestion throughput against the fake services as concurrency rises.
+
+The test case images are served by a local HTTP server and listed in a
+generated catalog, then ingested with the pipeline into a fresh
+`fake_services.FakeServices` for every worker count. The fake config sets
+the latency, error rate and quotas, so the numbers are reproducible and
+need no credentials. Failed products are reported by stage.
+
+With --schedule the calls go through a `scheduler.CallScheduler` whose
+quotas are the fake ones, so injected errors are retried and throttling
+is avoided instead of failing products.
+
+    python -m benchmarks.fake_ingest --products 200 --workers 1 4 16 --config fake.json --schedule
+"""
+import argparse
+import collections
+import contextlib
+import csv
+import functools
+import http.server
+import io
+import os
+import tempfile
+import threading
+import time
+
+from fake_services import FakeServices
+from scheduler import CallScheduler
+from session import VisionSession
+
+IMAGES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'beni-test-cases')
+CATALOG_HEADER = ['id', 'beni_product_id', 'product_id', 'product_url', 'image_url', 'affiliated_url', 'resaler',
+                  'brand', 'product_title', 'product_description', 'breadcrumbs', 'gender', 'color', 'currency',
+                  'size_country', 'in_stock', 'attributes', 'created_at', 'updated_at', 'condition',
+                  'product_category', 'size_exact', 'size_generic', 'price']
+
+
+def _serve(directory):
+    class Handler(http.server.SimpleHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory=directory))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def write_catalog(path, base_url, products):
+    images = sorted(name for name in os.listdir(IMAGES_DIR) if name.endswith('.jpg'))
+    with open(path, 'w', newline='') as catalog_file:
+        writer = csv.writer(catalog_file)
+        writer.writerow(CATALOG_HEADER)
+        for index in range(products):
+            row = dict.fromkeys(CATALOG_HEADER, '')
+            row.update({
+                'id': index,
+                'beni_product_id': 'FAKE-{}'.format(index),
+                'product_id': str(index),
+                # The query string makes every product a distinct blob.
+                'image_url': '{}/{}?{}'.format(base_url, images[index % len(images)], index),
+                'brand': 'Fake',
+                'product_title': 'Fake product {}'.format(index),
+                'gender': 'male',
+                'color': 'black',
+                'updated_at': '2022-01-01',
+                'product_category': 'apparel',
+            })
+            writer.writerow([row[column] for column in CATALOG_HEADER])
+
+
+def ingest(catalog_path, workers, config_path, schedule=False):
+    """Ingest the catalog into fresh fake services, return (seconds, pipeline, fake call stats)."""
+    from google.cloud import vision
+
+    import pipeline
+
+    services = FakeServices.from_config_file(config_path)
+    scheduler = None
+    if schedule:
+        window = services.inject.config['quota_window']
+        # The fake counts the quota of each method on its own, no groups.
+        scheduler = CallScheduler({method: limit * 60.0 / window
+                                   for method, limit in services.inject.config['quotas'].items()},
+                                  quota_groups={}, base_delay=0.05)
+    session = VisionSession('fake-project', 'fake-location', services=services)
+    storage_client = services.storage_client()
+    storage_client.create_bucket(storage_client.bucket('fake-bucket'))
+    services.product_search_client().create_product_set(
+        session.location_path, vision.ProductSet(display_name='FAKE'), 'FAKE')
+    started = time.perf_counter()
+    # The ingestion functions print every call, keep the report readable.
+    with contextlib.redirect_stdout(io.StringIO()):
+        run = pipeline.ingest_catalog_concurrently('fake-project', 'fake-location', 'FAKE', 'fake-bucket',
+                                                   catalog_path, workers, session=session, scheduler=scheduler)
+    return time.perf_counter() - started, run, services.inject.stats()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--products', type=int, default=200)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--config', help='fake services JSON config, see fake_services')
+    parser.add_argument('--schedule', action='store_true', help='rate limit and retry the calls')
+    args = parser.parse_args()
+
+    server = _serve(IMAGES_DIR)
+    base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    print('{:>8} {:>9} {:>11} {:>8} {:>10} {:>10}'.format(
+        'workers', 'seconds', 'products/s', 'failed', 'injected', 'throttled'))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        catalog_path = os.path.join(tmp_dir, 'catalog.csv')
+        write_catalog(catalog_path, base_url, args.products)
+        for workers in args.workers:
+            elapsed, run, stats = ingest(catalog_path, workers, args.config, args.schedule)
+            done = run.completed['reference_image']
+            print('{:>8} {:>9.2f} {:>11.1f} {:>8} {:>10} {:>10}'.format(
+                workers, elapsed, done / elapsed, len(run.errors), sum(stats['errors'].values()),
+                sum(stats['throttled'].values())))
+            failed = collections.Counter(stage for _, stage, _ in run.errors)
+            if failed:
+                print('         failed by stage: {}'.format(dict(failed)))
+    server.shutdown()
@@ -0,0 +1,69 @@
+"""Bytes and time saved per image by the normalization stage.
+
+For every image the original and normalized sizes and the time spent
+normalizing are reported. With --search, each image is also searched
+as-is and normalized against a real product set to compare RPC latency.
+
+    python -m benchmarks.normalize test.jpeg test-2.jpeg beni-test-cases/*.jpg --max-edge 512
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from preprocess import ImageNormalizer
+
+
+def _search_seconds(args, file_path, normalize):
+    from find_products import get_similar_products_file
+    from session import get_session
+
+    session = get_session(args.project_id, args.location)
+    started = time.perf_counter()
+    get_similar_products_file(args.project_id, args.location, args.product_set_id, 'apparel', file_path, None, 4,
+                              session=session, normalize=normalize)
+    return time.perf_counter() - started
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--max-edge', type=int, default=1024)
+    parser.add_argument('--quality', type=int, default=85)
+    parser.add_argument('--repeat', type=int, default=5, help='normalizations timed per image')
+    parser.add_argument('--search', action='store_true', help='also time real product searches')
+    parser.add_argument('--project-id', default='beni-ai-engine')
+    parser.add_argument('--location', default='us-east1')
+    parser.add_argument('--product-set-id', default='BENI_CLOTH')
+    args = parser.parse_args()
+
+    normalize = ImageNormalizer(args.max_edge, args.quality)
+    header = '{:<40} {:>10} {:>10} {:>7} {:>9}'.format('image', 'bytes', 'normalized', 'saved', 'ms/image')
+    if args.search:
+        header += ' {:>10} {:>10}'.format('search ms', 'normalized')
+    print(header)
+    total_before = total_after = 0
+    for file_path in args.images:
+        with open(file_path, 'rb') as image_file:
+            content = image_file.read()
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            normalized, _ = normalize(content)
+        elapsed = (time.perf_counter() - started) / args.repeat
+        total_before += len(content)
+        total_after += len(normalized)
+        line = '{:<40} {:>10} {:>10} {:>6.0%} {:>9.1f}'.format(
+            os.path.basename(file_path)[:40], len(content), len(normalized), 1 - len(normalized) / len(content),
+            elapsed * 1000)
+        if args.search:
+            # Warm the channel once so the first image does not pay the handshake.
+            _search_seconds(args, file_path, None)
+            original = _search_seconds(args, file_path, None)
+            with tempfile.NamedTemporaryFile(suffix='.jpg') as normalized_file:
+                normalized_file.write(normalized)
+                normalized_file.flush()
+                reduced = _search_seconds(args, normalized_file.name, None)
+            line += ' {:>10.0f} {:>10.0f}'.format(original * 1000, reduced * 1000)
+        print(line)
+    print('Total: {} -> {} bytes ({:.0%} saved)'.format(
+        total_before, total_after, 1 - total_after / total_before if total_before else 0))
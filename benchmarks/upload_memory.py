@@ -0,0 +1,103 @@
+"""Peak RSS of buffered vs streamed image uploads as concurrency rises.
+
+Images are served by a local HTTP server and uploaded into a sink bucket
+that consumes the data the way GCS does, so no network or credentials are
+needed. Every (mode, concurrency) pair runs in a fresh process because the
+peak RSS of a process never goes down.
+
+    python -m benchmarks.upload_memory --image-size 8 --concurrency 1 4 16 64
+"""
+import argparse
+import http.server
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from main import UPLOAD_CHUNK_SIZE, download_image, upload_image_content, upload_image_stream
+
+
+class _SinkBlob(object):
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size or UPLOAD_CHUNK_SIZE
+
+    def upload_from_string(self, data, content_type=None):
+        len(data)
+
+    def upload_from_file(self, file_obj, content_type=None):
+        while file_obj.read(self.chunk_size):
+            pass
+
+
+class _SinkSession(object):
+
+    def bucket(self, bucket_name):
+        return self
+
+    def blob(self, blob_name, chunk_size=None):
+        return _SinkBlob(chunk_size)
+
+
+def _serve(image_size):
+    payload = os.urandom(image_size)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _child(mode, concurrency, url):
+    session = _SinkSession()
+
+    def upload(index):
+        img_url = '{}/{}.jpg'.format(url, index)
+        if mode == 'stream':
+            return upload_image_stream('sink', img_url, session)
+        content, content_type = download_image(img_url)
+        return upload_image_content('sink', 'blob', content, content_type, session)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(upload, range(concurrency * 4)))
+    # ru_maxrss is in kilobytes on Linux.
+    print(json.dumps({'mode': mode, 'concurrency': concurrency,
+                      'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--image-size', type=float, default=8, help='image size in MB')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--child', nargs=3, metavar=('MODE', 'CONCURRENCY', 'URL'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args.child[0], int(args.child[1]), args.child[2])
+        sys.exit()
+
+    server = _serve(int(args.image_size * 1024 * 1024))
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    print('{:>10} {:>12} {:>12}'.format('mode', 'concurrency', 'max RSS MB'))
+    for mode in ('buffered', 'stream'):
+        for concurrency in args.concurrency:
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.upload_memory', '--child', mode, str(concurrency), url],
+                check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print('{:>10} {:>12} {:>12.1f}'.format(mode, concurrency, result['max_rss_mb']))
+    server.shutdown()
@@ -1,47 +1,130 @@
 from colorthief import ColorThief
-from scipy.spatial import KDTree
-from webcolors import (
-    CSS21_HEX_TO_NAMES,
-    CSS3_HEX_TO_NAMES,
-    hex_to_rgb,
-    rgb_to_name
-)
 import colorgram
 from google.cloud import vision
+from PIL import Image
+import collections
 import io
+import os
+import sys
+import threading
+import numpy as np
 import pandas as pd
 
-
-def convert_rgb_to_names(rgb_tuple, css_db):
-    names = []
-    rgb_values = []
-    for color_hex, color_name in css_db.items():
-        names.append(color_name)
-        rgb_values.append(hex_to_rgb(color_hex))
-
-    kdt_db = KDTree(rgb_values)
-    distance, index = kdt_db.query(rgb_tuple)
-    return f'{names[index]}'
+# The palette index and the NumPy extractor are shared with ingestion.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from colors import SAMPLE_EDGE, get_color_index, kmeans_palette  # noqa: E402
+
+
+class DecodedImage(object):
+    """An image file read and decoded once, shared by all the extractors.
+
+    `content` holds the file bytes (what Vision is sent), `image` the
+    decoded RGB image (what colorgram and ColorThief work on) and `pixels`
+    a NumPy view of it, all created once.
+    Args:
+        img_url: Path of the image.
+        max_edge: Optional longest side to decode at, JPEGs are then decoded
+            at reduced scale.
+    """
+
+    def __init__(self, img_url, max_edge=None):
+        self.img_url = img_url
+        with io.open(img_url, 'rb') as image_file:
+            self.content = image_file.read()
+        image = Image.open(io.BytesIO(self.content))
+        if max_edge:
+            image.draft('RGB', (max_edge, max_edge))
+        image = image.convert('RGB')
+        if max_edge and max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.BILINEAR)
+        self.image = image
+        self.pixels = np.asarray(image, dtype=np.uint8)
+        self._samples = {}
+
+    def sample_pixels(self, max_edge=SAMPLE_EDGE):
+        """Pixels of a copy reduced to `max_edge`, as an (N, 3) array."""
+        pixels = self._samples.get(max_edge)
+        if pixels is None:
+            if max(self.image.size) > max_edge:
+                image = self.image.copy()
+                image.thumbnail((max_edge, max_edge), Image.BILINEAR)
+                pixels = np.asarray(image, dtype=np.uint8).reshape(-1, 3)
+            else:
+                pixels = self.pixels.reshape(-1, 3)
+            self._samples[max_edge] = pixels
+        return pixels
+
+
+class ImageCache(object):
+    """Bounded LRU of decoded images, keyed by path, mtime and decode size."""
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, img_url, max_edge=None):
+        key = (os.path.abspath(img_url), os.stat(img_url).st_mtime_ns, max_edge)
+        with self._lock:
+            decoded = self._entries.get(key)
+            if decoded is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return decoded
+        decoded = DecodedImage(img_url, max_edge)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = decoded
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return decoded
+
+
+image_cache = ImageCache()
+
+
+def load_image(img_url, max_edge=None):
+    """Return the shared DecodedImage of a path, or `img_url` if it already is one."""
+    if isinstance(img_url, DecodedImage):
+        return img_url
+    return image_cache.get(img_url, max_edge)
+
+
+def numpy_convert(img_url):
+    palette_color = kmeans_palette(load_image(img_url).sample_pixels())
+    rgbs = [rgb for rgb, proportion in palette_color]
+    css_2 = get_color_index('css21').names_of(rgbs)
+    css_3 = get_color_index('css3').names_of(rgbs)
+    dataset = []
+    for (rgb, proportion), color_css_2, color_css_3 in zip(palette_color, css_2, css_3):
+        dataset.append(tuple((rgb, proportion, color_css_2, color_css_3)))
+    df = pd.DataFrame(dataset, columns=['RGB', 'PROPORTION', 'COLOR-CSS2', 'COLOR-CSS3'])
+    print(df)
 
 
 def cologram_convert(img_url):
-    colors = colorgram.extract(img_url, 8)
+    colors = colorgram.extract(load_image(img_url).image, 8)
+    rgbs = [tuple(c_color.rgb) for c_color in colors]
+    css_2 = get_color_index('css21').names_of(rgbs)
+    css_3 = get_color_index('css3').names_of(rgbs)
     dataset = []
-    for c_color in colors:
-        color_css_2 = convert_rgb_to_names(c_color.rgb, CSS21_HEX_TO_NAMES)
-        color_css_3 = convert_rgb_to_names(c_color.rgb, CSS3_HEX_TO_NAMES)
+    for c_color, color_css_2, color_css_3 in zip(colors, css_2, css_3):
         dataset.append(tuple((c_color.rgb, c_color.proportion, color_css_2, color_css_3)))
     df = pd.DataFrame(dataset, columns=['RGB', 'PROPORTION', 'COLOR-CSS2', 'COLOR-CSS3'])
     print(df)
 
 
 def color_thief_convert(img_url):
-    color_thief = ColorThief(img_url)
+    # ColorThief only opens the file in __init__, hand it the decoded image instead.
+    color_thief = ColorThief.__new__(ColorThief)
+    color_thief.image = load_image(img_url).image
     palette_color = color_thief.get_palette(quality=1)
+    css_2 = get_color_index('css21').names_of(palette_color)
+    css_3 = get_color_index('css3').names_of(palette_color)
     dataset = []
-    for p_color in palette_color:
-        color_css_2 = convert_rgb_to_names(p_color, CSS21_HEX_TO_NAMES)
-        color_css_3 = convert_rgb_to_names(p_color, CSS3_HEX_TO_NAMES)
+    for p_color, color_css_2, color_css_3 in zip(palette_color, css_2, css_3):
         dataset.append(tuple((p_color, color_css_2, color_css_3)))
     df = pd.DataFrame(dataset, columns=['RGB', 'COLOR-CSS2', 'COLOR-CSS3'])
     print(df)
@@ -51,18 +134,18 @@ def vision_api_convert(img_url):
     """Detects image properties in the file."""
     client = vision.ImageAnnotatorClient()
 
-    with io.open(img_url, 'rb') as image_file:
-        content = image_file.read()
+    content = load_image(img_url).content
 
     image = vision.Image(content=content)
 
     response = client.image_properties(image=image)
     props = response.image_properties_annotation
+    colors = props.dominant_colors.colors
+    rgbs = [(color.color.red, color.color.green, color.color.blue) for color in colors]
+    css_2 = get_color_index('css21').names_of(rgbs)
+    css_3 = get_color_index('css3').names_of(rgbs)
     dataset = []
-    for color in props.dominant_colors.colors:
-        t = (color.color.red, color.color.green, color.color.blue)
-        color_css_2 = (convert_rgb_to_names(t, CSS21_HEX_TO_NAMES))
-        color_css_3 = (convert_rgb_to_names(t, CSS3_HEX_TO_NAMES))
+    for color, t, color_css_2, color_css_3 in zip(colors, rgbs, css_2, css_3):
         dataset.append(tuple((t, color.score, color_css_2, color_css_3)))
     df = pd.DataFrame(dataset, columns=['RGB', 'SCORE', 'COLOR-CSS2', 'COLOR-CSS3'])
     print(df)
@@ -76,6 +159,8 @@ def vision_api_convert(img_url):
 
 def get_color_image(img_url):
     print(img_url)
+    # Read and decoded once, every extractor below works on the same copy.
+    img_url = load_image(img_url)
     print('--------------')
     print('Cologram')
     cologram_convert(img_url)
@@ -86,6 +171,9 @@ def get_color_image(img_url):
     print('Vision Api')
     vision_api_convert(img_url)
     print('--------------')
+    print('NumPy')
+    numpy_convert(img_url)
+    print('--------------')
 
 
 if __name__ == '__main__':
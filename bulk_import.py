@@ -0,0 +1,217 @@
+import csv
+import io
+import os
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import vision
+
+from main import read_catalog_rows, upload_image
+from session import get_session
+
+# ImportProductSets accepts at most this many lines per CSV file.
+MAX_CSV_LINES = 20000
+# Product labels are limited to 128 bytes per key and value.
+MAX_LABEL_LENGTH = 128
+# Catalog fields the import lines are built from, descriptions are not imported.
+BULK_FIELDS = ('beni_product_id', 'product_id', 'img_url', 'brand', 'product_title', 'gender', 'color',
+               'product_category')
+
+
+def _label_value(value):
+    """Make a label value safe for the `key=value,key=value` labels column."""
+    value = value.replace(',', ' ').replace('=', ' ').strip()
+    return value.encode('utf-8')[:MAX_LABEL_LENGTH].decode('utf-8', 'ignore')
+
+
+def bulk_csv_line(catalog_row, gcs_uri, product_set_id, product_category):
+    """Build one line of the Vision bulk-import CSV.
+    Args:
+        catalog_row: Catalog row as returned by `read_catalog_rows`.
+        gcs_uri: Google Cloud Storage path of the staged image.
+        product_set_id: Id of the product set.
+        product_category: Category of the product.
+    Returns:
+        The columns image-uri, image-id, product-set-id, product-id,
+        product-category, product-display-name, labels and bounding-poly.
+    """
+    labels = ','.join('{}={}'.format(key, _label_value(catalog_row[field])) for key, field in (
+        ('brand', 'brand'),
+        ('gender', 'gender'),
+        ('color', 'color'),
+        ('category', 'product_category'),
+    ) if catalog_row[field])
+    return [
+        gcs_uri,
+        catalog_row['product_id'],
+        product_set_id,
+        catalog_row['beni_product_id'],
+        product_category,
+        catalog_row['product_title'],
+        labels,
+        '',
+    ]
+
+
+def render_bulk_csv(lines):
+    """Render bulk-import lines as CSV text."""
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\n').writerows(lines)
+    return buffer.getvalue()
+
+
+class GcsImportTransport(object):
+    """Stages images and import files in GCS and runs ImportProductSets."""
+
+    def __init__(self, project_id, location, bucket_name, prefix='bulk-import', session=None, manifest=None,
+                 normalize=None):
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.session = session or get_session(project_id, location)
+        self.manifest = manifest
+        self.normalize = normalize
+
+    def stage_image(self, img_url):
+        return upload_image(self.bucket_name, img_url, session=self.session, manifest=self.manifest,
+                            normalize=self.normalize)
+
+    def upload_csv(self, name, text):
+        bucket = self.session.bucket(self.bucket_name)
+        blob_name = '{}/{}'.format(self.prefix, name)
+        bucket.blob(blob_name).upload_from_string(text, content_type='text/csv')
+        return 'gs://' + self.bucket_name + '/' + blob_name
+
+    def start_import(self, csv_uri):
+        gcs_source = vision.ImportProductSetsGcsSource(csv_file_uri=csv_uri)
+        input_config = vision.ImportProductSetsInputConfig(gcs_source=gcs_source)
+        return self.session.product_search_client.import_product_sets(
+            parent=self.session.location_path, input_config=input_config)
+
+
+class _LocalOperation(object):
+
+    def __init__(self, response):
+        self._response = response
+
+    def done(self):
+        return True
+
+    def result(self, timeout=None):
+        return self._response
+
+
+class LocalImportTransport(object):
+    """Stand-in transport that keeps everything on the local filesystem.
+
+    Images are not downloaded, import files are written under `root_dir`
+    and the import operation validates each line the way the API does,
+    so the bulk mode can be exercised without Google Cloud credentials.
+    """
+
+    def __init__(self, root_dir, failing_urls=()):
+        self.root_dir = root_dir
+        self.failing_urls = set(failing_urls)
+        self.products = {}
+        os.makedirs(root_dir, exist_ok=True)
+
+    def stage_image(self, img_url):
+        if not img_url or img_url in self.failing_urls:
+            return None
+        return 'gs://local/' + img_url.split('//')[-1]
+
+    def upload_csv(self, name, text):
+        path = os.path.join(self.root_dir, name)
+        with open(path, 'w') as csv_file:
+            csv_file.write(text)
+        return path
+
+    def start_import(self, csv_uri):
+        statuses = []
+        reference_images = []
+        with open(csv_uri, 'r') as csv_file:
+            for line in csv.reader(csv_file):
+                if len(line) != 8 or not line[0].startswith('gs://') or not line[3]:
+                    statuses.append(types.SimpleNamespace(code=3, message='Invalid line: {}'.format(line)))
+                    continue
+                self.products.setdefault(line[3], []).append(line[0])
+                statuses.append(types.SimpleNamespace(code=0, message=''))
+                reference_images.append(types.SimpleNamespace(name=line[1], uri=line[0]))
+        return _LocalOperation(types.SimpleNamespace(statuses=statuses, reference_images=reference_images))
+
+
+def stage_catalog(transport, csv_path, product_set_id, product_category='apparel', max_workers=16):
+    """Stage every catalog image and build the bulk-import lines.
+    Args:
+        transport: Transport used to stage the images.
+        csv_path: Path of the catalog CSV export.
+        product_set_id: Id of the product set.
+        product_category: Category of the products.
+        max_workers: Number of images staged concurrently.
+    Returns:
+        A tuple with the import lines, the catalog rows they were built
+        from and the rows whose image could not be staged.
+    """
+    catalog_rows = list(read_catalog_rows(csv_path, BULK_FIELDS))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        gcs_uris = list(executor.map(lambda row: transport.stage_image(row['img_url']), catalog_rows))
+
+    lines = []
+    staged_rows = []
+    failed_rows = []
+    for catalog_row, gcs_uri in zip(catalog_rows, gcs_uris):
+        if gcs_uri is None:
+            failed_rows.append(catalog_row)
+            continue
+        lines.append(bulk_csv_line(catalog_row, gcs_uri, product_set_id, product_category))
+        staged_rows.append(catalog_row)
+    return lines, staged_rows, failed_rows
+
+
+def wait_for_operation(operation, poll_interval=10, timeout=None):
+    """Poll a long-running operation until it finishes and return its response."""
+    started = time.monotonic()
+    while not operation.done():
+        if timeout is not None and time.monotonic() - started > timeout:
+            raise TimeoutError('Import operation did not finish in {} seconds'.format(timeout))
+        print('Import running for {:.0f}s...'.format(time.monotonic() - started))
+        time.sleep(poll_interval)
+    return operation.result()
+
+
+def import_catalog(transport, csv_path, product_set_id, product_category='apparel', max_workers=16,
+                   poll_interval=10, timeout=None):
+    """Load the whole catalog with ImportProductSets operations.
+    Args:
+        transport: A `GcsImportTransport` or any object with the same methods.
+        csv_path: Path of the catalog CSV export.
+        product_set_id: Id of the product set. It is created if it does not exist.
+        product_category: Category of the products.
+        max_workers: Number of images staged concurrently.
+        poll_interval: Seconds between operation polls.
+        timeout: Seconds to wait for each operation, None waits forever.
+    Returns:
+        A list of (beni_product_id, error message) for every row that failed.
+    """
+    lines, staged_rows, failed_rows = stage_catalog(
+        transport, csv_path, product_set_id, product_category, max_workers)
+    failures = [(row['beni_product_id'], 'Image could not be staged: {}'.format(row['img_url']))
+                for row in failed_rows]
+
+    for start in range(0, len(lines), MAX_CSV_LINES):
+        chunk = lines[start:start + MAX_CSV_LINES]
+        csv_uri = transport.upload_csv(
+            '{}-{}.csv'.format(product_set_id, start // MAX_CSV_LINES), render_bulk_csv(chunk))
+        print('Importing {} lines from {}'.format(len(chunk), csv_uri))
+        response = wait_for_operation(transport.start_import(csv_uri), poll_interval, timeout)
+        # statuses are in the same order as the lines of the CSV file.
+        for catalog_row, status in zip(staged_rows[start:start + MAX_CSV_LINES], response.statuses):
+            if status.code != 0:
+                failures.append((catalog_row['beni_product_id'], status.message))
+        print('Reference images imported: {}'.format(len(response.reference_images)))
+
+    for beni_product_id, message in failures:
+        print('Failed {}: {}'.format(beni_product_id, message))
+    total = len(lines) + len(failed_rows)
+    print('Imported {} of {} rows'.format(total - len(failures), total))
+    return failures
@@ -0,0 +1,311 @@
+"""Columnar on-disk copy of the catalog export.
+
+The CSV is streamed once into one string column per CSV column: a UTF-8
+data file holding the values back to back and an int64 offsets file,
+both memory-mapped when read. Prices, stock flags and dates are also
+stored as fixed-width typed columns (float64, int8 and datetime64 in
+UTC), read as NumPy arrays with `CatalogStore.values`; their text stays
+available so rows keep the exact CSV values. Reading a row only touches the columns
+asked for, so the long descriptions are never loaded by steps that do
+not need them. A sorted array of 64-bit hashes of `beni_product_id`
+answers lookups by id with a binary search instead of a full scan.
+
+The store is rebuilt automatically when the CSV changes:
+
+    catalog = open_catalog('product_catalog_productbase.csv')
+    catalog.get('Tradesy-4716', ['img_url', 'updated_at'])
+    for catalog_row in catalog.rows(['beni_product_id', 'updated_at']):
+        ...
+"""
+import array
+import csv
+import datetime
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+# Keys of the catalog rows used across the code, mapped to their CSV column.
+CATALOG_FIELDS = {
+    'beni_product_id': 'beni_product_id',
+    'product_id': 'product_id',
+    'img_url': 'image_url',
+    'brand': 'brand',
+    'product_title': 'product_title',
+    'product_description': 'product_description',
+    'gender': 'gender',
+    'color': 'color',
+    'updated_at': 'updated_at',
+    'product_category': 'product_category',
+}
+
+ID_COLUMN = 'beni_product_id'
+# CSV columns also stored as typed values, mapped to their NumPy dtype.
+TYPED_COLUMNS = {
+    'price': 'float64',
+    'in_stock': 'int8',
+    'created_at': 'datetime64[us]',
+    'updated_at': 'datetime64[us]',
+}
+# Bumped when the layout changes, older stores are rebuilt.
+STORE_VERSION = 2
+# Offsets buffered per column before they are written out.
+_FLUSH_ROWS = 65536
+
+
+def id_hash(beni_product_id):
+    """64-bit hash of a product id, as stored in the id index."""
+    return int.from_bytes(hashlib.blake2b(beni_product_id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+def parse_price(value):
+    """Amount of a `29.80 USD` price, NaN if there is none."""
+    try:
+        return float(value.split()[0])
+    except (IndexError, ValueError):
+        return float('nan')
+
+
+def parse_flag(value):
+    """1 for True, 0 for False, -1 when the flag is missing or unknown."""
+    return {'true': 1, 'false': 0}.get(value.strip().lower(), -1)
+
+
+def parse_timestamp(value):
+    """Microseconds since the epoch in UTC of a `2022-01-06 11:22:58.59-03` timestamp.
+
+    Returns the NaT value of datetime64 when the timestamp cannot be parsed.
+    Timestamps without an offset are taken as UTC.
+    """
+    try:
+        moment = datetime.datetime.fromisoformat(value.strip())
+    except ValueError:
+        return np.iinfo(np.int64).min
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=datetime.timezone.utc)
+    delta = moment - datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+# Parser and array typecode of each dtype of TYPED_COLUMNS.
+_TYPE_PARSERS = {
+    'float64': (parse_price, 'd'),
+    'int8': (parse_flag, 'b'),
+    'datetime64[us]': (parse_timestamp, 'q'),
+}
+
+
+def _column_file(store_dir, column, suffix):
+    # Column names come from the CSV header, keep them file-name safe.
+    safe = ''.join(c if c.isalnum() or c == '_' else '_' for c in column)
+    return os.path.join(store_dir, '{}.{}'.format(safe, suffix))
+
+
+def _source_stamp(csv_path):
+    stat = os.stat(csv_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def build_store(csv_path, store_dir):
+    """Stream a catalog CSV into a columnar store.
+
+    Memory stays bounded by the offset buffers and the id hashes (16
+    bytes a row), whatever the size of the text columns. The store is
+    written next to its final location and moved in place once complete.
+    Args:
+        csv_path: Path of the catalog CSV export.
+        store_dir: Directory of the store, replaced if it exists.
+    Returns:
+        The number of rows stored.
+    """
+    tmp_dir = store_dir.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    stamp = _source_stamp(csv_path)
+    with open(csv_path, 'r', newline='', encoding='utf-8') as read_obj:
+        csv_reader = csv.reader(read_obj)
+        header = next(csv_reader, None) or []
+        data_files = [open(_column_file(tmp_dir, column, 'data'), 'wb') for column in header]
+        offset_files = [open(_column_file(tmp_dir, column, 'offsets'), 'wb') for column in header]
+        positions = [0] * len(header)
+        offsets = [array.array('q', [0]) for _ in header]
+        typed = [(index, column, _TYPE_PARSERS[TYPED_COLUMNS[column]][0])
+                 for index, column in enumerate(header) if column in TYPED_COLUMNS]
+        value_files = {column: open(_column_file(tmp_dir, column, 'values'), 'wb') for _, column, _ in typed}
+        values = {column: array.array(_TYPE_PARSERS[TYPED_COLUMNS[column]][1]) for _, column, _ in typed}
+        id_position = header.index(ID_COLUMN) if ID_COLUMN in header else None
+        hashes = array.array('Q')
+        count = 0
+        try:
+            for row in csv_reader:
+                if len(row) < len(header):
+                    row = row + [''] * (len(header) - len(row))
+                for index, value in enumerate(row[:len(header)]):
+                    encoded = value.encode('utf-8')
+                    data_files[index].write(encoded)
+                    positions[index] += len(encoded)
+                    offsets[index].append(positions[index])
+                for index, column, parse in typed:
+                    values[column].append(parse(row[index]))
+                if id_position is not None:
+                    hashes.append(id_hash(row[id_position]))
+                count += 1
+                if count % _FLUSH_ROWS == 0:
+                    for index, column_offsets in enumerate(offsets):
+                        column_offsets.tofile(offset_files[index])
+                        offsets[index] = array.array('q')
+                    for column, column_values in values.items():
+                        column_values.tofile(value_files[column])
+                        values[column] = array.array(column_values.typecode)
+            for index, column_offsets in enumerate(offsets):
+                column_offsets.tofile(offset_files[index])
+            for column, column_values in values.items():
+                column_values.tofile(value_files[column])
+        finally:
+            for store_file in data_files + offset_files + list(value_files.values()):
+                store_file.close()
+
+    if id_position is not None:
+        hash_array = np.frombuffer(hashes, dtype=np.uint64)
+        # Stable, so rows sharing an id keep the CSV order.
+        order = np.argsort(hash_array, kind='stable')
+        hash_array[order].tofile(os.path.join(tmp_dir, 'ids.hash'))
+        order.astype(np.int64).tofile(os.path.join(tmp_dir, 'ids.rows'))
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as meta_file:
+        json.dump({'version': STORE_VERSION, 'columns': header, 'rows': count, 'source': stamp,
+                   'types': {column: TYPED_COLUMNS[column] for _, column, _ in typed}}, meta_file)
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(tmp_dir, store_dir)
+    return count
+
+
+class StringColumn(object):
+    """Memory-mapped string column, values are decoded on access."""
+
+    def __init__(self, store_dir, column, rows):
+        self.offsets = np.memmap(_column_file(store_dir, column, 'offsets'), dtype=np.int64, mode='r',
+                                 shape=(rows + 1,))
+        data_path = _column_file(store_dir, column, 'data')
+        # Memory-mapping an empty file fails, an all-empty column needs no mapping.
+        self.data = np.memmap(data_path, dtype=np.uint8, mode='r') if os.path.getsize(data_path) else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return bytes(self.data[start:end]).decode('utf-8')
+
+
+class CatalogStore(object):
+    """Read access to a store written by `build_store`.
+
+    Fields are the keys of CATALOG_FIELDS or any CSV column name. Columns
+    are opened the first time they are read.
+    Args:
+        store_dir: Directory of the store.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json')) as meta_file:
+            self.meta = json.load(meta_file)
+        self.columns = self.meta['columns']
+        self.types = self.meta.get('types', {})
+        self._columns = {}
+        self._values = {}
+        self._hashes = None
+        self._rows = None
+        if os.path.exists(os.path.join(store_dir, 'ids.hash')):
+            self._hashes = np.fromfile(os.path.join(store_dir, 'ids.hash'), dtype=np.uint64)
+            self._rows = np.fromfile(os.path.join(store_dir, 'ids.rows'), dtype=np.int64)
+
+    def __len__(self):
+        return self.meta['rows']
+
+    def column(self, field):
+        """Return the StringColumn of a field."""
+        name = CATALOG_FIELDS.get(field, field)
+        column = self._columns.get(name)
+        if column is None:
+            if name not in self.columns:
+                raise KeyError('Unknown catalog column: {}'.format(field))
+            column = self._columns[name] = StringColumn(self.store_dir, name, len(self))
+        return column
+
+    def values(self, field):
+        """Return the typed values of a TYPED_COLUMNS field as a memory-mapped array.
+
+        Missing or unparseable values are NaN for prices, -1 for flags and
+        NaT for dates.
+        """
+        name = CATALOG_FIELDS.get(field, field)
+        column_values = self._values.get(name)
+        if column_values is None:
+            if name not in self.types:
+                raise KeyError('The catalog column {} is not typed'.format(field))
+            if not len(self):
+                column_values = np.zeros(0, dtype=self.types[name])
+            else:
+                column_values = np.memmap(_column_file(self.store_dir, name, 'values'), dtype=self.types[name],
+                                          mode='r', shape=(len(self),))
+            self._values[name] = column_values
+        return column_values
+
+    def row(self, index, fields=None):
+        """Return the fields of a row as a dict, by default the CATALOG_FIELDS."""
+        fields = list(CATALOG_FIELDS) if fields is None else fields
+        return {field: self.column(field)[index] for field in fields}
+
+    def rows(self, fields=None):
+        """Yield every row, in CSV order, projected on `fields`."""
+        fields = list(CATALOG_FIELDS) if fields is None else fields
+        columns = [(field, self.column(field)) for field in fields]
+        for index in range(len(self)):
+            yield {field: column[index] for field, column in columns}
+
+    def find(self, beni_product_id):
+        """Return the row index of a product id, or None."""
+        if self._hashes is None:
+            raise KeyError('The catalog has no {} column'.format(ID_COLUMN))
+        key = np.uint64(id_hash(beni_product_id))
+        position = int(np.searchsorted(self._hashes, key))
+        ids = self.column(ID_COLUMN)
+        # Rows sharing the hash are adjacent, tell collisions apart by value.
+        while position < len(self._hashes) and self._hashes[position] == key:
+            index = int(self._rows[position])
+            if ids[index] == beni_product_id:
+                return index
+            position += 1
+        return None
+
+    def get(self, beni_product_id, fields=None):
+        """Return the row of a product id projected on `fields`, or None."""
+        index = self.find(beni_product_id)
+        return None if index is None else self.row(index, fields)
+
+    def is_current(self, csv_path):
+        """Whether the store was built from the current version of the CSV."""
+        return self.meta.get('version') == STORE_VERSION and self.meta.get('source') == _source_stamp(csv_path)
+
+
+def default_store_dir(csv_path):
+    return os.path.splitext(csv_path)[0] + '.catalog'
+
+
+def open_catalog(csv_path, store_dir=None):
+    """Open the store of a catalog CSV, building or rebuilding it if needed.
+    Args:
+        csv_path: Path of the catalog CSV export.
+        store_dir: Directory of the store, defaults to the CSV path with a
+            .catalog extension.
+    """
+    store_dir = store_dir or default_store_dir(csv_path)
+    if os.path.exists(os.path.join(store_dir, 'meta.json')):
+        store = CatalogStore(store_dir)
+        if store.is_current(csv_path):
+            return store
+    build_store(csv_path, store_dir)
+    return CatalogStore(store_dir)
@@ -0,0 +1,331 @@
+"""Dominant colors of images and their names in a palette of color names.
+
+Used by ingestion to label products with normalized colors, and by the
+color comparisons in beni-test-cases/color_image.py.
+"""
+import base64
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from scipy.spatial import KDTree
+from webcolors import CSS21_HEX_TO_NAMES, CSS3_HEX_TO_NAMES, hex_to_rgb
+
+# Longest side images are reduced to before extracting their palette.
+SAMPLE_EDGE = 100
+# Maximum standard deviation, per RGB channel, of a border still considered
+# a plain background.
+BACKGROUND_TOLERANCE = 20
+
+# Coarse names used to label garments, closer to catalog colors than CSS.
+FASHION_HEX_TO_NAMES = {
+    '#000000': 'black',
+    '#ffffff': 'white',
+    '#f5f0e1': 'cream',
+    '#808080': 'grey',
+    '#c0c0c0': 'silver',
+    '#1f2a44': 'navy',
+    '#2f5da8': 'blue',
+    '#87b5e0': 'light blue',
+    '#1f8a8a': 'teal',
+    '#2e7d32': 'green',
+    '#6b6b2e': 'olive',
+    '#c3b091': 'khaki',
+    '#e8d9b5': 'beige',
+    '#c19a6b': 'camel',
+    '#6f4e37': 'brown',
+    '#c62828': 'red',
+    '#7b1f2e': 'burgundy',
+    '#f4a6b7': 'pink',
+    '#ef6c00': 'orange',
+    '#f9d71c': 'yellow',
+    '#d4af37': 'gold',
+    '#6a1b9a': 'purple',
+    '#b39ddb': 'lilac',
+}
+
+PALETTES = {
+    'css21': CSS21_HEX_TO_NAMES,
+    'css3': CSS3_HEX_TO_NAMES,
+    'fashion': FASHION_HEX_TO_NAMES,
+}
+
+
+def rgb_to_lab(rgb):
+    """Convert an (N, 3) array of sRGB colors (0-255) to CIELAB (D65)."""
+    rgb = np.asarray(rgb, dtype=np.float64) / 255
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = linear @ np.array([[0.4124, 0.3576, 0.1805],
+                             [0.2126, 0.7152, 0.0722],
+                             [0.0193, 0.1192, 0.9505]]).T
+    xyz /= np.array([0.95047, 1.0, 1.08883])
+    f = np.where(xyz > 216 / 24389, np.cbrt(xyz), (24389 / 27 * xyz + 16) / 116)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+
+class ColorNameIndex(object):
+    """Nearest color name lookup over a fixed palette.
+
+    The palette is converted and loaded in a KDTree once, then any number
+    of colors is named with a single vectorized query.
+    Args:
+        hex_to_names: Mapping of '#rrggbb' to color name.
+        space: 'rgb' for plain RGB distance, 'lab' for CIELAB distance,
+            which matches perceived color differences better.
+    """
+
+    def __init__(self, hex_to_names, space='rgb'):
+        self.space = space
+        self.names = np.array(list(hex_to_names.values()))
+        self.rgb_values = np.array([hex_to_rgb(color_hex) for color_hex in hex_to_names], dtype=np.float64)
+        self.kdt_db = KDTree(self._to_space(self.rgb_values))
+
+    def _to_space(self, rgb):
+        return rgb_to_lab(rgb) if self.space == 'lab' else np.asarray(rgb, dtype=np.float64)
+
+    def names_of(self, colors):
+        """Name an (N, 3) array of RGB colors, returns N names."""
+        colors = np.asarray(colors, dtype=np.float64).reshape(-1, 3)
+        if not len(colors):
+            return []
+        distance, index = self.kdt_db.query(self._to_space(colors))
+        return self.names[index].tolist()
+
+    def name_of(self, rgb_tuple):
+        return self.names_of([rgb_tuple])[0]
+
+
+_color_indexes = {}
+_color_indexes_lock = threading.Lock()
+
+
+def get_color_index(palette='css3', space='rgb'):
+    """Return the shared index of a palette, building it on first use.
+
+    Only the named palettes are shared, an index is built for every call
+    with a mapping, which callers can keep instead.
+    Args:
+        palette: A name in PALETTES, or a '#rrggbb' to name mapping.
+        space: 'rgb' or 'lab', see `ColorNameIndex`.
+    """
+    if not isinstance(palette, str):
+        return ColorNameIndex(palette, space)
+    key = (palette, space)
+    color_index = _color_indexes.get(key)
+    if color_index is None:
+        with _color_indexes_lock:
+            color_index = _color_indexes.get(key)
+            if color_index is None:
+                color_index = _color_indexes[key] = ColorNameIndex(PALETTES[palette], space)
+    return color_index
+
+
+def load_pixels(img_url, max_edge=SAMPLE_EDGE):
+    """Decode an image at reduced size and return its pixels as an (N, 3) uint8 array."""
+    image = Image.open(img_url)
+    # Lets the JPEG decoder skip most of the work for large photos.
+    image.draft('RGB', (max_edge, max_edge))
+    image = image.convert('RGB')
+    image.thumbnail((max_edge, max_edge), Image.BILINEAR)
+    return np.asarray(image, dtype=np.uint8).reshape(-1, 3)
+
+
+def kmeans_palette(pixels, color_count=8, iterations=20, seed=0):
+    """Dominant colors of a set of pixels, with vectorized k-means.
+
+    Centers are seeded with k-means++ from a fixed seed, so the same image
+    always gives the same palette.
+    Args:
+        pixels: (N, 3) array of RGB pixels.
+        color_count: Maximum number of colors returned.
+        iterations: Maximum number of k-means iterations.
+        seed: Seed of the center initialization.
+    Returns:
+        List of (rgb tuple, proportion), most frequent color first.
+    """
+    pixels = np.asarray(pixels, dtype=np.uint32).reshape(-1, 3)
+    if not len(pixels):
+        return []
+    # Identical pixels are clustered once, weighted by how often they appear.
+    packed, counts = np.unique(pixels[:, 0] << 16 | pixels[:, 1] << 8 | pixels[:, 2], return_counts=True)
+    colors = np.stack([packed >> 16, packed >> 8 & 255, packed & 255], axis=1).astype(np.float32)
+    weights = counts.astype(np.float32)
+    color_count = min(color_count, len(colors))
+    random_state = np.random.RandomState(seed)
+
+    centers = np.empty((color_count, 3), dtype=np.float32)
+    centers[0] = colors[random_state.choice(len(colors), p=weights / weights.sum())]
+    closest = ((colors - centers[0]) ** 2).sum(axis=1)
+    for i in range(1, color_count):
+        probabilities = closest * weights
+        total = probabilities.sum()
+        if not total:
+            color_count = i
+            centers = centers[:i]
+            break
+        centers[i] = colors[random_state.choice(len(colors), p=probabilities / total)]
+        closest = np.minimum(closest, ((colors - centers[i]) ** 2).sum(axis=1))
+
+    for _ in range(iterations):
+        distances = ((colors[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        labels = distances.argmin(axis=1)
+        cluster_weights = np.bincount(labels, weights=weights, minlength=color_count)
+        sums = np.stack([np.bincount(labels, weights=weights * colors[:, channel], minlength=color_count)
+                         for channel in range(3)], axis=1)
+        occupied = cluster_weights > 0
+        updated = centers.copy()
+        updated[occupied] = sums[occupied] / cluster_weights[occupied, None]
+        if np.allclose(updated, centers, atol=0.5):
+            centers = updated
+            break
+        centers = updated
+
+    distances = ((colors[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+    cluster_weights = np.bincount(distances.argmin(axis=1), weights=weights, minlength=color_count)
+    order = np.argsort(-cluster_weights)
+    total = cluster_weights.sum()
+    return [(tuple(int(round(value)) for value in centers[i]), float(cluster_weights[i] / total))
+            for i in order if cluster_weights[i] > 0]
+
+
+def extract_palette(img_url, color_count=8):
+    return kmeans_palette(load_pixels(img_url), color_count)
+
+
+def extract_palettes(img_urls, color_count=8, max_workers=None, chunksize=16):
+    """Palettes of many images, spread across a process pool.
+    Args:
+        img_urls: Paths of the images.
+        color_count: Maximum number of colors per palette.
+        max_workers: Number of processes, defaults to the number of CPUs.
+        chunksize: Images sent to a worker at a time.
+    Returns:
+        A palette per image, in input order. See `kmeans_palette`.
+    """
+    img_urls = list(img_urls)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(extract_palette, img_urls, [color_count] * len(img_urls), chunksize=chunksize))
+
+
+def _background_mask(pixels):
+    """Mask of the pixels matching a uniform border, i.e. a studio background."""
+    border = np.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]]).astype(np.float32)
+    if border.std(axis=0).max() > BACKGROUND_TOLERANCE:
+        return np.zeros(pixels.shape[:2], dtype=bool)
+    background = np.median(border, axis=0)
+    return np.sqrt(((pixels.astype(np.float32) - background) ** 2).sum(axis=2)) < BACKGROUND_TOLERANCE * 2
+
+
+def dominant_color_names(content, palette='fashion', min_proportion=0.15, max_colors=2):
+    """Normalized names of the main colors of an image.
+
+    A uniform background, as in catalog photos, is left out so it does not
+    come out as the color of every product. The palette is named in CIELAB
+    and colors sharing a name are added up.
+    Args:
+        content: Image bytes.
+        palette: Palette of names, see `get_color_index`.
+        min_proportion: Share of the image a color needs to be reported.
+        max_colors: Maximum number of names returned.
+    Returns:
+        List of names, most frequent first.
+    """
+    image = Image.open(io.BytesIO(content))
+    image.draft('RGB', (SAMPLE_EDGE, SAMPLE_EDGE))
+    image = image.convert('RGB')
+    image.thumbnail((SAMPLE_EDGE, SAMPLE_EDGE), Image.BILINEAR)
+    pixels = np.asarray(image, dtype=np.uint8)
+    foreground = pixels[~_background_mask(pixels)]
+    # Nothing but background: the product is the color of the background.
+    if len(foreground) < pixels.shape[0] * pixels.shape[1] * 0.05:
+        foreground = pixels.reshape(-1, 3)
+    colors = kmeans_palette(foreground)
+    names = get_color_index(palette, 'lab').names_of([rgb for rgb, _ in colors])
+    totals = {}
+    for name, (_, proportion) in zip(names, colors):
+        totals[name] = totals.get(name, 0.0) + proportion
+    ranked = sorted(totals.items(), key=lambda item: -item[1])
+    return [name for name, proportion in ranked[:max_colors] if proportion >= min_proportion]
+
+
+def content_md5(content):
+    """Base64 MD5 of image bytes, the form GCS reports as `md5_hash`."""
+    return base64.b64encode(hashlib.md5(content).digest()).decode('ascii')
+
+
+class ColorEnricher(object):
+    """Computes the color labels of product images in a process pool.
+
+    Results are cached by the MD5 of the image, in memory and in an
+    append-only JSONL file, so re-ingesting the same images skips the work.
+    The MD5 is the one GCS and the blob manifest use, so images already in
+    the manifest are looked up without being downloaded.
+    Args:
+        cache_path: Optional path of the JSONL cache, created if missing.
+        max_workers: Number of processes, defaults to the number of CPUs.
+        palette: Palette of names, see `get_color_index`.
+    """
+
+    def __init__(self, cache_path=None, max_workers=None, palette='fashion'):
+        self.palette = palette
+        self._colors = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if cache_path is not None:
+            if os.path.exists(cache_path):
+                with open(cache_path, 'r', encoding='utf-8') as cache_file:
+                    for line in cache_file:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            continue
+                        self._colors[entry['md5']] = entry['colors']
+            self._file = open(cache_path, 'a', encoding='utf-8')
+        # Forking copies the gRPC clients and threads of the parent, which
+        # is unsafe: the workers are spawned as fresh interpreters instead.
+        self._executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def __len__(self):
+        return len(self._colors)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, md5):
+        """Return the cached color names of an image, or None."""
+        return self._colors.get(md5)
+
+    def __call__(self, content, md5=None):
+        """Color names of image bytes, computed in the pool on a cache miss.
+
+        Blocks the calling thread only, so pipeline workers calling it keep
+        every process busy.
+        """
+        md5 = md5 or content_md5(content)
+        colors = self._colors.get(md5)
+        if colors is None:
+            colors = self._executor.submit(dominant_color_names, content, self.palette).result()
+            self.remember(md5, colors)
+        return colors
+
+    def remember(self, md5, colors):
+        with self._lock:
+            self._colors[md5] = colors
+            if self._file is not None:
+                self._file.write(json.dumps({'md5': md5, 'colors': colors}) + '\n')
+                self._file.flush()
+
+    def close(self):
+        self._executor.shutdown()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
@@ -0,0 +1,672 @@
+"""In-process stand-ins for the Vision Product Search and Storage clients.
+
+They implement the calls `main.py`, `bulk_import.py` and `find_products.py`
+make, keep product sets, products, reference images and blobs in memory,
+and inject latency, errors and quota limits, so ingestion and search can be
+load-tested without Google Cloud. Sessions use them when the environment
+says so:
+
+    VISION_BACKEND=fake VISION_FAKE_CONFIG=fake.json python main.py pipeline
+
+The optional JSON config sets the latency distribution and error rate of
+every call, overridable per method, and per-method request quotas:
+
+    {
+        "seed": 1,
+        "latency": {"distribution": "lognormal", "median_ms": 60, "sigma": 0.4},
+        "error_rate": 0.01,
+        "methods": {
+            "product_search": {"latency": {"distribution": "lognormal", "median_ms": 250, "sigma": 0.3}},
+            "upload": {"latency": {"distribution": "uniform", "low_ms": 20, "high_ms": 80}}
+        },
+        "quotas": {"create_product": 1800, "product_search": 1800},
+        "quota_window": 60
+    }
+
+Method names are the client method names, plus `upload` (one per upload
+request, i.e. per chunk of a resumable upload) and `download` for blobs.
+Injected errors are `ServiceUnavailable`, exceeded quotas
+`ResourceExhausted`, as the real services raise them.
+"""
+import asyncio
+import base64
+import collections
+import datetime
+import hashlib
+import io
+import json
+import math
+import random
+import threading
+import time
+
+from google.api_core import exceptions
+from google.cloud import vision
+from google.rpc import status_pb2
+
+from label_filter import matches, parse_filter
+
+DEFAULT_CONFIG = {
+    'seed': None,
+    'latency': {'distribution': 'fixed', 'ms': 0},
+    'error_rate': 0.0,
+    'methods': {},
+    'quotas': {},
+    'quota_window': 60,
+}
+
+
+class FaultInjector(object):
+    """Applies the latency, error rate and quota of a config to each call."""
+
+    def __init__(self, config=None):
+        self.config = dict(DEFAULT_CONFIG, **(config or {}))
+        self.calls = collections.Counter()
+        self.errors = collections.Counter()
+        self.throttled = collections.Counter()
+        self._random = random.Random(self.config['seed'])
+        self._lock = threading.Lock()
+        self._windows = {}
+
+    def _setting(self, method, name):
+        return self.config['methods'].get(method, {}).get(name, self.config[name])
+
+    def _latency(self, method):
+        latency = self._setting(method, 'latency')
+        distribution = latency.get('distribution', 'fixed')
+        with self._lock:
+            if distribution == 'uniform':
+                milliseconds = self._random.uniform(latency['low_ms'], latency['high_ms'])
+            elif distribution == 'lognormal':
+                milliseconds = math.exp(self._random.gauss(math.log(latency['median_ms']), latency['sigma']))
+            elif distribution == 'exponential':
+                milliseconds = self._random.expovariate(1 / latency['mean_ms'])
+            else:
+                milliseconds = latency.get('ms', 0)
+        return milliseconds / 1000
+
+    def _check_quota(self, method):
+        limit = self.config['quotas'].get(method)
+        if limit is None:
+            return
+        window = self.config['quota_window']
+        now = time.monotonic()
+        with self._lock:
+            started, count = self._windows.get(method, (now, 0))
+            if now - started >= window:
+                started, count = now, 0
+            if count >= limit:
+                self.throttled[method] += 1
+                raise exceptions.ResourceExhausted(
+                    'Quota exceeded for {}: {} requests per {}s'.format(method, limit, window))
+            self._windows[method] = (started, count + 1)
+
+    def _start(self, method):
+        with self._lock:
+            self.calls[method] += 1
+        self._check_quota(method)
+        return self._latency(method)
+
+    def _finish(self, method):
+        error_rate = self._setting(method, 'error_rate')
+        if error_rate:
+            with self._lock:
+                failed = self._random.random() < error_rate
+                if failed:
+                    self.errors[method] += 1
+            if failed:
+                raise exceptions.ServiceUnavailable('Injected failure of {}'.format(method))
+
+    def __call__(self, method):
+        """Account for one call: raise on quota, sleep, then maybe fail."""
+        delay = self._start(method)
+        if delay > 0:
+            time.sleep(delay)
+        self._finish(method)
+
+    async def wait(self, method):
+        """Same as calling the injector, without blocking the event loop."""
+        delay = self._start(method)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._finish(method)
+
+    def stats(self):
+        return {'calls': dict(self.calls), 'errors': dict(self.errors), 'throttled': dict(self.throttled)}
+
+
+class FakeServices(object):
+    """State shared by every fake client of a process.
+    Args:
+        config: Dict as described in the module docstring.
+    """
+
+    def __init__(self, config=None):
+        self.inject = FaultInjector(config)
+        self.lock = threading.RLock()
+        self.product_sets = {}
+        self.products = {}
+        self.reference_images = {}
+        self.buckets = {}
+        self.index_time = datetime.datetime.now(datetime.timezone.utc)
+        self._embeddings = {}
+
+    @classmethod
+    def from_config_file(cls, path=None):
+        if not path:
+            return cls()
+        with open(path, 'r') as config_file:
+            return cls(json.load(config_file))
+
+    def product_search_client(self):
+        return FakeProductSearchClient(self)
+
+    def image_annotator_client(self):
+        return FakeImageAnnotatorClient(self)
+
+    def image_annotator_async_client(self):
+        return FakeImageAnnotatorAsyncClient(self)
+
+    def product_search_async_client(self):
+        return FakeProductSearchAsyncClient(self)
+
+    def storage_client(self, project=None):
+        return FakeStorageClient(self)
+
+    def storage_async_client(self, http):
+        return FakeStorageAsyncClient(self)
+
+    def touch_index(self):
+        with self.lock:
+            self.index_time = datetime.datetime.now(datetime.timezone.utc)
+
+    def read_blob(self, gcs_uri):
+        """Content of a gs:// URI, or None if no such blob exists."""
+        if not gcs_uri.startswith('gs://'):
+            return None
+        bucket_name, _, blob_name = gcs_uri[len('gs://'):].partition('/')
+        blob = self.buckets.get(bucket_name, {}).get(blob_name)
+        return blob['content'] if blob is not None else None
+
+    def reference_embedding(self, reference_image):
+        """Embedding of a reference image, computed once from its blob.
+
+        Called without the lock: concurrent searches may both compute a
+        missing embedding, they store the same value.
+        """
+        from local_search import embed_image
+
+        embedding = self._embeddings.get(reference_image.name)
+        if embedding is None:
+            content = self.read_blob(reference_image.uri)
+            if content is None:
+                return None
+            try:
+                embedding = embed_image(content)
+            except Exception:
+                return None
+            self._embeddings[reference_image.name] = embedding
+        return embedding
+
+
+class _Operation(object):
+    """Already finished long-running operation."""
+
+    def __init__(self, response):
+        self._response = response
+
+    def done(self):
+        return True
+
+    def result(self, timeout=None):
+        return self._response
+
+
+class FakeProductSearchClient(object):
+    """ProductSearchClient keeping its resources in a FakeServices.
+    Args:
+        services: The FakeServices.
+        inject: Callable applied to the method name of every call,
+            defaults to the fault injector of the services.
+    """
+
+    def __init__(self, services, inject=None):
+        self.services = services
+        self.inject = inject or services.inject
+
+    @staticmethod
+    def product_set_path(project, location, product_set):
+        return 'projects/{}/locations/{}/productSets/{}'.format(project, location, product_set)
+
+    @staticmethod
+    def product_path(project, location, product):
+        return 'projects/{}/locations/{}/products/{}'.format(project, location, product)
+
+    @staticmethod
+    def reference_image_path(project, location, product, reference_image):
+        return 'projects/{}/locations/{}/products/{}/referenceImages/{}'.format(
+            project, location, product, reference_image)
+
+    def _product(self, name):
+        product = self.services.products.get(name)
+        if product is None:
+            raise exceptions.NotFound('Product not found: {}'.format(name))
+        return product
+
+    def _product_set(self, name):
+        product_set = self.services.product_sets.get(name)
+        if product_set is None:
+            raise exceptions.NotFound('Product set not found: {}'.format(name))
+        return product_set
+
+    def create_product_set(self, parent, product_set, product_set_id):
+        self.inject('create_product_set')
+        name = '{}/productSets/{}'.format(parent, product_set_id)
+        with self.services.lock:
+            if name in self.services.product_sets:
+                raise exceptions.AlreadyExists('Product set already exists: {}'.format(name))
+            created = vision.ProductSet(name=name, display_name=product_set.display_name)
+            self.services.product_sets[name] = {'product_set': created, 'products': set()}
+        return created
+
+    def get_product_set(self, name):
+        self.inject('get_product_set')
+        with self.services.lock:
+            product_set = vision.ProductSet(self._product_set(name)['product_set'])
+            product_set.index_time = self.services.index_time
+        return product_set
+
+    def create_product(self, parent, product, product_id):
+        self.inject('create_product')
+        name = '{}/products/{}'.format(parent, product_id)
+        with self.services.lock:
+            if name in self.services.products:
+                raise exceptions.AlreadyExists('Product already exists: {}'.format(name))
+            created = vision.Product(
+                name=name, display_name=product.display_name, description=product.description,
+                product_category=product.product_category, product_labels=list(product.product_labels))
+            self.services.products[name] = created
+            self.services.reference_images[name] = {}
+        return created
+
+    def update_product(self, product, update_mask=None):
+        self.inject('update_product')
+        with self.services.lock:
+            stored = self._product(product.name)
+            for path in (update_mask.paths if update_mask is not None else ('display_name', 'product_labels')):
+                if path == 'product_labels':
+                    stored.product_labels = list(product.product_labels)
+                else:
+                    setattr(stored, path, getattr(product, path))
+        return stored
+
+    def add_product_to_product_set(self, name, product):
+        self.inject('add_product_to_product_set')
+        with self.services.lock:
+            self._product(product)
+            self._product_set(name)['products'].add(product)
+        self.services.touch_index()
+
+    def remove_product_from_product_set(self, name, product):
+        self.inject('remove_product_from_product_set')
+        with self.services.lock:
+            self._product_set(name)['products'].discard(product)
+        self.services.touch_index()
+
+    def create_reference_image(self, parent, reference_image, reference_image_id):
+        self.inject('create_reference_image')
+        name = '{}/referenceImages/{}'.format(parent, reference_image_id)
+        with self.services.lock:
+            self._product(parent)
+            if self.services.read_blob(reference_image.uri) is None:
+                raise exceptions.InvalidArgument('Image not found: {}'.format(reference_image.uri))
+            images = self.services.reference_images[parent]
+            if name in images:
+                raise exceptions.AlreadyExists('Reference image already exists: {}'.format(name))
+            created = images[name] = vision.ReferenceImage(name=name, uri=reference_image.uri)
+        self.services.touch_index()
+        return created
+
+    def delete_reference_image(self, name):
+        self.inject('delete_reference_image')
+        product_name = name.split('/referenceImages/')[0]
+        with self.services.lock:
+            if self.services.reference_images.get(product_name, {}).pop(name, None) is None:
+                raise exceptions.NotFound('Reference image not found: {}'.format(name))
+        self.services.touch_index()
+
+    def delete_product(self, name):
+        self.inject('delete_product')
+        with self.services.lock:
+            self._product(name)
+            del self.services.products[name]
+            self.services.reference_images.pop(name, None)
+            for product_set in self.services.product_sets.values():
+                product_set['products'].discard(name)
+        self.services.touch_index()
+
+    def import_product_sets(self, parent, input_config):
+        """Import a bulk CSV stored in the fake storage, line by line like the API."""
+        from csv import reader
+
+        self.inject('import_product_sets')
+        content = self.services.read_blob(input_config.gcs_source.csv_file_uri)
+        if content is None:
+            raise exceptions.InvalidArgument('CSV not found: {}'.format(input_config.gcs_source.csv_file_uri))
+        statuses = []
+        reference_images = []
+        for line in reader(io.StringIO(content.decode('utf-8'))):
+            if len(line) != 8 or self.services.read_blob(line[0]) is None:
+                statuses.append(status_pb2.Status(code=3, message='Invalid line'))
+                continue
+            image_uri, image_id, product_set_id, product_id, category, display_name, labels, _ = line
+            product_name = '{}/products/{}'.format(parent, product_id)
+            product_set_name = '{}/productSets/{}'.format(parent, product_set_id)
+            with self.services.lock:
+                if product_name not in self.services.products:
+                    self.services.products[product_name] = vision.Product(
+                        name=product_name, display_name=display_name, product_category=category,
+                        product_labels=[vision.Product.KeyValue(key=key, value=value) for key, _, value in
+                                        (label.partition('=') for label in labels.split(',') if label)])
+                    self.services.reference_images[product_name] = {}
+                product_set = self.services.product_sets.setdefault(product_set_name, {
+                    'product_set': vision.ProductSet(name=product_set_name, display_name=product_set_id),
+                    'products': set()})
+                product_set['products'].add(product_name)
+                image_name = '{}/referenceImages/{}'.format(product_name, image_id)
+                reference_image = vision.ReferenceImage(name=image_name, uri=image_uri)
+                self.services.reference_images[product_name][image_name] = reference_image
+            statuses.append(status_pb2.Status(code=0))
+            reference_images.append(reference_image)
+        self.services.touch_index()
+        return _Operation(vision.ImportProductSetsResponse(statuses=statuses, reference_images=reference_images))
+
+
+class _FakeAsyncTransport(object):
+    """Stands for the gRPC transport of an async client, which holds the channel."""
+
+    def __init__(self):
+        self.closed = False
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeProductSearchAsyncClient(object):
+    """Asyncio flavour of FakeProductSearchClient.
+
+    Every method of the sync client is a coroutine here: the injected
+    latency is awaited, then the sync client applies the call.
+    """
+
+    product_set_path = staticmethod(FakeProductSearchClient.product_set_path)
+    product_path = staticmethod(FakeProductSearchClient.product_path)
+    reference_image_path = staticmethod(FakeProductSearchClient.reference_image_path)
+
+    def __init__(self, services):
+        self.services = services
+        self.transport = _FakeAsyncTransport()
+        self._client = FakeProductSearchClient(services, inject=lambda method: None)
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        async def call(*args, timeout=None, **kwargs):
+            await self.services.inject.wait(name)
+            return method(*args, **kwargs)
+
+        return call
+
+
+class FakeImageAnnotatorClient(object):
+    """ImageAnnotatorClient answering product searches from a FakeServices.
+
+    Products of the set that match the category and filter are ranked by
+    the cosine similarity of their reference images to the query, using
+    the embeddings of `local_search`, so results behave like real ones.
+
+    Object localization boxes the blobs standing out of a uniform
+    background, which is enough for catalog-like photos.
+    """
+
+    def __init__(self, services):
+        self.services = services
+
+    def _localize(self, content, max_results):
+        import numpy as np
+        from PIL import Image
+        from scipy import ndimage
+
+        from colors import SAMPLE_EDGE, _background_mask
+
+        image = Image.open(io.BytesIO(content))
+        image.draft('RGB', (SAMPLE_EDGE, SAMPLE_EDGE))
+        image = image.convert('RGB')
+        image.thumbnail((SAMPLE_EDGE, SAMPLE_EDGE), Image.BILINEAR)
+        pixels = np.asarray(image, dtype=np.uint8)
+        height, width = pixels.shape[:2]
+        components, count = ndimage.label(~_background_mask(pixels))
+        boxes = []
+        for index, (rows, columns) in enumerate(ndimage.find_objects(components)):
+            area = int((components[rows, columns] == index + 1).sum())
+            if area >= height * width * 0.03:
+                boxes.append((area, columns.start / width, rows.start / height,
+                              columns.stop / width, rows.stop / height))
+        if not boxes:
+            # No background to tell objects apart, the whole image is one.
+            boxes = [(height * width, 0.0, 0.0, 1.0, 1.0)]
+        boxes.sort(key=lambda box: -box[0])
+        annotations = []
+        for area, left, top, right, bottom in boxes[:max_results or None]:
+            vertices = [{'x': left, 'y': top}, {'x': right, 'y': top},
+                        {'x': right, 'y': bottom}, {'x': left, 'y': bottom}]
+            annotations.append(vision.LocalizedObjectAnnotation(
+                name='Clothing', score=min(0.99, 0.5 + area / float(height * width)),
+                bounding_poly={'normalized_vertices': vertices}))
+        return annotations
+
+    def _search(self, content, product_search_params, max_results):
+        from local_search import embed_image
+
+        services = self.services
+        node = parse_filter(product_search_params.filter)
+        categories = set(product_search_params.product_categories)
+        query = embed_image(content)
+        # Only the candidates are read under the lock, concurrent searches
+        # are scored in parallel like on the real service.
+        candidates = []
+        with services.lock:
+            product_set = services.product_sets.get(product_search_params.product_set)
+            names = list(product_set['products']) if product_set is not None else []
+            for name in names:
+                product = services.products.get(name)
+                if product is None or (categories and product.product_category not in categories):
+                    continue
+                labels = {}
+                for label in product.product_labels:
+                    labels.setdefault(label.key, set()).add(label.value)
+                if matches(node, labels):
+                    candidates.append((product, list(services.reference_images.get(name, {}).values())))
+            index_time = services.index_time
+        results = []
+        for product, reference_images in candidates:
+            best = None
+            for reference_image in reference_images:
+                embedding = services.reference_embedding(reference_image)
+                if embedding is None:
+                    continue
+                score = float(embedding @ query)
+                if best is None or score > best[0]:
+                    best = (score, reference_image.name)
+            if best is not None:
+                results.append(vision.ProductSearchResults.Result(product=product, score=best[0], image=best[1]))
+        results.sort(key=lambda result: -result.score)
+        if max_results:
+            results = results[:max_results]
+        return vision.ProductSearchResults(index_time=index_time, results=results)
+
+    def product_search(self, image, image_context=None, max_results=None):
+        self.services.inject('product_search')
+        params = image_context.product_search_params
+        return vision.AnnotateImageResponse(product_search_results=self._search(image.content, params, max_results))
+
+    def object_localization(self, image, max_results=None):
+        self.services.inject('object_localization')
+        return vision.AnnotateImageResponse(localized_object_annotations=self._localize(image.content, max_results))
+
+    def batch_annotate_images(self, requests):
+        self.services.inject('batch_annotate_images')
+        return self._annotate(requests)
+
+    def _annotate(self, requests):
+        responses = []
+        for request in requests:
+            response = vision.AnnotateImageResponse()
+            try:
+                for feature in request.features:
+                    if feature.type_ == vision.Feature.Type.OBJECT_LOCALIZATION:
+                        response.localized_object_annotations = self._localize(
+                            request.image.content, feature.max_results)
+                    elif feature.type_ == vision.Feature.Type.PRODUCT_SEARCH:
+                        response.product_search_results = self._search(
+                            request.image.content, request.image_context.product_search_params,
+                            feature.max_results)
+            except Exception as e:
+                response = vision.AnnotateImageResponse(error={'code': 3, 'message': str(e)})
+            responses.append(response)
+        return vision.BatchAnnotateImagesResponse(responses=responses)
+
+
+class FakeImageAnnotatorAsyncClient(FakeImageAnnotatorClient):
+    """Asyncio flavour of FakeImageAnnotatorClient.
+
+    Injected latency is awaited, the embeddings are computed in the
+    default executor so the event loop keeps serving other requests.
+    """
+
+    def __init__(self, services):
+        super(FakeImageAnnotatorAsyncClient, self).__init__(services)
+        self.transport = _FakeAsyncTransport()
+
+    async def batch_annotate_images(self, requests=None, timeout=None):
+        await self.services.inject.wait('batch_annotate_images')
+        return await asyncio.get_running_loop().run_in_executor(None, self._annotate, requests)
+
+
+class FakeBlob(object):
+
+    def __init__(self, bucket, name, chunk_size=None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+        self.content_type = None
+
+    def _stored(self):
+        return self.bucket.services.buckets.get(self.bucket.name, {}).get(self.name)
+
+    @property
+    def md5_hash(self):
+        stored = self._stored()
+        return stored['md5'] if stored is not None else None
+
+    @property
+    def size(self):
+        stored = self._stored()
+        return len(stored['content']) if stored is not None else None
+
+    def exists(self):
+        return self._stored() is not None
+
+    def _store(self, content, content_type):
+        services = self.bucket.services
+        with services.lock:
+            if self.bucket.name not in services.buckets:
+                raise exceptions.NotFound('Bucket not found: {}'.format(self.bucket.name))
+            services.buckets[self.bucket.name][self.name] = {
+                'content': content,
+                'content_type': content_type or self.content_type or 'application/octet-stream',
+                'md5': base64.b64encode(hashlib.md5(content).digest()).decode('ascii'),
+            }
+
+    def upload_from_string(self, data, content_type=None):
+        self.bucket.services.inject('upload')
+        self._store(data.encode('utf-8') if isinstance(data, str) else data, content_type)
+
+    def upload_from_file(self, file_obj, content_type=None, size=None):
+        # Resumable uploads send one request per chunk.
+        chunks = []
+        for chunk in iter(lambda: file_obj.read(self.chunk_size or -1), b''):
+            self.bucket.services.inject('upload')
+            chunks.append(chunk)
+            if not self.chunk_size:
+                break
+        self._store(b''.join(chunks), content_type)
+
+    def download_as_bytes(self):
+        self.bucket.services.inject('download')
+        stored = self._stored()
+        if stored is None:
+            raise exceptions.NotFound('Blob not found: {}'.format(self.name))
+        return stored['content']
+
+
+class FakeBucket(object):
+
+    def __init__(self, services, name):
+        self.services = services
+        self.name = name
+        self.storage_class = None
+        self.location = None
+
+    def blob(self, blob_name, chunk_size=None):
+        return FakeBlob(self, blob_name, chunk_size)
+
+    def list_blobs(self, prefix=None):
+        self.services.inject('list_blobs')
+        with self.services.lock:
+            names = sorted(self.services.buckets.get(self.name, {}))
+        return [self.blob(name) for name in names if prefix is None or name.startswith(prefix)]
+
+
+class FakeStorageAsyncClient(object):
+    """Asyncio counterpart of the media uploads of FakeBlob, see `async_api.GcsAsyncClient`."""
+
+    def __init__(self, services):
+        self.services = services
+
+    async def upload(self, bucket_name, blob_name, data, content_type, timeout=None):
+        await self.services.inject.wait('upload')
+        FakeBucket(self.services, bucket_name).blob(blob_name)._store(data, content_type)
+        return {'bucket': bucket_name, 'name': blob_name, 'size': str(len(data))}
+
+
+class FakeStorageClient(object):
+
+    def __init__(self, services):
+        self.services = services
+
+    def bucket(self, bucket_name):
+        return FakeBucket(self.services, bucket_name)
+
+    def create_bucket(self, bucket, location=None):
+        self.services.inject('create_bucket')
+        with self.services.lock:
+            if bucket.name in self.services.buckets:
+                raise exceptions.Conflict('Bucket already exists: {}'.format(bucket.name))
+            self.services.buckets[bucket.name] = {}
+        bucket.location = (location or 'US').upper()
+        return bucket
+
+
+_services = None
+_services_lock = threading.Lock()
+
+
+def get_services(config_path=None):
+    """Return the process-wide FakeServices, created from `config_path` on first use."""
+    global _services
+    if _services is None:
+        with _services_lock:
+            if _services is None:
+                _services = FakeServices.from_config_file(config_path)
+    return _services
@@ -1,6 +1,85 @@
+import abc
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
 from google.cloud import vision
 
+from preprocess import normalizer_id
+from session import get_session
+from tracing import span, traced
+
+
+# Images the API accepts in a single batch_annotate_images call.
+MAX_BATCH_IMAGES = 16
+
+
+def product_search_context(session, product_set_id, product_category, filter):
+    """Build the image context holding the product search parameters."""
+    product_set_path = session.product_set_path(product_set_id)
+    product_search_params = vision.ProductSearchParams(
+        product_set=product_set_path,
+        product_categories=[product_category],
+        filter=filter)
+    return vision.ImageContext(
+        product_search_params=product_search_params)
+
+
+class SearchBackend(abc.ABC):
+    """Engine answering the product searches of `get_similar_products_file`."""
+
+    @abc.abstractmethod
+    def product_search(self, content, product_set_id, product_category, filter, max_results):
+        """Search products similar to an image.
+        Args:
+            content: Image bytes.
+            product_set_id: Id of the product set.
+            product_category: Category of the product.
+            filter: Condition to be applied on the labels.
+            max_results: The maximum number of results, None for all of them.
+        Returns:
+            A `vision.ProductSearchResults`.
+        """
 
+    def product_set_index_time(self, product_set_id):
+        """Time the product set was last indexed, or None when the backend cannot tell."""
+        return None
+
+
+class VisionSearchBackend(SearchBackend):
+    """Searches with the Vision API ImageAnnotator."""
+
+    def __init__(self, session):
+        self.session = session
+
+    def product_search(self, content, product_set_id, product_category, filter, max_results):
+        with span('search.build_request'):
+            # Create annotate image request along with product search feature.
+            image = vision.Image(content=content)
+
+            # product search specific parameters
+            image_context = product_search_context(self.session, product_set_id, product_category, filter)
+
+        with span('search.client'):
+            image_annotator_client = self.session.image_annotator_client
+
+        # Search products similar to the image.
+        with span('search.rpc'):
+            response = image_annotator_client.product_search(
+                image,
+                image_context=image_context,
+                max_results=max_results
+            )
+        with span('search.parse'):
+            return response.product_search_results
+
+    def product_set_index_time(self, product_set_id):
+        product_set = self.session.product_search_client.get_product_set(
+            name=self.session.product_set_path(product_set_id))
+        return product_set.index_time
+
+
+@traced('get_similar_products_file')
 def get_similar_products_file(
         project_id,
         location,
@@ -8,7 +87,12 @@ def get_similar_products_file(
         product_category,
         file_path,
         filter,
-        max_results
+        max_results,
+        session=None,
+        normalize=None,
+        cache=None,
+        backend=None,
+        coalesce=None
 ):
     """Search similar products to image.
     Args:
@@ -23,43 +107,153 @@ def get_similar_products_file(
                 color:red AND style:kids
                 color:blue AND style:kids
         max_results: The maximum number of results (matches) to return. If omitted, all results are returned.
+        session: VisionSession to reuse, defaults to the process-wide one.
+        normalize: Optional callable mapping the image bytes to (content, content_type)
+                   before they are sent, such as `preprocess.ImageNormalizer`.
+        cache: Optional `search_cache.SearchResultCache` answering repeated
+               and near-identical queries without calling the API, with
+               entries kept apart per backend.
+        backend: SearchBackend answering the search, defaults to the Vision API.
+                 `local_search.LocalSearchEngine` answers it offline.
+        coalesce: Optional `singleflight.SingleFlight` making concurrent identical
+                  searches share a single call.
     """
-    # product_search_client is needed only for its helper methods.
-    product_search_client = vision.ProductSearchClient()
-    image_annotator_client = vision.ImageAnnotatorClient()
+    if backend is None:
+        backend = VisionSearchBackend(session or get_session(project_id, location))
 
     # Read the image as a stream of bytes.
-    with open(file_path, 'rb') as image_file:
+    with span('search.read_file'), open(file_path, 'rb') as image_file:
         content = image_file.read()
 
-    # Create annotate image request along with product search feature.
-    image = vision.Image(content=content)
+    cache_key = None
+    if cache is not None:
+        with span('search.cache_lookup'):
+            try:
+                cache_key = cache.make_key(content, product_set_id, product_category, filter, max_results, backend,
+                                           normalize)
+            except OSError as e:
+                # Not an image Pillow can hash, the backend reports what is wrong with it.
+                print('Cache skipped for {}: {}'.format(file_path, e))
+            cached = None if cache_key is None else cache.get(cache_key, product_set_id, backend)
+        if cached is not None:
+            return cached.results
 
-    # product search specific parameters
-    product_set_path = product_search_client.product_set_path(
-        project=project_id, location=location,
-        product_set=product_set_id)
-    product_search_params = vision.ProductSearchParams(
-        product_set=product_set_path,
-        product_categories=[product_category],
-        filter=filter)
-    image_context = vision.ImageContext(
-        product_search_params=product_search_params)
+    def search(content):
+        if normalize is not None:
+            with span('search.normalize'):
+                content, _ = normalize(content)
+        return backend.product_search(content, product_set_id, product_category, filter, max_results)
 
-    # Search products similar to the image.
-    response = image_annotator_client.product_search(
-        image,
-        image_context=image_context,
-        max_results=max_results
-    )
+    if coalesce is not None:
+        # Keyed on the bytes as read, identical uploads join before normalizing.
+        key = coalesce.make_key(content, product_set_id, product_category, filter, max_results,
+                                normalizer_id(normalize))
+        product_search_results = coalesce.do(key, search, content)
+    else:
+        product_search_results = search(content)
 
-    index_time = response.product_search_results.index_time
+    index_time = product_search_results.index_time
     print('Product set index time: {}'.format(index_time))
 
-    return response.product_search_results.results
+    if cache_key is not None:
+        with span('search.cache_store'):
+            cache.put(cache_key, product_set_id, product_search_results, backend)
+    return product_search_results.results
 
 
-def print_results(results, file_path):
+def search_many(
+        project_id,
+        location,
+        product_set_id,
+        product_category,
+        images,
+        filter,
+        max_results,
+        session=None,
+        normalize=None,
+        batch_size=MAX_BATCH_IMAGES,
+        max_workers=4
+):
+    """Search similar products for many images with batched requests.
+
+    Up to `batch_size` images are sent in each batch_annotate_images call
+    and `max_workers` calls run concurrently, so N images cost about
+    N / 16 round trips instead of N. Images are read when their batch is
+    sent, so only the batches in flight are held in memory.
+    Args:
+        project_id: Id of the project.
+        location: A compute region name.
+        product_set_id: Id of the product set.
+        product_category: Category of the product.
+        images: Iterable of local file paths, or of image contents as bytes.
+        filter: Condition to be applied on the labels, see `get_similar_products_file`.
+        max_results: The maximum number of results per image. If omitted, all results are returned.
+        session: VisionSession to reuse, defaults to the process-wide one.
+        normalize: Optional callable mapping the image bytes to (content, content_type).
+        batch_size: Images per request, at most 16.
+        max_workers: Requests in flight at the same time.
+    Returns:
+        A list with one (product_search_results, error) tuple per image, in
+        input order. error is None on success, or the error message of
+        that image (or of its whole batch) when it failed.
+    """
+    session = session or get_session(project_id, location)
+    image_annotator_client = session.image_annotator_client
+    image_context = product_search_context(session, product_set_id, product_category, filter)
+    feature = vision.Feature(type_=vision.Feature.Type.PRODUCT_SEARCH)
+    if max_results:
+        feature.max_results = max_results
+
+    def read_image(image):
+        if isinstance(image, bytes):
+            content = image
+        else:
+            with open(image, 'rb') as image_file:
+                content = image_file.read()
+        if normalize is not None:
+            content, _ = normalize(content)
+        return content
+
+    def search_batch(batch):
+        try:
+            requests = [vision.AnnotateImageRequest(
+                image=vision.Image(content=read_image(image)),
+                features=[feature],
+                image_context=image_context) for image in batch]
+            response = image_annotator_client.batch_annotate_images(requests=requests)
+        except Exception as e:
+            return [(None, str(e))] * len(batch)
+        return [(None, image_response.error.message) if image_response.error.code
+                else (image_response.product_search_results, None)
+                for image_response in response.responses]
+
+    # The input is consumed one batch at a time, as slots free up:
+    # executor.map would submit, and so read, every batch at once.
+    images = iter(images)
+    batches = iter(lambda: list(itertools.islice(images, batch_size)), [])
+    results = []
+    in_flight = collections.deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch in batches:
+            if len(in_flight) >= max_workers:
+                results.extend(in_flight.popleft().result())
+            in_flight.append(executor.submit(search_batch, batch))
+        # Futures are collected in submission order, so results keep the input order.
+        while in_flight:
+            results.extend(in_flight.popleft().result())
+    return results
+
+
+# Catalog fields printed with each result when a catalog store is given.
+RESULT_FIELDS = ('product_url', 'price', 'currency', 'in_stock')
+
+
+def print_results(results, file_path, catalog=None):
+    """Print search results, with their catalog page and price if `catalog` is given.
+
+    `catalog` is a `catalog.CatalogStore`, or a `label_index.LabelIndex`
+    already holding the RESULT_FIELDS in memory.
+    """
     print('Search results for: {}'.format(file_path))
     for result in results:
         product = result.product
@@ -72,6 +266,12 @@ def print_results(results, file_path):
             product.display_name))
         print('Product description: {}\n'.format(product.description))
         print('Product labels: {}\n'.format(product.product_labels))
+        if catalog is not None:
+            catalog_row = catalog.get(product.name.split('/')[-1], RESULT_FIELDS)
+            if catalog_row is not None:
+                print('Product page: {} ({} {}, in stock: {})\n'.format(
+                    catalog_row['product_url'], catalog_row['price'], catalog_row['currency'],
+                    catalog_row['in_stock']))
 
 
 if __name__ == '__main__':
@@ -79,13 +279,14 @@ if __name__ == '__main__':
     location = "us-east1"
     product_set_id = 'BENI_CLOTH'
     product_category = 'apparel'
+    session = get_session(project_id, location)
 
     filter1 = None
     results1 = get_similar_products_file(project_id, location, product_set_id, product_category, 'test.jpeg',
-                                         filter1, 4)
+                                         filter1, 4, session=session)
     print_results(results1, 'test.jpeg')
 
     filter2 = 'color = Black AND gender = Women'
     results2 = get_similar_products_file(project_id, location, product_set_id, product_category, 'test-2.jpeg',
-                                         filter2, 4)
+                                         filter2, 4, session=session)
     print_results(results2, 'test-2.jpeg')
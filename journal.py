@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+import time
+
+from google.api_core.exceptions import AlreadyExists
+
+
+class IngestJournal(object):
+    """Append-only JSONL record of the ingestion stages finished per product.
+
+    Every line is `{"id": beni_product_id, "stage": name, "data": {...}}`.
+    On open the file is replayed so a re-run can skip finished work without
+    calling the API. Writes go through a buffered file that is fsynced
+    every `fsync_every` records or `fsync_interval` seconds, whichever
+    comes first, so a crash loses at most one batch and the stages in it
+    are simply redone.
+    Args:
+        path: Path of the journal file, created if missing.
+        fsync_every: Number of records written between fsyncs.
+        fsync_interval: Maximum seconds between fsyncs.
+    """
+
+    def __init__(self, path, fsync_every=64, fsync_interval=1.0):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._stages = {}
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._load()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as journal_file:
+            for line in journal_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A crash can leave the last line half written.
+                    continue
+                self._stages.setdefault(record['id'], {})[record['stage']] = record.get('data') or {}
+
+    def __len__(self):
+        return len(self._stages)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_done(self, product_id, stage):
+        return stage in self._stages.get(product_id, ())
+
+    def get(self, product_id, stage):
+        """Return the data recorded with a finished stage, or None."""
+        return self._stages.get(product_id, {}).get(stage)
+
+    def mark(self, product_id, stage, **data):
+        """Record that a stage finished for a product."""
+        line = json.dumps({'id': product_id, 'stage': stage, 'data': data}, ensure_ascii=False) + '\n'
+        with self._lock:
+            self._stages.setdefault(product_id, {})[stage] = data
+            self._file.write(line)
+            self._pending += 1
+            if self._pending >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._sync()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+
+
+def run_step(journal, product_id, stage, fn, *args, **kwargs):
+    """Run one ingestion step unless the journal already has it.
+
+    "Already exists" answers mean an earlier run finished the step without
+    recording it, so they are journaled as done instead of raised.
+    Args:
+        journal: An `IngestJournal`, or None to always run the step.
+        product_id: beni_product_id of the product.
+        stage: Name of the step.
+        fn: Callable doing the step, called with the remaining arguments.
+    """
+    if journal is not None and journal.is_done(product_id, stage):
+        return
+    try:
+        fn(*args, **kwargs)
+    except AlreadyExists:
+        pass
+    if journal is not None:
+        journal.mark(product_id, stage)
@@ -0,0 +1,118 @@
+import re
+
+_TOKEN = re.compile(r'\s*(\(|\)|=|[^\s()=]+)')
+
+
+class FilterSyntaxError(ValueError):
+    pass
+
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if match is None:
+            raise FilterSyntaxError('Unexpected character at {}: {!r}'.format(position, text[position:]))
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+class _Parser(object):
+
+    def __init__(self, text):
+        self.tokens = _tokenize(text)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected is not None and token != expected):
+            raise FilterSyntaxError('Expected {!r}, got {!r}'.format(expected or 'a term', token))
+        self.position += 1
+        return token
+
+    def parse(self):
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise FilterSyntaxError('Unexpected {!r}'.format(self.peek()))
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == 'OR':
+            self.take()
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_atom()]
+        while self.peek() == 'AND':
+            self.take()
+            nodes.append(self.parse_atom())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_atom(self):
+        if self.peek() == '(':
+            self.take()
+            node = self.parse_or()
+            self.take(')')
+            return node
+        key = self.take()
+        self.take('=')
+        # Values may contain spaces, e.g. `category = Apparel & Accessories > Shoes`.
+        words = [self.take()]
+        while self.peek() not in (None, 'AND', 'OR', ')'):
+            words.append(self.take())
+        return ('eq', key, ' '.join(words))
+
+
+def parse_filter(text):
+    """Parse a Product Search label filter.
+
+    The syntax is the one the API accepts, e.g.
+    `(color = red OR color = blue) AND gender = Women`, with AND binding
+    tighter than OR. Returns None for an empty filter, otherwise a tree of
+    ('eq', key, value), ('and', [nodes]) and ('or', [nodes]) tuples.
+    """
+    if text is None or not text.strip():
+        return None
+    return _Parser(text).parse()
+
+
+def matches(node, labels):
+    """Evaluate a parsed filter against labels.
+    Args:
+        node: Tree returned by `parse_filter`, None matches everything.
+        labels: Mapping of label key to the set of values of a product.
+    """
+    if node is None:
+        return True
+    if node[0] == 'eq':
+        return node[2] in labels.get(node[1], ())
+    if node[0] == 'and':
+        return all(matches(child, labels) for child in node[1])
+    return any(matches(child, labels) for child in node[1])
+
+
+def evaluate(node, lookup, universe, intersect, union):
+    """Evaluate a parsed filter with set algebra instead of per-product checks.
+
+    Lets indexes answer a filter from their posting lists or masks.
+    Args:
+        node: Tree returned by `parse_filter`.
+        lookup: Callable (key, value) returning the products with that label.
+        universe: Value returned for an empty filter.
+        intersect: Callable combining a list of values for AND.
+        union: Callable combining a list of values for OR.
+    """
+    if node is None:
+        return universe
+    if node[0] == 'eq':
+        return lookup(node[1], node[2])
+    children = [evaluate(child, lookup, universe, intersect, union) for child in node[1]]
+    return intersect(children) if node[0] == 'and' else union(children)
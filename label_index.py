@@ -0,0 +1,156 @@
+"""In-memory catalog index to enrich and re-filter search results locally.
+
+Products are keyed by `beni_product_id`, with their catalog fields kept
+for joins and an inverted index per label key (the labels of
+`main.catalog_row_labels`: brand, gender, color and category). Label
+filters are answered with set algebra on the posting lists, so a search
+can over-fetch once and then be filtered again or paginated without
+calling the API:
+
+    index = LabelIndex.from_catalog('product_catalog_productbase.csv')
+    results = get_similar_products_file(..., filter=None, max_results=100)
+    women = index.filter_results(results, 'color = Black AND gender = Women')
+    for result, catalog_row in index.join(women[:10]):
+        ...
+
+`index.get(beni_product_id, fields)` mirrors `CatalogStore.get`, so an
+index can be passed to `find_products.print_results` as the catalog.
+"""
+import argparse
+import functools
+import operator
+
+from catalog import open_catalog
+from label_filter import evaluate, matches, parse_filter
+
+# Label keys, as set on the products, mapped to their catalog field.
+LABEL_FIELDS = {
+    'brand': 'brand',
+    'gender': 'gender',
+    'color': 'color',
+    'category': 'product_category',
+}
+# Catalog fields kept for joins.
+ENRICH_FIELDS = ('product_title', 'product_url', 'affiliated_url', 'img_url', 'price', 'currency', 'in_stock')
+
+
+def result_product_id(result):
+    """beni_product_id of a search result, the last part of its product name."""
+    return result.product.name.split('/')[-1]
+
+
+class LabelIndex(object):
+    """Catalog rows by product id and posting lists by label.
+    Args:
+        rows: Iterable of catalog rows with `beni_product_id`, the
+            LABEL_FIELDS and the fields to keep.
+        fields: Fields of each row kept for joins.
+    """
+
+    def __init__(self, rows, fields=ENRICH_FIELDS):
+        self.fields = tuple(fields)
+        self._rows = {}
+        self._labels = {}
+        self._postings = {}
+        self._filters = {}
+        for catalog_row in rows:
+            beni_product_id = catalog_row['beni_product_id']
+            self._rows[beni_product_id] = {field: catalog_row[field] for field in self.fields}
+            self._labels[beni_product_id] = {key: {catalog_row[field]} for key, field in LABEL_FIELDS.items()}
+            for key, field in LABEL_FIELDS.items():
+                self._postings.setdefault((key, catalog_row[field]), set()).add(beni_product_id)
+        self._all = frozenset(self._rows)
+
+    @classmethod
+    def from_catalog(cls, csv_path, fields=ENRICH_FIELDS):
+        """Build the index from a catalog CSV, through its columnar store."""
+        columns = ['beni_product_id'] + list(LABEL_FIELDS.values())
+        columns += [field for field in fields if field not in columns]
+        return cls(open_catalog(csv_path).rows(columns), fields)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, beni_product_id):
+        return beni_product_id in self._rows
+
+    def get(self, beni_product_id, fields=None):
+        """Return the kept fields of a product, or those of `fields`, or None if unknown."""
+        catalog_row = self._rows.get(beni_product_id)
+        if catalog_row is None or fields is None:
+            return catalog_row
+        return {field: catalog_row[field] for field in fields}
+
+    def values(self, key):
+        """Label values of a key with their product count, most common first."""
+        counts = [(value, len(ids)) for (label_key, value), ids in self._postings.items() if label_key == key]
+        return sorted(counts, key=lambda count: -count[1])
+
+    def lookup(self, filter):
+        """Return the set of product ids matching a label filter.
+
+        Results are cached per filter text, the index does not change
+        once built.
+        """
+        ids = self._filters.get(filter)
+        if ids is None:
+            ids = evaluate(parse_filter(filter), lambda key, value: self._postings.get((key, value), frozenset()),
+                           self._all, lambda sets: functools.reduce(operator.and_, sets),
+                           lambda sets: functools.reduce(operator.or_, sets))
+            self._filters[filter] = ids = frozenset(ids)
+        return ids
+
+    def filter_results(self, results, filter):
+        """Keep the search results matching a label filter, in their order.
+
+        Results outside the catalog postings are checked against their
+        catalog labels together with the labels returned with the result,
+        which also hold the labels the catalog does not have, such as the
+        `detected_colors` of `main.catalog_row_labels`.
+        """
+        node = parse_filter(filter)
+        if node is None:
+            return list(results)
+        ids = self.lookup(filter)
+        kept = []
+        for result in results:
+            beni_product_id = result_product_id(result)
+            if beni_product_id in ids:
+                kept.append(result)
+            elif matches(node, _result_labels(result, self._labels.get(beni_product_id))):
+                kept.append(result)
+        return kept
+
+    def join(self, results):
+        """Pair each search result with its catalog row, None for unknown products."""
+        return [(result, self._rows.get(result_product_id(result))) for result in results]
+
+    def page(self, results, filter=None, page=0, page_size=10):
+        """One page of the results matching `filter`, with the catalog rows joined."""
+        start = page * page_size
+        return self.join(self.filter_results(results, filter)[start:start + page_size])
+
+
+def _result_labels(result, catalog_labels=None):
+    labels = {key: set(values) for key, values in (catalog_labels or {}).items()}
+    for label in result.product.product_labels:
+        labels.setdefault(label.key, set()).add(label.value)
+    return labels
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Count the catalog products matching label filters.')
+    parser.add_argument('filters', nargs='*', help='e.g. "color = Black AND gender = Women"')
+    parser.add_argument('--catalog', default='product_catalog_productbase.csv')
+    parser.add_argument('--show', type=int, default=5, help='product ids printed per filter')
+    args = parser.parse_args()
+
+    index = LabelIndex.from_catalog(args.catalog)
+    print('{} products'.format(len(index)))
+    if not args.filters:
+        for key in LABEL_FIELDS:
+            print('{}: {}'.format(key, ', '.join('{} ({})'.format(value, count)
+                                                for value, count in index.values(key)[:10])))
+    for filter in args.filters:
+        ids = sorted(index.lookup(filter))
+        print('{}: {} products {}'.format(filter, len(ids), ids[:args.show]))
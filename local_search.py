@@ -0,0 +1,284 @@
+"""Local visual search engine usable as a `get_similar_products_file` backend.
+
+Build an index from the catalog (downloads the images) or from the test
+cases (local files), then search it offline:
+
+    python local_search.py build local_index/BENI_CLOTH --catalog product_catalog_productbase.csv
+    python local_search.py build local_index/BENI_TEST_CASES --test-cases beni-test-cases/test_cases_images.csv
+    python local_search.py search local_index/BENI_TEST_CASES beni-test-cases/zara_black_shirt_2.jpg \\
+        --filter "color = black"
+"""
+import argparse
+import datetime
+import io
+import json
+import os
+import time
+from csv import reader
+
+import numpy as np
+from google.cloud import vision
+from PIL import Image
+
+from find_products import SearchBackend, get_similar_products_file, print_results
+from label_filter import evaluate, parse_filter
+
+# Side of the square the images are reduced to before extracting features.
+EMBEDDING_SIZE = 64
+HUE_BINS, SATURATION_BINS, VALUE_BINS = 8, 4, 4
+GRID_CELLS, ORIENTATION_BINS = 4, 8
+EMBEDDING_DIM = HUE_BINS * SATURATION_BINS * VALUE_BINS + GRID_CELLS * GRID_CELLS * ORIENTATION_BINS
+
+
+def embed_image(content):
+    """Compact descriptor of an image: HSV color histogram + gradient histograms.
+
+    The color part is a joint 8x4x4 HSV histogram, the texture part the
+    magnitude-weighted gradient orientations of a 4x4 grid (a small HOG).
+    Both are square-rooted (Hellinger) and the result is L2-normalized, so
+    a dot product between two embeddings is their cosine similarity.
+    Args:
+        content: Image bytes.
+    Returns:
+        A float32 vector of EMBEDDING_DIM values.
+    """
+    image = Image.open(io.BytesIO(content))
+    # Only a small thumbnail is needed, let the JPEG decoder skip the rest.
+    image.draft('RGB', (EMBEDDING_SIZE * 2, EMBEDDING_SIZE * 2))
+    image = image.convert('RGB').resize((EMBEDDING_SIZE, EMBEDDING_SIZE), Image.BILINEAR)
+
+    hsv = np.asarray(image.convert('HSV'), dtype=np.uint16)
+    hue = hsv[..., 0] * HUE_BINS >> 8
+    saturation = hsv[..., 1] * SATURATION_BINS >> 8
+    value = hsv[..., 2] * VALUE_BINS >> 8
+    bins = (hue * SATURATION_BINS + saturation) * VALUE_BINS + value
+    color = np.bincount(bins.ravel(), minlength=HUE_BINS * SATURATION_BINS * VALUE_BINS).astype(np.float32)
+    color /= color.sum()
+
+    gray = np.asarray(image.convert('L'), dtype=np.float32)
+    gradient_y, gradient_x = np.gradient(gray)
+    magnitude = np.hypot(gradient_x, gradient_y)
+    # Unsigned orientation in [0, pi).
+    orientation = ((np.arctan2(gradient_y, gradient_x) % np.pi) * ORIENTATION_BINS / np.pi).astype(np.intp)
+    orientation = np.minimum(orientation, ORIENTATION_BINS - 1)
+    cell = EMBEDDING_SIZE // GRID_CELLS
+    rows, columns = np.indices(gray.shape) // cell
+    texture_bins = (rows * GRID_CELLS + columns) * ORIENTATION_BINS + orientation
+    texture = np.bincount(texture_bins.ravel(), weights=magnitude.ravel(),
+                          minlength=GRID_CELLS * GRID_CELLS * ORIENTATION_BINS).astype(np.float32)
+    total = texture.sum()
+    if total:
+        texture /= total
+
+    embedding = np.sqrt(np.concatenate([color, texture]))
+    norm = np.linalg.norm(embedding)
+    return embedding / norm if norm else embedding
+
+
+def build_index(index_dir, product_set_id, products):
+    """Write a local index.
+
+    Embeddings are appended to a raw float32 file as they are computed, so
+    building never holds more than one image in memory.
+    Args:
+        index_dir: Directory of the index, created if missing.
+        product_set_id: Id of the product set the index stands for.
+        products: Iterable of dicts with beni_product_id, display_name,
+            description, product_category, labels (list of (key, value)),
+            image (a gs:// or local reference reported back as the result
+            image) and content (the image bytes).
+    Returns:
+        The number of products indexed.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    count = 0
+    with open(os.path.join(index_dir, 'embeddings.f32'), 'wb') as embeddings_file, \
+            open(os.path.join(index_dir, 'products.jsonl'), 'w', encoding='utf-8') as products_file:
+        for product in products:
+            try:
+                embedding = embed_image(product['content'])
+            except Exception as e:
+                print('Skipping {}: {}'.format(product['beni_product_id'], e))
+                continue
+            embeddings_file.write(embedding.astype(np.float32).tobytes())
+            products_file.write(json.dumps({key: product[key] for key in (
+                'beni_product_id', 'display_name', 'description', 'product_category', 'labels', 'image')}) + '\n')
+            count += 1
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as meta_file:
+        json.dump({'product_set_id': product_set_id, 'count': count, 'dim': EMBEDDING_DIM,
+                   'index_time': time.time()}, meta_file)
+    return count
+
+
+class LocalSearchEngine(SearchBackend):
+    """Answers product searches from a local index, without network.
+
+    The embeddings are memory-mapped, a query is one matrix-vector product
+    over them. Label filters use the same syntax as the API and are
+    answered from per-label boolean masks built once when the index is
+    opened. Results are `vision.ProductSearchResults`, so they print and
+    cache like API results; product names follow the API resource format.
+    Args:
+        index_dir: Directory written by `build_index`.
+        project_id: Project used in the product resource names.
+        location: Location used in the product resource names.
+    """
+
+    def __init__(self, index_dir, project_id='local', location='local'):
+        with open(os.path.join(index_dir, 'meta.json')) as meta_file:
+            self.meta = json.load(meta_file)
+        self.product_set_id = self.meta['product_set_id']
+        self.index_time = datetime.datetime.fromtimestamp(self.meta['index_time'], datetime.timezone.utc)
+        shape = (self.meta['count'], self.meta['dim'])
+        # Memory-mapping an empty file fails, an empty index needs no mapping.
+        if self.meta['count']:
+            self.embeddings = np.memmap(os.path.join(index_dir, 'embeddings.f32'), dtype=np.float32, mode='r',
+                                        shape=shape)
+        else:
+            self.embeddings = np.zeros(shape, dtype=np.float32)
+        with open(os.path.join(index_dir, 'products.jsonl'), encoding='utf-8') as products_file:
+            self.products = [json.loads(line) for line in products_file]
+        self._product_prefix = 'projects/{}/locations/{}/products/'.format(project_id, location)
+
+        count = len(self.products)
+        postings = {}
+        categories = {}
+        for row, product in enumerate(self.products):
+            for key, value in product['labels']:
+                postings.setdefault((key, value), []).append(row)
+            categories.setdefault(product['product_category'], []).append(row)
+        # Row lists per label, turned into masks only for the filters used.
+        self._postings = {label: np.array(rows, dtype=np.intp) for label, rows in postings.items()}
+        self._category_masks = {category: self._mask(rows) for category, rows in categories.items()}
+        self._all = np.ones(count, dtype=bool)
+        self._none = np.zeros(count, dtype=bool)
+        self._filters = {}
+
+    def product_set_index_time(self, product_set_id):
+        return self.index_time
+
+    def _mask(self, rows):
+        mask = np.zeros(len(self.products), dtype=bool)
+        mask[rows] = True
+        return mask
+
+    def filter_mask(self, filter):
+        """Boolean mask of the products matching a label filter."""
+        mask = self._filters.get(filter)
+        if mask is None:
+            mask = evaluate(parse_filter(filter), lambda key, value: self._mask(self._postings.get((key, value), [])),
+                            self._all, np.logical_and.reduce, np.logical_or.reduce)
+            self._filters[filter] = mask
+        return mask
+
+    def top_k(self, embedding, mask, k):
+        """Rows and scores of the k best matches among the masked products."""
+        scores = self.embeddings @ embedding
+        scores = np.where(mask, scores, -np.inf)
+        candidates = int(mask.sum())
+        k = candidates if k is None else min(k, candidates)
+        if k == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        rows = np.argpartition(-scores, k - 1)[:k]
+        rows = rows[np.argsort(-scores[rows])]
+        return rows, scores[rows]
+
+    def product_search(self, content, product_set_id, product_category, filter, max_results):
+        if product_set_id != self.product_set_id:
+            return vision.ProductSearchResults(index_time=self.index_time)
+        mask = self.filter_mask(filter) & self._category_masks.get(product_category, self._none)
+        rows, scores = self.top_k(embed_image(content), mask, max_results)
+        results = []
+        for row, score in zip(rows, scores):
+            product = self.products[row]
+            results.append(vision.ProductSearchResults.Result(
+                product=vision.Product(
+                    name=self._product_prefix + product['beni_product_id'],
+                    display_name=product['display_name'],
+                    description=product['description'],
+                    product_category=product['product_category'],
+                    product_labels=[vision.Product.KeyValue(key=key, value=value)
+                                    for key, value in product['labels']]),
+                score=float(score),
+                image=product['image']))
+        return vision.ProductSearchResults(index_time=self.index_time, results=results)
+
+
+def _catalog_products(csv_path, product_category):
+    from main import download_image, read_catalog_rows
+
+    for catalog_row in read_catalog_rows(csv_path):
+        try:
+            image = download_image(catalog_row['img_url'])
+        except Exception as e:
+            print(e)
+            continue
+        if image is None:
+            continue
+        yield {
+            'beni_product_id': catalog_row['beni_product_id'],
+            'display_name': catalog_row['product_title'],
+            'description': catalog_row['product_description'],
+            'product_category': product_category,
+            'labels': [['brand', catalog_row['brand']], ['gender', catalog_row['gender']],
+                       ['color', catalog_row['color']], ['category', catalog_row['product_category']]],
+            'image': catalog_row['img_url'],
+            'content': image[0],
+        }
+
+
+def _test_case_products(csv_path, product_category):
+    base_dir = os.path.dirname(csv_path)
+    with open(csv_path, 'r') as read_obj:
+        csv_reader = reader(read_obj)
+        header = next(csv_reader)
+        if header is not None:
+            for row in csv_reader:
+                with open(os.path.join(base_dir, row[2]), 'rb') as image_file:
+                    content = image_file.read()
+                yield {
+                    'beni_product_id': row[1],
+                    'display_name': row[3],
+                    'description': row[4],
+                    'product_category': product_category,
+                    'labels': [['brand', row[6]], ['gender', row[5]], ['color', row[7]]],
+                    'image': row[2],
+                    'content': content,
+                }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    build_parser = subparsers.add_parser('build')
+    build_parser.add_argument('index_dir')
+    build_parser.add_argument('--product-set-id')
+    build_parser.add_argument('--product-category', default='apparel')
+    source = build_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--catalog')
+    source.add_argument('--test-cases')
+    search_parser = subparsers.add_parser('search')
+    search_parser.add_argument('index_dir')
+    search_parser.add_argument('images', nargs='+')
+    search_parser.add_argument('--product-category', default='apparel')
+    search_parser.add_argument('--filter')
+    search_parser.add_argument('--max-results', type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        product_set_id = args.product_set_id or os.path.basename(os.path.normpath(args.index_dir))
+        if args.catalog:
+            products = _catalog_products(args.catalog, args.product_category)
+        else:
+            products = _test_case_products(args.test_cases, args.product_category)
+        print('Indexed {} products'.format(build_index(args.index_dir, product_set_id, products)))
+    elif args.command == 'search':
+        engine = LocalSearchEngine(args.index_dir)
+        for file_path in args.images:
+            started = time.perf_counter()
+            results = get_similar_products_file(None, None, engine.product_set_id, args.product_category, file_path,
+                                                args.filter, args.max_results, backend=engine)
+            print('Search time: {:.1f} ms'.format((time.perf_counter() - started) * 1000))
+            print_results(results, file_path)
+    else:
+        parser.print_help()
@@ -1,16 +1,30 @@
 from google.cloud import vision
 from google.protobuf import field_mask_pb2 as field_mask
-from google.cloud import storage
 import urllib.request
-from csv import reader
+import argparse
+import base64
+import hashlib
+import io
+import tempfile
 
+from catalog import open_catalog
+from journal import IngestJournal, run_step
+from manifest import BlobManifest
+from preprocess import ImageNormalizer
+from scheduler import CallScheduler, scheduled
+from session import get_session
+from tracing import span, traced
 
-def create_bucket(bucket_name):
+# Resumable upload chunks must be a multiple of 256 KB.
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+
+def create_bucket(bucket_name, session=None):
     """
     Create a new bucket in the US region with the coldline storage
     class
     """
-    storage_client = storage.Client()
+    storage_client = (session or get_session()).storage_client
 
     bucket = storage_client.bucket(bucket_name)
     bucket.storage_class = "COLDLINE"
@@ -24,58 +38,247 @@ def create_bucket(bucket_name):
     return new_bucket
 
 
-def upload_image(bucket_name, img_url):
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(bucket_name)
-    blob_name = img_url.split('//')[1]
-    blob = bucket.blob(blob_name)
+def image_blob_name(img_url):
+    return img_url.split('//')[1]
+
+
+def download_image(img_url):
+    """Download an image URL.
+    Returns:
+        A tuple (content, content_type), or None when the URL is not an image.
+    """
+    with span('upload_image.download'), urllib.request.urlopen(img_url) as response:
+        # check if URL contains an image
+        info = response.info()
+        if (info.get_content_type().startswith("image")):
+            return response.read(), info.get_content_type()
+        else:
+            return None
+
+
+def upload_image_content(bucket_name, blob_name, content, content_type, session=None):
+    bucket = (session or get_session()).bucket(bucket_name)
+    with span('upload_image.gcs_upload'):
+        bucket.blob(blob_name).upload_from_string(content, content_type=content_type)
+    return 'gs://' + bucket_name + '/' + blob_name
+
+
+class _ResponseStream(object):
+    """File-like view of an HTTP response for resumable uploads.
+
+    Resumable uploads check `tell()` and seek back to the last committed
+    byte when they recover. A response cannot rewind, but the upload only
+    ever seeks to the position already reached, which is supported.
+    """
+
+    def __init__(self, response):
+        self._response = response
+        self._position = 0
+
+    def read(self, size=-1):
+        data = self._response.read(size)
+        self._position += len(data)
+        return data
 
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=0):
+        if whence != 0 or position != self._position:
+            raise OSError('HTTP response streams cannot seek')
+        return self._position
+
+
+def upload_image_stream(bucket_name, img_url, session=None, chunk_size=UPLOAD_CHUNK_SIZE):
+    """Stream an image URL into GCS without holding the whole image in memory.
+
+    The response body is sent with a resumable upload, `chunk_size` bytes
+    at a time, so each upload buffers at most one chunk.
+    Args:
+        bucket_name: Bucket where the image is stored.
+        img_url: URL of the image.
+        session: VisionSession to reuse, defaults to the process-wide one.
+        chunk_size: Bytes per upload request, a multiple of 256 KB.
+    Returns:
+        The gs:// URI of the image, or None when the URL is not an image.
+    """
+    bucket = (session or get_session()).bucket(bucket_name)
+    blob_name = image_blob_name(img_url)
+    blob = bucket.blob(blob_name, chunk_size=chunk_size)
+
+    with span('upload_image.fetch'):
+        response = urllib.request.urlopen(img_url)
+    with response:
+        # check if URL contains an image
+        info = response.info()
+        if (info.get_content_type().startswith("image")):
+            # Download and upload overlap, they are timed together.
+            with span('upload_image.stream_upload'):
+                blob.upload_from_file(_ResponseStream(response), content_type=info.get_content_type())
+            return 'gs://' + bucket_name + '/' + blob_name
+        else:
+            return None
+
+
+def upload_image_dedup(bucket_name, img_url, manifest, session=None, chunk_size=UPLOAD_CHUNK_SIZE, normalize=None):
+    """Upload an image unless the same URL or the same bytes are already stored.
+
+    A URL whose blob is in the manifest is not downloaded at all. Otherwise
+    the image is spooled to a temporary file (in memory up to a few chunks)
+    while its MD5 is computed, and bytes already stored under another blob
+    reuse that blob's URI instead of being written again.
+    Args:
+        bucket_name: Bucket where the image is stored.
+        img_url: URL of the image.
+        manifest: BlobManifest of the images already stored.
+        session: VisionSession to reuse, defaults to the process-wide one.
+        chunk_size: Bytes read and uploaded at a time.
+        normalize: Optional callable mapping image bytes to (content, content_type)
+            applied before hashing and uploading, such as `ImageNormalizer`.
+    Returns:
+        The gs:// URI holding the image, or None when the URL is not an image.
+    """
+    blob_name = image_blob_name(img_url)
+    entry = manifest.by_blob_name(blob_name)
+    if entry is not None:
+        return entry['uri']
+
+    with span('upload_image.fetch'):
+        response = urllib.request.urlopen(img_url)
+    with response, tempfile.SpooledTemporaryFile(max_size=4 * chunk_size) as spool:
+        # check if URL contains an image
+        info = response.info()
+        if not info.get_content_type().startswith("image"):
+            return None
+        source, content_type = response, info.get_content_type()
+        if normalize is not None:
+            with span('upload_image.download'):
+                content = response.read()
+            with span('upload_image.normalize'):
+                content, content_type = normalize(content)
+            source = io.BytesIO(content)
+        # Without normalize this also downloads the body, chunk by chunk.
+        with span('upload_image.hash'):
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: source.read(chunk_size), b''):
+                md5.update(chunk)
+                spool.write(chunk)
+        digest = base64.b64encode(md5.digest()).decode('ascii')
+        size = spool.tell()
+
+        entry = manifest.by_md5(digest)
+        if entry is None:
+            spool.seek(0)
+            blob = (session or get_session()).bucket(bucket_name).blob(blob_name, chunk_size=chunk_size)
+            with span('upload_image.gcs_upload'):
+                blob.upload_from_file(spool, content_type=content_type, size=size)
+            return manifest.add(digest, bucket_name, blob_name, size, content_type)['uri']
+
+    # Same bytes under another name: remember the alias, reuse the stored blob.
+    manifest.add(digest, bucket_name, blob_name, size, entry['content_type'], uri=entry['uri'])
+    return entry['uri']
+
+
+def store_image_content(bucket_name, blob_name, content, content_type, session=None, manifest=None,
+                        normalize=None):
+    """Store image bytes already downloaded, like `store_image` does for a URL.
+    Args:
+        bucket_name: Bucket where the image is stored.
+        blob_name: Name of the blob, see `image_blob_name`.
+        content: Image bytes.
+        content_type: MIME type of the image.
+        session: VisionSession to reuse, defaults to the process-wide one.
+        manifest: BlobManifest used to skip bytes already stored.
+        normalize: Optional callable mapping image bytes to (content, content_type).
+    Returns:
+        The gs:// URI holding the image.
+    """
+    if normalize is not None:
+        with span('upload_image.normalize'):
+            content, content_type = normalize(content)
+    if manifest is None:
+        return upload_image_content(bucket_name, blob_name, content, content_type, session)
+    with span('upload_image.hash'):
+        digest = base64.b64encode(hashlib.md5(content).digest()).decode('ascii')
+    entry = manifest.by_md5(digest)
+    if entry is not None:
+        # Same bytes under another name: remember the alias, reuse the stored blob.
+        manifest.add(digest, bucket_name, blob_name, len(content), entry['content_type'], uri=entry['uri'])
+        return entry['uri']
+    upload_image_content(bucket_name, blob_name, content, content_type, session)
+    return manifest.add(digest, bucket_name, blob_name, len(content), content_type)['uri']
+
+
+def store_image(bucket_name, img_url, session=None, manifest=None, normalize=None):
+    """Copy an image URL into GCS with the cheapest path the options allow.
+    Args:
+        bucket_name: Bucket where the image is stored.
+        img_url: URL of the image.
+        session: VisionSession to reuse, defaults to the process-wide one.
+        manifest: BlobManifest used to skip images already stored.
+        normalize: Optional callable mapping image bytes to (content, content_type).
+    Returns:
+        The gs:// URI holding the image, or None when the URL is not an image.
+    """
+    if manifest is not None:
+        return upload_image_dedup(bucket_name, img_url, manifest, session, normalize=normalize)
+    if normalize is not None:
+        image = download_image(img_url)
+        if image is None:
+            return None
+        return store_image_content(bucket_name, image_blob_name(img_url), image[0], image[1], session,
+                                   normalize=normalize)
+    return upload_image_stream(bucket_name, img_url, session)
+
+
+@traced('upload_image')
+def upload_image(bucket_name, img_url, session=None, manifest=None, normalize=None):
     # try to read the image URL
     try:
-        with urllib.request.urlopen(img_url) as response:
-            # check if URL contains an image
-            info = response.info()
-            if (info.get_content_type().startswith("image")):
-                blob.upload_from_string(response.read(), content_type=info.get_content_type())
-                return 'gs://' + bucket_name + '/' + blob_name
-            else:
-                return None
+        return store_image(bucket_name, img_url, session, manifest, normalize)
     except Exception as e:
         print(e)
         return None
 
 
+@traced('create_product_set')
 def create_product_set(
-        project_id, location, product_set_id, product_set_display_name):
+        project_id, location, product_set_id, product_set_display_name, session=None):
     """Create a product set.
     Args:
         project_id: Id of the project.
         location: A compute region name.
         product_set_id: Id of the product set.
         product_set_display_name: Display name of the product set.
+        session: VisionSession to reuse, defaults to the process-wide one.
     """
-    client = vision.ProductSearchClient()
+    with span('create_product_set.client'):
+        session = session or get_session(project_id, location)
+        client = session.product_search_client
 
     # A resource that represents Google Cloud Platform location.
-    location_path = f"projects/{project_id}/locations/{location}"
+    location_path = session.location_path
 
     # Create a product set with the product set specification in the region.
-    product_set = vision.ProductSet(
-        display_name=product_set_display_name)
+    with span('create_product_set.build'):
+        product_set = vision.ProductSet(
+            display_name=product_set_display_name)
 
     # The response is the product set with `name` populated.
-    response = client.create_product_set(
-        parent=location_path,
-        product_set=product_set,
-        product_set_id=product_set_id)
+    with span('create_product_set.rpc'):
+        response = client.create_product_set(
+            parent=location_path,
+            product_set=product_set,
+            product_set_id=product_set_id)
 
     # Display the product set information.
     print('Product set name: {}'.format(response.name))
 
 
+@traced('create_product')
 def create_product(
         project_id, location, product_id, product_display_name, product_description,
-        product_category, product_labels):
+        product_category, product_labels, session=None):
     """Create one product.
     Args:
         project_id: Id of the project.
@@ -83,49 +286,53 @@ def create_product(
         product_id: Id of the product.
         product_display_name: Display name of the product.
         product_category: Category of the product.
+        session: VisionSession to reuse, defaults to the process-wide one.
     """
-    client = vision.ProductSearchClient()
+    with span('create_product.client'):
+        session = session or get_session(project_id, location)
+        client = session.product_search_client
 
     # A resource that represents Google Cloud Platform location.
-    location_path = f"projects/{project_id}/locations/{location}"
+    location_path = session.location_path
 
     # Create a product with the product specification in the region.
     # Set product display name and product category.
-    product = vision.Product(
-        display_name=product_display_name,
-        description=product_description,
-        product_category=product_category,
-        product_labels=product_labels)
+    with span('create_product.build'):
+        product = vision.Product(
+            display_name=product_display_name,
+            description=product_description,
+            product_category=product_category,
+            product_labels=product_labels)
 
     # The response is the product with the `name` field populated.
-    response = client.create_product(
-        parent=location_path,
-        product=product,
-        product_id=product_id)
+    with span('create_product.rpc'):
+        response = client.create_product(
+            parent=location_path,
+            product=product,
+            product_id=product_id)
 
     # Display the product information.
     print('Product name: {}'.format(response.name))
 
 
 def add_product_to_product_set(
-        project_id, location, product_id, product_set_id):
+        project_id, location, product_id, product_set_id, session=None):
     """Add a product to a product set.
     Args:
         project_id: Id of the project.
         location: A compute region name.
         product_id: Id of the product.
         product_set_id: Id of the product set.
+        session: VisionSession to reuse, defaults to the process-wide one.
     """
-    client = vision.ProductSearchClient()
+    session = session or get_session(project_id, location)
+    client = session.product_search_client
 
     # Get the full path of the product set.
-    product_set_path = client.product_set_path(
-        project=project_id, location=location,
-        product_set=product_set_id)
+    product_set_path = session.product_set_path(product_set_id)
 
     # Get the full path of the product.
-    product_path = client.product_path(
-        project=project_id, location=location, product=product_id)
+    product_path = session.product_path(product_id)
 
     # Add the product to the product set.
     client.add_product_to_product_set(
@@ -133,8 +340,9 @@ def add_product_to_product_set(
     print('Product added to product set.')
 
 
+@traced('create_reference_image')
 def create_reference_image(
-        project_id, location, product_id, reference_image_id, gcs_uri):
+        project_id, location, product_id, reference_image_id, gcs_uri, session=None):
     """Create a reference image.
     Args:
         project_id: Id of the project.
@@ -142,72 +350,305 @@ def create_reference_image(
         product_id: Id of the product.
         reference_image_id: Id of the reference image.
         gcs_uri: Google Cloud Storage path of the input image.
+        session: VisionSession to reuse, defaults to the process-wide one.
     """
-    client = vision.ProductSearchClient()
+    with span('create_reference_image.client'):
+        session = session or get_session(project_id, location)
+        client = session.product_search_client
 
     # Get the full path of the product.
-    product_path = client.product_path(
-        project=project_id, location=location, product=product_id)
+    product_path = session.product_path(product_id)
 
     # Create a reference image.
-    reference_image = vision.ReferenceImage(uri=gcs_uri)
+    with span('create_reference_image.build'):
+        reference_image = vision.ReferenceImage(uri=gcs_uri)
 
     # The response is the reference image with `name` populated.
-    image = client.create_reference_image(
-        parent=product_path,
-        reference_image=reference_image,
-        reference_image_id=reference_image_id)
+    with span('create_reference_image.rpc'):
+        image = client.create_reference_image(
+            parent=product_path,
+            reference_image=reference_image,
+            reference_image_id=reference_image_id)
 
     # Display the reference image information.
     print('Reference image name: {}'.format(image.name))
     print('Reference image uri: {}'.format(image.uri))
 
 
+def update_product_labels(
+        project_id, location, product_id, product_display_name, product_description, product_labels,
+        session=None):
+    """Update the display name, description and labels of a product.
+    Args:
+        project_id: Id of the project.
+        location: A compute region name.
+        product_id: Id of the product.
+        product_display_name: Display name of the product.
+        product_description: Description of the product.
+        product_labels: Labels of the product, they replace the current ones.
+        session: VisionSession to reuse, defaults to the process-wide one.
+    """
+    session = session or get_session(project_id, location)
+    client = session.product_search_client
+
+    # Get the full path of the product.
+    product_path = session.product_path(product_id)
+
+    # Set product name, display name, description and labels.
+    product = vision.Product(
+        name=product_path,
+        display_name=product_display_name,
+        description=product_description,
+        product_labels=product_labels)
+
+    # Only the fields in the mask are updated.
+    update_mask = field_mask.FieldMask(paths=['display_name', 'description', 'product_labels'])
+
+    # This overwrites the product_labels.
+    updated_product = client.update_product(
+        product=product, update_mask=update_mask)
+
+    # Display the updated product information.
+    print('Product name: {}'.format(updated_product.name))
+
+
+def delete_reference_image(
+        project_id, location, product_id, reference_image_id, session=None):
+    """Delete a reference image.
+    Args:
+        project_id: Id of the project.
+        location: A compute region name.
+        product_id: Id of the product.
+        reference_image_id: Id of the reference image.
+        session: VisionSession to reuse, defaults to the process-wide one.
+    """
+    session = session or get_session(project_id, location)
+    client = session.product_search_client
+
+    # Get the full path of the reference image.
+    reference_image_path = client.reference_image_path(
+        project=project_id, location=location, product=product_id,
+        reference_image=reference_image_id)
+
+    # Delete the reference image.
+    client.delete_reference_image(name=reference_image_path)
+    print('Reference image deleted from product.')
+
+
+def remove_product_from_product_set(
+        project_id, location, product_id, product_set_id, session=None):
+    """Remove a product from a product set.
+    Args:
+        project_id: Id of the project.
+        location: A compute region name.
+        product_id: Id of the product.
+        product_set_id: Id of the product set.
+        session: VisionSession to reuse, defaults to the process-wide one.
+    """
+    session = session or get_session(project_id, location)
+    client = session.product_search_client
+
+    # Get the full path of the product set.
+    product_set_path = session.product_set_path(product_set_id)
+
+    # Get the full path of the product.
+    product_path = session.product_path(product_id)
+
+    # Remove the product from the product set.
+    client.remove_product_from_product_set(
+        name=product_set_path, product=product_path)
+    print('Product removed from product set.')
+
+
+def delete_product(project_id, location, product_id, session=None):
+    """Delete the product and all its reference images.
+    Args:
+        project_id: Id of the project.
+        location: A compute region name.
+        product_id: Id of the product.
+        session: VisionSession to reuse, defaults to the process-wide one.
+    """
+    session = session or get_session(project_id, location)
+    client = session.product_search_client
+
+    # Get the full path of the product.
+    product_path = session.product_path(product_id)
+
+    # Delete a product.
+    client.delete_product(name=product_path)
+    print('Product deleted.')
+
+
+def read_catalog_rows(csv_path, fields=None):
+    """Read the catalog export row by row.
+
+    Rows come from the columnar store of the CSV (see `catalog`), built on
+    first use and whenever the CSV changes, so only the fields asked for
+    are read from disk.
+    Args:
+        csv_path: Path of the catalog CSV export.
+        fields: Keys to load, defaults to every catalog field used for ingestion.
+    Returns:
+        An iterator of dicts with the catalog fields used for ingestion.
+    """
+    return open_catalog(csv_path).rows(fields)
+
+
+def catalog_row_labels(catalog_row):
+    """Build the product labels of a catalog row.
+
+    Colors detected in the product image (`detected_colors`, see
+    `colors.ColorEnricher`) are added as extra `color` labels, so filters
+    on normalized colors also match products with free-text colors.
+    """
+    product_labels = [
+        vision.Product.KeyValue(key='brand', value=catalog_row['brand']),
+        vision.Product.KeyValue(key='gender', value=catalog_row['gender']),
+        vision.Product.KeyValue(key='color', value=catalog_row['color']),
+        vision.Product.KeyValue(key='category', value=catalog_row['product_category'])
+    ]
+    for color in catalog_row.get('detected_colors', ()):
+        if color != catalog_row['color']:
+            product_labels.append(vision.Product.KeyValue(key='color', value=color))
+    return product_labels
+
+
+def ingest_catalog(project_id, location, product_set_id, bucket_name, csv_path, session=None, journal=None,
+                   manifest=None, normalize=None, scheduler=None):
+    """Create products, reference images and set membership row by row.
+
+    With a journal, steps finished by an earlier run are skipped locally.
+    With a manifest, images already stored in the bucket are not uploaded.
+    `normalize` is applied to the images before they are uploaded. With a
+    scheduler (a `scheduler.CallScheduler`), calls are rate limited and
+    retried, and the rows still failing go to its dead-letter file.
+    """
+    session = session or get_session(project_id, location)
+    create_product_call = scheduled(scheduler, 'create_product', create_product)
+    add_product_call = scheduled(scheduler, 'add_product_to_product_set', add_product_to_product_set)
+    store_image_call = scheduled(scheduler, 'gcs_upload', store_image)
+    create_reference_image_call = scheduled(scheduler, 'create_reference_image', create_reference_image)
+
+    def failed(catalog_row, stage, error):
+        print(error)
+        if scheduler is not None:
+            scheduler.dead_letter(catalog_row, stage, error)
+
+    for catalog_row in read_catalog_rows(csv_path):
+        beni_product_id = catalog_row['beni_product_id']
+        try:
+            run_step(journal, beni_product_id, 'create_product', create_product_call,
+                     project_id, location, beni_product_id, catalog_row['product_title'],
+                     catalog_row['product_description'], 'apparel', catalog_row_labels(catalog_row),
+                     session=session)
+        except Exception as e:
+            failed(catalog_row, 'create_product', e)
+        try:
+            run_step(journal, beni_product_id, 'attach', add_product_call,
+                     project_id, location, beni_product_id, product_set_id, session=session)
+        except Exception as e:
+            failed(catalog_row, 'attach', e)
+        try:
+            uploaded = journal.get(beni_product_id, 'upload') if journal is not None else None
+            if uploaded is not None:
+                gcs_uri = uploaded['gcs_uri']
+            else:
+                gcs_uri = store_image_call(bucket_name, catalog_row['img_url'], session, manifest, normalize)
+                if gcs_uri is not None and journal is not None:
+                    journal.mark(beni_product_id, 'upload', gcs_uri=gcs_uri)
+            if gcs_uri is not None:
+                run_step(journal, beni_product_id, 'reference_image', create_reference_image_call,
+                         project_id, location, beni_product_id, catalog_row['product_id'], gcs_uri,
+                         session=session)
+        except Exception as e:
+            failed(catalog_row, 'reference_image', e)
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load the product catalog into Vision Product Search.')
+    parser.add_argument('mode', nargs='?', default='serial', choices=['serial', 'pipeline', 'bulk', 'sync'],
+                        help='serial: one RPC per row and step, pipeline: concurrent stages, '
+                             'bulk: a single ImportProductSets operation, '
+                             'sync: only the changes since the last sync')
+    parser.add_argument('--catalog', default='product_catalog_productbase.csv')
+    parser.add_argument('--workers', type=int, default=8, help='worker threads per pipeline stage')
+    parser.add_argument('--queue-size', type=int, default=32, help='jobs buffered in front of each pipeline stage')
+    parser.add_argument('--journal', default='ingest_journal.jsonl',
+                        help='checkpoint journal used to resume serial and pipeline runs')
+    parser.add_argument('--snapshot', default='catalog_snapshot.json', help='catalog state of the last sync')
+    parser.add_argument('--manifest', default='blob_manifest.jsonl',
+                        help='images already in the bucket, built from a bucket listing on first use')
+    parser.add_argument('--max-edge', type=int, default=0,
+                        help='downsize images to this many pixels and strip their metadata before uploading, '
+                             'by default they are uploaded as they are')
+    parser.add_argument('--quality', type=int, default=85, help='JPEG quality of downsized images')
+    parser.add_argument('--enrich-colors', action='store_true',
+                        help='pipeline and sync: add the colors detected in each image as color labels')
+    parser.add_argument('--color-cache', default='color_cache.jsonl', help='detected colors by image MD5')
+    parser.add_argument('--dead-letter', default='dead_letter.jsonl',
+                        help='serial, pipeline and sync: rows still failing after every retry')
+    parser.add_argument('--max-attempts', type=int, default=5, help='attempts per API call on retryable errors')
+    parser.add_argument('--trace-output',
+                        help='print the time spent per stage and write it to this JSON file, '
+                             'VISION_TRACE_SAMPLE sets the share of calls timed')
+    args = parser.parse_args()
+    if args.enrich_colors and args.mode not in ('pipeline', 'sync'):
+        parser.error('--enrich-colors is only supported in the pipeline and sync modes')
+
     bucket_name = "beni-ai-engine"
     project_id = "beni-ai-engine"
     location = "us-east1"
     product_set_id = 'BENI_CLOTH'
+    session = get_session(project_id, location)
     try:
-        create_bucket(bucket_name)
-    except Exception as e:
-        print(e)
-    try:
-        create_product_set(project_id, location, product_set_id, "TEST_CLOTH")
+        create_bucket(bucket_name, session=session)
     except Exception as e:
         print(e)
-    with open('product_catalog_productbase.csv', 'r') as read_obj:
-        csv_reader = reader(read_obj)
-        header = next(csv_reader)
-        if header is not None:
-            for row in csv_reader:
-                beni_product_id = row[1]
-                product_id = row[2]
-                img_url = row[4]
-                brand = row[7]
-                product_title = row[8]
-                product_description = row[9]
-                gender = row[11]
-                color = row[12]
-                product_category = row[20]
-                product_labels = [
-                    vision.Product.KeyValue(key='brand', value=brand),
-                    vision.Product.KeyValue(key='gender', value=gender),
-                    vision.Product.KeyValue(key='color', value=color),
-                    vision.Product.KeyValue(key='category', value=product_category)
-                ]
-                try:
-                    create_product(project_id, location, beni_product_id, product_title, product_description, 'apparel',
-                                   product_labels)
-                except Exception as e:
-                    print(e)
-                try:
-                    add_product_to_product_set(project_id, location, beni_product_id, product_set_id)
-                except Exception as e:
-                    print(e)
-                try:
-                    gcs_uri = upload_image(bucket_name, img_url)
-                    if gcs_uri is not None:
-                        create_reference_image(project_id, location, beni_product_id, product_id, gcs_uri)
-                except Exception as e:
-                    print(e)
+    manifest = BlobManifest.load_or_build(args.manifest, session.bucket(bucket_name))
+    normalize = ImageNormalizer(args.max_edge, args.quality) if args.max_edge else None
+    if args.mode == 'bulk':
+        # ImportProductSets creates the product set on the fly.
+        import bulk_import
+
+        transport = bulk_import.GcsImportTransport(project_id, location, bucket_name, session=session,
+                                                   manifest=manifest, normalize=normalize)
+        bulk_import.import_catalog(transport, args.catalog, product_set_id)
+    else:
+        try:
+            create_product_set(project_id, location, product_set_id, "TEST_CLOTH", session=session)
+        except Exception as e:
+            print(e)
+    scheduler = CallScheduler(max_attempts=args.max_attempts, dead_letter_path=args.dead_letter)
+    enrich = None
+    if args.enrich_colors:
+        from colors import ColorEnricher
+
+        enrich = ColorEnricher(args.color_cache)
+    if args.mode == 'sync':
+        import sync
+
+        sync.sync_catalog(project_id, location, product_set_id, bucket_name, args.catalog, args.snapshot,
+                          args.workers, args.queue_size, session=session, manifest=manifest, normalize=normalize,
+                          enrich=enrich, scheduler=scheduler)
+    elif args.mode in ('serial', 'pipeline'):
+        with IngestJournal(args.journal) as journal:
+            if args.mode == 'pipeline':
+                import pipeline
+
+                pipeline.ingest_catalog_concurrently(project_id, location, product_set_id, bucket_name, args.catalog,
+                                                     args.workers, args.queue_size, session=session, journal=journal,
+                                                     manifest=manifest, normalize=normalize, enrich=enrich,
+                                                     scheduler=scheduler)
+            else:
+                ingest_catalog(project_id, location, product_set_id, bucket_name, args.catalog, session=session,
+                               journal=journal, manifest=manifest, normalize=normalize, scheduler=scheduler)
+    if scheduler.stats:
+        scheduler.print_stats()
+    if enrich is not None:
+        enrich.close()
+    if args.trace_output:
+        from tracing import tracer
+
+        tracer.print_report()
+        with open(args.trace_output, 'w') as trace_file:
+            trace_file.write(tracer.to_json(indent=2))
@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+
+
+class BlobManifest(object):
+    """Local index of the images already stored in GCS.
+
+    Entries are keyed by the base64 MD5 of the content, the same value GCS
+    reports as `md5_hash`, so the manifest can be rebuilt from a bucket
+    listing without downloading anything. A second index by blob name lets
+    a re-run skip images whose URL was already uploaded.
+
+    The file is an append-only JSONL log, one entry per line.
+    Args:
+        path: Path of the manifest file, created if missing.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._by_md5 = {}
+        self._by_blob_name = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as manifest_file:
+                for line in manifest_file:
+                    try:
+                        self._index(json.loads(line))
+                    except ValueError:
+                        continue
+        self._file = open(path, 'a', encoding='utf-8')
+
+    @classmethod
+    def load_or_build(cls, path, bucket):
+        """Open the manifest, listing the bucket first if it does not exist yet."""
+        exists = os.path.exists(path)
+        manifest = cls(path)
+        if not exists:
+            manifest.add_bucket_listing(bucket)
+        return manifest
+
+    def __len__(self):
+        return len(self._by_md5)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _index(self, entry):
+        self._by_md5.setdefault(entry['md5'], entry)
+        self._by_blob_name[entry['blob_name']] = entry
+
+    def add(self, md5, bucket_name, blob_name, size, content_type, uri=None):
+        """Record a stored image.
+
+        `uri` is given for aliases: a blob name whose bytes are stored
+        under another blob.
+        """
+        entry = {
+            'md5': md5,
+            'uri': uri or 'gs://' + bucket_name + '/' + blob_name,
+            'blob_name': blob_name,
+            'size': size,
+            'content_type': content_type,
+        }
+        with self._lock:
+            self._index(entry)
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+        return entry
+
+    def add_bucket_listing(self, bucket, prefix=None):
+        """Add every object of a bucket, using the MD5 GCS already computed."""
+        for blob in bucket.list_blobs(prefix=prefix):
+            if blob.md5_hash and blob.name not in self._by_blob_name:
+                self.add(blob.md5_hash, bucket.name, blob.name, blob.size, blob.content_type)
+
+    def by_md5(self, md5):
+        return self._by_md5.get(md5)
+
+    def by_blob_name(self, blob_name):
+        return self._by_blob_name.get(blob_name)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
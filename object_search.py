@@ -0,0 +1,178 @@
+"""Product searches for every object of a photo.
+
+A photo holding several garments returns mixed results when searched as
+a whole. Here the objects are localized with a single Vision call, the
+image is decoded once and each bounding box is cropped from it, then the
+crops are searched concurrently, so the latency is about one localization
+plus the slowest crop search instead of their sum.
+
+    python object_search.py beni-test-cases/nlm1126s-multi-2.jpeg --product-set-id BENI_CLOTH
+"""
+import argparse
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import vision
+from PIL import Image
+
+from find_products import VisionSearchBackend, print_results
+from session import get_session
+from tracing import span, traced
+
+
+def localize_objects(session, content, max_objects=10, min_score=0.5):
+    """Localize the objects of an image.
+    Returns:
+        The `vision.LocalizedObjectAnnotation`s scoring at least `min_score`,
+        best first.
+    """
+    with span('object_search.localize'):
+        response = session.image_annotator_client.object_localization(
+            image=vision.Image(content=content), max_results=max_objects)
+    if response.error.code:
+        raise RuntimeError(response.error.message)
+    annotations = [annotation for annotation in response.localized_object_annotations
+                   if annotation.score >= min_score]
+    return sorted(annotations, key=lambda annotation: -annotation.score)
+
+
+def bounding_box(annotation):
+    """Normalized (left, top, right, bottom) of an object annotation."""
+    xs = [vertex.x for vertex in annotation.bounding_poly.normalized_vertices]
+    ys = [vertex.y for vertex in annotation.bounding_poly.normalized_vertices]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def crop_objects(content, boxes, padding=0.05, max_edge=1024, quality=90):
+    """Crop boxes out of an image decoded once.
+    Args:
+        content: Image bytes.
+        boxes: Normalized (left, top, right, bottom) boxes.
+        padding: Share of the box size added on each side, the search
+            works better with a little context around the object.
+        max_edge: Longest side of the crops, larger ones are downsized.
+        quality: JPEG quality of the crops.
+    Returns:
+        The JPEG bytes of each crop, in the order of `boxes`.
+    """
+    image = Image.open(io.BytesIO(content))
+    image = image.convert('RGB')
+    width, height = image.size
+    crops = []
+    for left, top, right, bottom in boxes:
+        pad_x = (right - left) * padding
+        pad_y = (bottom - top) * padding
+        x0 = int(max(0.0, left - pad_x) * width)
+        y0 = int(max(0.0, top - pad_y) * height)
+        # Degenerate boxes still give a one pixel crop.
+        x1 = max(x0 + 1, int(min(1.0, right + pad_x) * width))
+        y1 = max(y0 + 1, int(min(1.0, bottom + pad_y) * height))
+        crop = image.crop((x0, y0, x1, y1))
+        if max(crop.size) > max_edge:
+            crop.thumbnail((max_edge, max_edge), Image.LANCZOS)
+        output = io.BytesIO()
+        crop.save(output, format='JPEG', quality=quality)
+        crops.append(output.getvalue())
+    return crops
+
+
+@traced('search_objects_file')
+def search_objects_file(
+        project_id,
+        location,
+        product_set_id,
+        product_category,
+        file_path,
+        filter,
+        max_results,
+        session=None,
+        backend=None,
+        max_objects=5,
+        min_score=0.5,
+        max_workers=None
+):
+    """Search similar products for each object of an image.
+    Args:
+        project_id: Id of the project.
+        location: A compute region name.
+        product_set_id: Id of the product set.
+        product_category: Category of the product.
+        file_path: Local file path of the image to be searched.
+        filter: Condition to be applied on the labels, see `get_similar_products_file`.
+        max_results: The maximum number of results per object.
+        session: VisionSession to reuse, defaults to the process-wide one.
+        backend: SearchBackend answering the crop searches, defaults to the Vision API.
+        max_objects: The maximum number of objects searched.
+        min_score: Objects localized with a lower confidence are skipped.
+        max_workers: Crop searches in flight, defaults to one per object.
+    Returns:
+        A list with one dict per object, most confident first, holding its
+        `name`, `score`, `bounding_box` (normalized left, top, right,
+        bottom) and search `results`, or `error` when its search failed.
+        An image where nothing is localized is searched whole, as one
+        object named None.
+    """
+    session = session or get_session(project_id, location)
+    backend = backend or VisionSearchBackend(session)
+
+    # Read the image as a stream of bytes.
+    with open(file_path, 'rb') as image_file:
+        content = image_file.read()
+
+    annotations = localize_objects(session, content, max_objects, min_score)
+    if annotations:
+        objects = [{'name': annotation.name, 'score': annotation.score, 'bounding_box': bounding_box(annotation)}
+                   for annotation in annotations]
+        with span('object_search.crop'):
+            crops = crop_objects(content, [detected['bounding_box'] for detected in objects])
+    else:
+        objects = [{'name': None, 'score': None, 'bounding_box': (0.0, 0.0, 1.0, 1.0)}]
+        crops = [content]
+
+    def search(crop):
+        try:
+            with span('object_search.search'):
+                product_search_results = backend.product_search(
+                    crop, product_set_id, product_category, filter, max_results)
+        except Exception as e:
+            return None, str(e)
+        return product_search_results.results, None
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(crops)) as executor:
+        for detected, (results, error) in zip(objects, executor.map(search, crops)):
+            if error is None:
+                detected['results'] = results
+            else:
+                detected['error'] = error
+    return objects
+
+
+def print_object_results(objects, file_path, catalog=None):
+    """Print the results of `search_objects_file` object by object."""
+    for detected in objects:
+        left, top, right, bottom = detected['bounding_box']
+        print('Object: {} (confidence {}) at ({:.2f}, {:.2f})-({:.2f}, {:.2f})'.format(
+            detected['name'], detected['score'], left, top, right, bottom))
+        if 'error' in detected:
+            print('Search failed: {}\n'.format(detected['error']))
+        else:
+            print_results(detected['results'], file_path, catalog)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image', help='local path of the photo')
+    parser.add_argument('--project-id', default='beni-ai-engine')
+    parser.add_argument('--location', default='us-east1')
+    parser.add_argument('--product-set-id', default='BENI_CLOTH')
+    parser.add_argument('--product-category', default='apparel')
+    parser.add_argument('--filter')
+    parser.add_argument('--max-results', type=int, default=4, help='results per object')
+    parser.add_argument('--max-objects', type=int, default=5)
+    parser.add_argument('--min-score', type=float, default=0.5, help='lowest object confidence searched')
+    args = parser.parse_args()
+
+    objects = search_objects_file(args.project_id, args.location, args.product_set_id, args.product_category,
+                                  args.image, args.filter, args.max_results, max_objects=args.max_objects,
+                                  min_score=args.min_score)
+    print_object_results(objects, args.image)
@@ -0,0 +1,300 @@
+import queue
+import threading
+import time
+
+from journal import run_step
+from main import (
+    add_product_to_product_set,
+    catalog_row_labels,
+    create_product,
+    create_reference_image,
+    download_image,
+    image_blob_name,
+    read_catalog_rows,
+    store_image,
+    store_image_content,
+    upload_image_content,
+)
+from scheduler import scheduled
+from session import get_session
+
+_DONE = object()
+
+
+class Stage(object):
+    """One step of the pipeline.
+    Args:
+        name: Name used in the statistics.
+        fn: Callable that takes a job and returns it, or None to drop it.
+        workers: Number of threads running this stage, at least one.
+    """
+
+    def __init__(self, name, fn, workers=1):
+        # A stage without workers would never drain its queue and block the feeder.
+        if workers < 1:
+            raise ValueError('Stage {} needs at least one worker, got {}'.format(name, workers))
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+
+
+class Pipeline(object):
+    """Runs jobs through stages connected by bounded queues.
+
+    Each job goes through the stages in order, so the steps of one product
+    never overlap, while the worker threads of every stage keep several
+    products in flight. A full queue blocks the stage that feeds it, which
+    keeps fast stages from piling up work in front of slow ones.
+
+    A job whose stage raises is dropped, and handed to `dead_letter(job,
+    stage_name, error)` when given, such as `CallScheduler.dead_letter`.
+    """
+
+    def __init__(self, stages, queue_size=32, dead_letter=None):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.dead_letter = dead_letter
+        self.completed = {stage.name: 0 for stage in stages}
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def _run_stage(self, stage, stage_queue, next_queue, next_workers, remaining):
+        while True:
+            job = stage_queue.get()
+            if job is _DONE:
+                break
+            try:
+                job = stage.fn(job)
+            except Exception as e:
+                with self._lock:
+                    self.errors.append((job.get('beni_product_id'), stage.name, e))
+                print('{} failed for {}: {}'.format(stage.name, job.get('beni_product_id'), e))
+                if self.dead_letter is not None:
+                    self.dead_letter(job, stage.name, e)
+                continue
+            if job is None:
+                continue
+            with self._lock:
+                self.completed[stage.name] += 1
+            if next_queue is not None:
+                next_queue.put(job)
+        # The last worker of a stage to finish tells the next stage to stop.
+        with self._lock:
+            remaining[stage.name] -= 1
+            last = remaining[stage.name] == 0
+        if last and next_queue is not None:
+            for _ in range(next_workers):
+                next_queue.put(_DONE)
+
+    def run(self, jobs):
+        """Feed jobs through every stage and wait until all of them are done."""
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining = {stage.name: stage.workers for stage in self.stages}
+        threads = []
+        for index, stage in enumerate(self.stages):
+            last_stage = index == len(self.stages) - 1
+            next_queue = None if last_stage else queues[index + 1]
+            next_workers = 0 if last_stage else self.stages[index + 1].workers
+            for _ in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._run_stage, args=(stage, queues[index], next_queue, next_workers, remaining),
+                    name='{}-worker'.format(stage.name), daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        started = time.monotonic()
+        for job in jobs:
+            queues[0].put(job)
+        for _ in range(self.stages[0].workers):
+            queues[0].put(_DONE)
+        for thread in threads:
+            thread.join()
+        return time.monotonic() - started
+
+
+INGEST_STAGES = ('upload', 'create_product', 'attach', 'reference_image')
+
+
+def detect_colors(job, enrich, manifest=None):
+    """Set `detected_colors` on a catalog job, see `main.catalog_row_labels`.
+
+    Images the manifest knows are looked up in the color cache by their
+    MD5 before anything is downloaded. The image bytes left on the job by
+    the upload stage, if any, are used and removed from it, otherwise the
+    image is downloaded.
+    """
+    content = job.pop('content', None)
+    job.pop('content_type', None)
+    entry = manifest.by_blob_name(image_blob_name(job['img_url'])) if manifest is not None else None
+    md5 = entry['md5'] if entry is not None else None
+    detected_colors = enrich.get(md5) if md5 is not None else None
+    if detected_colors is None:
+        if content is None:
+            image = download_image(job['img_url'])
+            if image is None:
+                return job
+            content = image[0]
+        detected_colors = enrich(content)
+        if md5 is not None:
+            enrich.remember(md5, detected_colors)
+    job['detected_colors'] = detected_colors
+    return job
+
+
+def build_ingest_stages(project_id, location, product_set_id, bucket_name, workers=8, session=None, journal=None,
+                        stream=True, manifest=None, normalize=None, enrich=None, scheduler=None):
+    """Build the download → upload → create product → attach → reference image stages.
+
+    With `stream` the download and upload happen in one stage that pipes
+    the HTTP response into GCS, so memory does not grow with the image
+    size times the number of jobs queued between the two stages. A
+    manifest or `normalize` also merge them into `main.store_image`.
+
+    With `enrich`, a colors stage before create product adds the colors
+    detected in the image to the product labels. The upload stage then
+    downloads the image whole and leaves its bytes on the job for the
+    colors stage, instead of streaming it, so it is downloaded only once.
+    Args:
+        project_id: Id of the project.
+        location: A compute region name.
+        product_set_id: Id of the product set.
+        bucket_name: Bucket where the images are stored.
+        workers: Worker threads per stage, an int or a dict keyed by stage name.
+        session: VisionSession to reuse, defaults to the process-wide one.
+        journal: IngestJournal used to skip and record finished stages.
+        stream: Stream images from their URL straight into GCS.
+        manifest: BlobManifest used to skip images already stored.
+        normalize: Optional callable applied to the images before they are uploaded.
+        enrich: Optional `colors.ColorEnricher` used to label detected colors.
+        scheduler: Optional `scheduler.CallScheduler` the downloads, uploads
+            and API calls go through.
+    """
+    session = session or get_session(project_id, location)
+    download_image_call = scheduled(scheduler, 'download_image', download_image)
+    store_image_call = scheduled(scheduler, 'gcs_upload', store_image)
+    upload_image_content_call = scheduled(scheduler, 'gcs_upload', upload_image_content)
+    store_image_content_call = scheduled(scheduler, 'gcs_upload', store_image_content)
+    create_product_call = scheduled(scheduler, 'create_product', create_product)
+    add_product_call = scheduled(scheduler, 'add_product_to_product_set', add_product_to_product_set)
+    create_reference_image_call = scheduled(scheduler, 'create_reference_image', create_reference_image)
+    single_step = stream or manifest is not None or normalize is not None
+
+    def uploaded_uri(job):
+        uploaded = journal.get(job['beni_product_id'], 'upload') if journal is not None else None
+        return uploaded['gcs_uri'] if uploaded is not None else None
+
+    def download(job):
+        job['gcs_uri'] = uploaded_uri(job)
+        if job['gcs_uri'] is not None:
+            return job
+        image = download_image_call(job['img_url'])
+        if image is None:
+            print('Not an image: {}'.format(job['img_url']))
+            return None
+        job['content'], job['content_type'] = image
+        return job
+
+    def keep_and_store(job):
+        """Upload an image keeping its bytes on the job, for the colors stage."""
+        entry = manifest.by_blob_name(image_blob_name(job['img_url'])) if manifest is not None else None
+        if entry is not None:
+            return entry['uri']
+        image = download_image_call(job['img_url'])
+        if image is None:
+            return None
+        job['content'], job['content_type'] = image
+        return store_image_content_call(bucket_name, image_blob_name(job['img_url']), job['content'],
+                                        job['content_type'], session, manifest, normalize)
+
+    def upload(job):
+        if single_step:
+            job['gcs_uri'] = uploaded_uri(job)
+        if job['gcs_uri'] is not None:
+            return job
+        if single_step and enrich is not None:
+            job['gcs_uri'] = keep_and_store(job)
+            if job['gcs_uri'] is None:
+                print('Not an image: {}'.format(job['img_url']))
+                return None
+        elif single_step:
+            job['gcs_uri'] = store_image_call(bucket_name, job['img_url'], session, manifest, normalize)
+            if job['gcs_uri'] is None:
+                print('Not an image: {}'.format(job['img_url']))
+                return None
+        elif enrich is not None:
+            job['gcs_uri'] = upload_image_content_call(
+                bucket_name, image_blob_name(job['img_url']), job['content'], job['content_type'], session)
+        else:
+            job['gcs_uri'] = upload_image_content_call(
+                bucket_name, image_blob_name(job['img_url']), job.pop('content'), job.pop('content_type'), session)
+        if journal is not None:
+            journal.mark(job['beni_product_id'], 'upload', gcs_uri=job['gcs_uri'])
+        return job
+
+    def colors(job):
+        if journal is not None and journal.is_done(job['beni_product_id'], 'create_product'):
+            # The labels are only used when the product is created.
+            job.pop('content', None)
+            job.pop('content_type', None)
+            return job
+        return detect_colors(job, enrich, manifest)
+
+    def product(job):
+        run_step(journal, job['beni_product_id'], 'create_product', create_product_call,
+                 project_id, location, job['beni_product_id'], job['product_title'],
+                 job['product_description'], 'apparel', catalog_row_labels(job), session=session)
+        return job
+
+    def attach(job):
+        run_step(journal, job['beni_product_id'], 'attach', add_product_call,
+                 project_id, location, job['beni_product_id'], product_set_id, session=session)
+        return job
+
+    def reference_image(job):
+        run_step(journal, job['beni_product_id'], 'reference_image', create_reference_image_call,
+                 project_id, location, job['beni_product_id'], job['product_id'], job['gcs_uri'],
+                 session=session)
+        return job
+
+    steps = [('download', download), ('upload', upload), ('create_product', product),
+             ('attach', attach), ('reference_image', reference_image)]
+    if enrich is not None:
+        steps.insert(2, ('colors', colors))
+    if single_step:
+        steps.pop(0)
+    stages = []
+    for name, fn in steps:
+        stage_workers = workers.get(name, 1) if isinstance(workers, dict) else workers
+        stages.append(Stage(name, fn, stage_workers))
+    return stages
+
+
+def ingest_catalog_concurrently(project_id, location, product_set_id, bucket_name, csv_path, workers=8,
+                                queue_size=32, session=None, journal=None, manifest=None, normalize=None,
+                                enrich=None, scheduler=None):
+    """Concurrent version of `main.ingest_catalog`.
+    Args:
+        workers: Worker threads per stage, an int or a dict keyed by stage name.
+        queue_size: Capacity of the queue in front of each stage.
+        journal: IngestJournal used to skip and record finished stages.
+        manifest: BlobManifest used to skip images already stored.
+        normalize: Optional callable applied to the images before they are uploaded.
+        enrich: Optional `colors.ColorEnricher` used to label detected colors.
+        scheduler: Optional `scheduler.CallScheduler` the calls go through,
+            failed products go to its dead-letter file.
+    """
+    stages = build_ingest_stages(project_id, location, product_set_id, bucket_name, workers, session, journal,
+                                 manifest=manifest, normalize=normalize, enrich=enrich, scheduler=scheduler)
+    jobs = read_catalog_rows(csv_path)
+    if journal is not None:
+        # Products finished by an earlier run never enter the pipeline.
+        jobs = (job for job in jobs
+                if not all(journal.is_done(job['beni_product_id'], stage) for stage in INGEST_STAGES))
+    pipeline = Pipeline(stages, queue_size, scheduler.dead_letter if scheduler is not None else None)
+    elapsed = pipeline.run(jobs)
+    done = pipeline.completed[stages[-1].name]
+    print('Ingested {} products in {:.1f}s ({:.1f}/s), {} errors'.format(
+        done, elapsed, done / elapsed if elapsed else 0, len(pipeline.errors)))
+    for stage in stages:
+        print('  {}: {}'.format(stage.name, pipeline.completed[stage.name]))
+    return pipeline
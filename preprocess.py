@@ -0,0 +1,75 @@
+import io
+
+from PIL import Image, ImageOps
+
+# JPEG segments describing the encoding itself (JFIF, Adobe color
+# transform), any other segment holds metadata: EXIF, XMP, ICC, comments.
+ENCODING_SEGMENTS = ('APP0', 'APP14')
+# EXIF tag of the orientation the image must be displayed in.
+ORIENTATION_TAG = 0x0112
+
+
+class ImageNormalizer(object):
+    """Downsize and re-encode images before they are uploaded or searched.
+
+    Product Search does not benefit from large images, so images are
+    shrunk to `max_edge` pixels on their longest side and re-encoded as
+    JPEG at `quality`. Metadata such as EXIF, XMP, ICC profiles and
+    comments is dropped. JPEGs are decoded with the scaled (draft)
+    decoder, which skips most of the DCT work when the target is much
+    smaller than the source.
+
+    Call an instance with the image bytes to get (content, content_type).
+    Args:
+        max_edge: Maximum width and height of the result, in pixels.
+        quality: JPEG quality of the result.
+    """
+
+    def __init__(self, max_edge=1024, quality=85):
+        self.max_edge = max_edge
+        self.quality = quality
+
+    def __repr__(self):
+        return 'ImageNormalizer(max_edge={}, quality={})'.format(self.max_edge, self.quality)
+
+    def __call__(self, content):
+        image = Image.open(io.BytesIO(content))
+        if image.format == 'JPEG':
+            clean = all(segment in ENCODING_SEGMENTS for segment, _ in image.applist)
+            upright = image.getexif().get(ORIENTATION_TAG, 1) == 1
+            if max(image.size) <= self.max_edge and clean and upright:
+                # Already small and clean, re-encoding would only lose quality.
+                return content, 'image/jpeg'
+            # Decodes at the smallest 1/2, 1/4 or 1/8 scale still >= max_edge.
+            image.draft('RGB', (self.max_edge, self.max_edge))
+        # The EXIF orientation is dropped with the rest of the metadata, it
+        # is applied to the pixels first so the image is not stored sideways.
+        image = ImageOps.exif_transpose(image)
+        if max(image.size) > self.max_edge:
+            image.thumbnail((self.max_edge, self.max_edge), Image.LANCZOS)
+        if image.mode in ('RGBA', 'LA', 'P'):
+            # JPEG has no alpha, flatten transparent areas onto white.
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        output = io.BytesIO()
+        # Pillow writes some of image.info back, such as the comment: clear it
+        # so EXIF, XMP, ICC data and comments are all dropped.
+        image.info = {}
+        image.save(output, format='JPEG', quality=self.quality, optimize=True)
+        return output.getvalue(), 'image/jpeg'
+
+
+def normalizer_id(normalize):
+    """Stable description of a normalize callable, for keys of search results.
+
+    Results answered from differently normalized images must not be shared,
+    so the settings of an `ImageNormalizer` (its repr) or the qualified name
+    of a function are part of the keys. None means the bytes are sent as is.
+    """
+    if normalize is None:
+        return 'raw'
+    return getattr(normalize, '__qualname__', None) or repr(normalize)
@@ -0,0 +1,304 @@
+"""Rate limiting, adaptive concurrency and retries for the API calls of ingestion.
+
+Every call goes through `CallScheduler.call(method, fn, ...)`, which:
+
+- waits for a token of the token bucket of the method's quota group
+  (QUOTA_GROUPS), refilled at the group's quota (QUOTAS_PER_MINUTE), so
+  calls never start faster than the project is allowed to make them;
+- waits for a slot of the method's AIMD concurrency limit, which grows
+  by one for every `limit` successful calls and halves when the service
+  answers RESOURCE_EXHAUSTED;
+- retries RETRYABLE errors with exponential backoff and full jitter, up
+  to `max_attempts` attempts, then raises `RetriesExhausted`.
+
+Items whose calls still fail are appended to a dead-letter JSONL file by
+the pipeline instead of being lost, and can be fed back with
+`read_dead_letters`:
+
+    scheduler = CallScheduler(dead_letter_path='dead_letter.jsonl')
+    create = scheduler.wrap('create_product', create_product)
+"""
+import json
+import random
+import socket
+import threading
+import time
+
+from google.api_core import exceptions
+
+# Methods counted against one shared service quota, by quota group.
+# Methods of no group have a quota of their own.
+QUOTA_GROUPS = {
+    'create_product': 'mutations',
+    'update_product': 'mutations',
+    'delete_product': 'mutations',
+    'create_product_set': 'mutations',
+    'add_product_to_product_set': 'mutations',
+    'remove_product_from_product_set': 'mutations',
+    'create_reference_image': 'mutations',
+    'delete_reference_image': 'mutations',
+}
+
+# Published Vision Product Search quotas, requests per minute and project,
+# by quota group or method.
+QUOTAS_PER_MINUTE = {
+    'mutations': 1800,
+    'product_search': 1800,
+    'batch_annotate_images': 1800,
+    'import_product_sets': 20,
+}
+
+# Errors worth another attempt: throttling, unavailability and timeouts.
+RETRYABLE = (
+    exceptions.ResourceExhausted,
+    exceptions.TooManyRequests,
+    exceptions.ServiceUnavailable,
+    exceptions.InternalServerError,
+    exceptions.GatewayTimeout,
+    exceptions.DeadlineExceeded,
+    exceptions.Aborted,
+    ConnectionError,
+    socket.timeout,
+)
+# Errors meaning the service is over capacity, the concurrency is cut.
+OVERLOAD = (exceptions.ResourceExhausted, exceptions.TooManyRequests)
+
+
+class RetriesExhausted(Exception):
+    """A call still failed after every attempt, `__cause__` is the last error."""
+
+    def __init__(self, method, attempts, error):
+        super(RetriesExhausted, self).__init__('{} failed after {} attempts: {}'.format(method, attempts, error))
+        self.method = method
+        self.attempts = attempts
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket.
+    Args:
+        rate: Tokens added per second.
+        burst: Tokens the bucket holds at most.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        # Starting full would let a burst on top of a whole window of quota.
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def drain(self):
+        """Drop the saved tokens, after the service said the quota is spent."""
+        with self._lock:
+            self._tokens = min(self._tokens, 0.0)
+
+
+class AIMDLimiter(object):
+    """Concurrency limit with additive increase and multiplicative decrease.
+    Args:
+        initial: Starting limit.
+        minimum: Limit never cut below this.
+        maximum: Limit never grown above this.
+        decrease: Factor applied to the limit on overload.
+        cooldown: Seconds after a decrease during which further overloads,
+            caused by calls started before it, do not decrease again.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=64, decrease=0.5, cooldown=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            if self.limit < self.maximum:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+                self._condition.notify()
+
+    def on_overload(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self._last_decrease = now
+
+
+class CallScheduler(object):
+    """Runs API calls within their quota, with adaptive concurrency and retries.
+    Args:
+        quotas: Requests per minute by quota group or method, merged over
+            QUOTAS_PER_MINUTE. Methods without a quota are not rate limited.
+        quota_groups: Quota group by method, defaults to QUOTA_GROUPS. The
+            methods of a group share one token bucket.
+        max_attempts: Attempts per call, the first one included.
+        base_delay: Backoff of the first retry, in seconds, doubled at each one.
+        max_delay: Longest backoff, in seconds.
+        throttle_delay: Shortest backoff after RESOURCE_EXHAUSTED, in seconds,
+            quotas are counted over whole seconds or minutes.
+        initial_concurrency: Starting AIMD limit of each method.
+        max_concurrency: Highest AIMD limit of each method.
+        dead_letter_path: JSONL file receiving the items given up on.
+    """
+
+    def __init__(self, quotas=None, quota_groups=None, max_attempts=5, base_delay=0.5, max_delay=30.0,
+                 throttle_delay=1.0, initial_concurrency=8, max_concurrency=64, dead_letter_path=None):
+        self.quotas = dict(QUOTAS_PER_MINUTE, **(quotas or {}))
+        self.quota_groups = QUOTA_GROUPS if quota_groups is None else quota_groups
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.throttle_delay = throttle_delay
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.dead_letter_path = dead_letter_path
+        self.stats = {}
+        self._buckets = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def _method_state(self, method):
+        with self._lock:
+            group = self.quota_groups.get(method, method)
+            if group not in self._buckets:
+                quota = self.quotas.get(group)
+                # A one second burst: a full minute of tokens would all go out at once.
+                self._buckets[group] = TokenBucket(quota / 60.0) if quota else None
+            limiter = self._limiters.get(method)
+            if limiter is None:
+                limiter = self._limiters[method] = AIMDLimiter(self.initial_concurrency,
+                                                               maximum=self.max_concurrency)
+                self.stats[method] = {'calls': 0, 'retries': 0, 'throttled': 0, 'failed': 0}
+            return self._buckets[group], limiter, self.stats[method]
+
+    def backoff(self, attempt):
+        """Seconds to wait before retry number `attempt` (1 for the first), with full jitter."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, method, fn, *args, **kwargs):
+        """Call `fn(*args, **kwargs)` as an API call of `method`.
+
+        Errors that are not RETRYABLE are raised at once, such as
+        AlreadyExists or NotFound, so callers keep handling them.
+        """
+        bucket, limiter, stats = self._method_state(method)
+        attempt = 0
+        while True:
+            attempt += 1
+            if bucket is not None:
+                bucket.acquire()
+            limiter.acquire()
+            try:
+                result = fn(*args, **kwargs)
+            except RETRYABLE as e:
+                error = e
+            else:
+                limiter.on_success()
+                with self._lock:
+                    stats['calls'] += 1
+                return result
+            finally:
+                limiter.release()
+
+            overloaded = isinstance(error, OVERLOAD)
+            if overloaded:
+                limiter.on_overload()
+                if bucket is not None:
+                    bucket.drain()
+            with self._lock:
+                stats['calls'] += 1
+                stats['throttled'] += overloaded
+                if attempt >= self.max_attempts:
+                    stats['failed'] += 1
+                else:
+                    stats['retries'] += 1
+            if attempt >= self.max_attempts:
+                raise RetriesExhausted(method, attempt, error) from error
+            delay = self.backoff(attempt)
+            time.sleep(max(delay, self.throttle_delay) if overloaded else delay)
+
+    def wrap(self, method, fn):
+        """Return `fn` with every call going through `call`."""
+
+        def scheduled(*args, **kwargs):
+            return self.call(method, fn, *args, **kwargs)
+
+        scheduled.__name__ = getattr(fn, '__name__', method)
+        return scheduled
+
+    def dead_letter(self, job, stage, error):
+        """Append an item given up on to the dead-letter file.
+
+        Only the text and list fields of the job are kept, enough to feed
+        the catalog row back through ingestion.
+        """
+        if self.dead_letter_path is None:
+            return
+        record = {
+            'id': job.get('beni_product_id'),
+            'stage': stage,
+            'error': '{}: {}'.format(type(error).__name__, error),
+            'time': time.time(),
+            'job': {key: value for key, value in job.items() if isinstance(value, (str, int, float, list))},
+        }
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            with open(self.dead_letter_path, 'a', encoding='utf-8') as dead_letter_file:
+                dead_letter_file.write(line)
+
+    def concurrency(self):
+        """Current AIMD limit of every method used so far."""
+        with self._lock:
+            return {method: int(limiter.limit) for method, limiter in self._limiters.items()}
+
+    def print_stats(self):
+        limits = self.concurrency()
+        print('{:<32} {:>8} {:>8} {:>10} {:>7} {:>6}'.format(
+            'method', 'calls', 'retries', 'throttled', 'failed', 'limit'))
+        for method, stats in sorted(self.stats.items()):
+            print('{:<32} {:>8} {:>8} {:>10} {:>7} {:>6}'.format(
+                method, stats['calls'], stats['retries'], stats['throttled'], stats['failed'], limits[method]))
+
+
+def scheduled(scheduler, method, fn):
+    """`scheduler.wrap(method, fn)`, or `fn` itself without a scheduler."""
+    return fn if scheduler is None else scheduler.wrap(method, fn)
+
+
+def read_dead_letters(path):
+    """Yield the catalog rows of a dead-letter file, ready to be ingested again."""
+    with open(path, 'r', encoding='utf-8') as dead_letter_file:
+        for line in dead_letter_file:
+            try:
+                yield json.loads(line)['job']
+            except ValueError:
+                continue
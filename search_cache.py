@@ -0,0 +1,174 @@
+import collections
+import io
+import sqlite3
+import threading
+import time
+
+from google.cloud import vision
+from PIL import Image
+
+from preprocess import normalizer_id
+
+
+def perceptual_hash(content):
+    """64-bit difference hash (dHash) of an image, as a hex string.
+
+    Re-encoded, resized or slightly recompressed copies of a photo give the
+    same hash, so they share cache entries.
+    """
+    image = Image.open(io.BytesIO(content))
+    # Only a 9x8 thumbnail is needed, let the JPEG decoder skip the rest.
+    image.draft('L', (64, 64))
+    pixels = list(image.convert('L').resize((9, 8), Image.BILINEAR).getdata())
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + column] < pixels[row * 9 + column + 1])
+    return '{:016x}'.format(bits)
+
+
+def _timestamp(index_time):
+    return index_time.timestamp() if index_time else 0.0
+
+
+def _scope(product_set_id, backend):
+    """Product set of an entry, apart for each backend: their indexes differ."""
+    return product_set_id if backend is None else '{}/{}'.format(type(backend).__name__, product_set_id)
+
+
+class SearchResultCache(object):
+    """LRU + TTL cache of product search results with an optional disk tier.
+
+    Keys combine the perceptual hash of the query image with the backend,
+    the normalizer the image goes through and every search parameter. Each entry remembers the `index_time` of
+    the product set it was answered from; as soon as a response shows a
+    newer index for that set, the older entries of the set are treated as
+    misses. Lookups given a backend also ask it for the index time of the
+    set every `revalidate` seconds, so a reindex is noticed under steady
+    hits too.
+    Args:
+        max_entries: Entries kept in memory.
+        ttl: Seconds an entry stays valid.
+        disk_path: Optional SQLite file holding entries evicted from, or
+            not yet loaded into, memory.
+        revalidate: Seconds between two index time checks of a product set
+            with the backend, None never checks.
+    """
+
+    def __init__(self, max_entries=1024, ttl=600, disk_path=None, revalidate=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.revalidate = revalidate
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._entries = collections.OrderedDict()
+        self._index_times = {}
+        self._checked = {}
+        self._lock = threading.Lock()
+        self._disk = None
+        if disk_path is not None:
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute(
+                'CREATE TABLE IF NOT EXISTS results '
+                '(key TEXT PRIMARY KEY, product_set_id TEXT, index_time REAL, stored_at REAL, data BLOB)')
+            self._index_times.update(self._disk.execute(
+                'SELECT product_set_id, MAX(index_time) FROM results GROUP BY product_set_id'))
+
+    @staticmethod
+    def make_key(content, product_set_id, product_category, filter, max_results, backend=None, normalize=None):
+        """Key of a query, raises OSError when the image cannot be decoded to be hashed."""
+        return '|'.join(str(part) for part in (
+            perceptual_hash(content), _scope(product_set_id, backend), normalizer_id(normalize), product_category,
+            filter, max_results))
+
+    def _valid(self, product_set_id, index_time, stored_at):
+        return (time.time() - stored_at < self.ttl
+                and index_time >= self._index_times.get(product_set_id, 0.0))
+
+    def _newer_index(self, scope, index_time):
+        if index_time > self._index_times.get(scope, 0.0):
+            self._index_times[scope] = index_time
+
+    def _check_index_time(self, product_set_id, backend):
+        """Ask the backend for the index time of a set, at most every `revalidate` seconds."""
+        scope = _scope(product_set_id, backend)
+        now = time.time()
+        with self._lock:
+            if self.revalidate is None or now - self._checked.get(scope, 0.0) < self.revalidate:
+                return
+            self._checked[scope] = now
+        try:
+            index_time = backend.product_set_index_time(product_set_id)
+        except Exception as e:
+            # Entries stay usable until the next check.
+            print('Could not check the index time of {}: {}'.format(product_set_id, e))
+            return
+        with self._lock:
+            self._newer_index(scope, _timestamp(index_time))
+
+    def get(self, key, product_set_id, backend=None):
+        """Return the cached ProductSearchResults for a key, or None."""
+        if backend is not None:
+            self._check_index_time(product_set_id, backend)
+        product_set_id = _scope(product_set_id, backend)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                results, index_time, stored_at = entry
+                if self._valid(product_set_id, index_time, stored_at):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return results
+                del self._entries[key]
+                self.stale += 1
+            if self._disk is not None:
+                row = self._disk.execute(
+                    'SELECT index_time, stored_at, data FROM results WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    index_time, stored_at, data = row
+                    if self._valid(product_set_id, index_time, stored_at):
+                        results = vision.ProductSearchResults.deserialize(data)
+                        self._remember(key, results, index_time, stored_at)
+                        self.disk_hits += 1
+                        return results
+                    self._disk.execute('DELETE FROM results WHERE key = ?', (key,))
+                    self.stale += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, product_set_id, product_search_results, backend=None):
+        product_set_id = _scope(product_set_id, backend)
+        index_time = _timestamp(product_search_results.index_time)
+        stored_at = time.time()
+        with self._lock:
+            self._newer_index(product_set_id, index_time)
+            self._remember(key, product_search_results, index_time, stored_at)
+            if self._disk is not None:
+                self._disk.execute(
+                    'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                    (key, product_set_id, index_time, stored_at,
+                     vision.ProductSearchResults.serialize(product_search_results)))
+                self._disk.commit()
+
+    def _remember(self, key, results, index_time, stored_at):
+        self._entries[key] = (results, index_time, stored_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'entries': len(self._entries),
+            'hit_ratio': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
@@ -0,0 +1,381 @@
+"""Asynchronous HTTP service answering visual product searches.
+
+    python search_service.py --port 8080 --max-concurrency 64
+
+POST /search takes either a multipart form with an `image` file, or a JSON
+body with `image_url` or `image_base64`. Both accept `product_set_id`,
+`product_category`, `filter` and `max_results`, as form fields, JSON keys
+or query parameters. The response is streamed as JSON, one result at a
+time:
+
+    {"index_time": "...", "results": [{"product": "...", "display_name": "...",
+     "score": 0.87, "image": "...", "labels": {"color": ["black"]}}, ...]}
+
+Images and bodies over MAX_IMAGE_BYTES are refused with 413.
+
+GET /healthz answers while the service is up, GET /metrics exposes the
+request counters and latency histogram in the Prometheus text format.
+
+Searches go through the asyncio Vision client over a small pool of gRPC
+channels, so a single process keeps many requests in flight without a
+thread per request. At most `max_concurrency` searches run at once, up to
+`max_waiting` more wait for a slot and the rest are rejected with 503.
+Identical searches arriving while one is running share its call (see
+`singleflight`) and take no slot.
+"""
+import argparse
+import asyncio
+import base64
+import binascii
+import json
+import time
+
+from aiohttp import ClientTimeout, web
+from google.api_core import exceptions
+from google.cloud import vision
+
+from async_api import AsyncSession
+from find_products import product_search_context
+from label_filter import FilterSyntaxError, parse_filter
+from session import get_session
+from singleflight import SingleFlight
+from tracing import span, tracer
+
+# Upper bounds, in seconds, of the request latency histogram.
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Larger images are refused rather than buffered.
+MAX_IMAGE_BYTES = 20 * 1024 * 1024
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class TooLarge(BadRequest):
+    pass
+
+
+class Overloaded(Exception):
+    pass
+
+
+class ServiceMetrics(object):
+    """Request counters and latency histogram of the service."""
+
+    def __init__(self):
+        self.requests = {}
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.upstream_errors = 0
+        self.latency_buckets = [0] * len(LATENCY_BUCKETS)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+
+    def observe(self, status, seconds):
+        self.requests[status] = self.requests.get(status, 0) + 1
+        self.latency_sum += seconds
+        self.latency_count += 1
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.latency_buckets[index] += 1
+
+    def to_prometheus(self):
+        lines = ['# TYPE search_requests_total counter']
+        for status, count in sorted(self.requests.items()):
+            lines.append('search_requests_total{{status="{}"}} {}'.format(status, count))
+        lines += [
+            '# TYPE search_in_flight gauge',
+            'search_in_flight {}'.format(self.in_flight),
+            '# TYPE search_waiting gauge',
+            'search_waiting {}'.format(self.waiting),
+            '# TYPE search_rejected_total counter',
+            'search_rejected_total {}'.format(self.rejected),
+            '# TYPE search_upstream_errors_total counter',
+            'search_upstream_errors_total {}'.format(self.upstream_errors),
+            '# TYPE search_latency_seconds histogram',
+        ]
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_buckets):
+            lines.append('search_latency_seconds_bucket{{le="{}"}} {}'.format(bound, count))
+        lines += [
+            'search_latency_seconds_bucket{{le="+Inf"}} {}'.format(self.latency_count),
+            'search_latency_seconds_sum {}'.format(self.latency_sum),
+            'search_latency_seconds_count {}'.format(self.latency_count),
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+def result_to_dict(result):
+    labels = {}
+    for label in result.product.product_labels:
+        labels.setdefault(label.key, []).append(label.value)
+    return {
+        'product': result.product.name,
+        'display_name': result.product.display_name,
+        'product_category': result.product.product_category,
+        'score': result.score,
+        'image': result.image,
+        'labels': labels,
+    }
+
+
+class SearchService(object):
+    """Product searches served over HTTP with aiohttp.
+    Args:
+        project_id: Id of the project.
+        location: A compute region name.
+        product_set_id: Product set searched when the request names none.
+        product_category: Category used when the request names none.
+        max_results: Results returned when the request does not say.
+        max_concurrency: Searches running at the same time.
+        max_waiting: Searches waiting for a slot before new ones are rejected.
+        channels: Async clients, each with its own gRPC channel, used in turn.
+        rpc_timeout: Seconds a Vision call may take.
+        session: VisionSession to reuse, defaults to the process-wide one.
+        normalize: Optional callable mapping image bytes to (content,
+            content_type), run in the default executor.
+        coalesce: Whether identical concurrent searches share one call.
+    """
+
+    def __init__(self, project_id, location, product_set_id, product_category='apparel', max_results=10,
+                 max_concurrency=64, max_waiting=256, channels=4, rpc_timeout=30, session=None, normalize=None,
+                 coalesce=True):
+        self.session = session or get_session(project_id, location)
+        self.product_set_id = product_set_id
+        self.product_category = product_category
+        self.max_results = max_results
+        self.max_concurrency = max_concurrency
+        self.max_waiting = max_waiting
+        self.channels = channels
+        self.rpc_timeout = rpc_timeout
+        self.normalize = normalize
+        self.metrics = ServiceMetrics()
+        self.coalesce = SingleFlight() if coalesce else None
+        self.api = AsyncSession(self.session.project_id, self.session.location, channels, session=self.session)
+        self._semaphore = None
+
+    async def start(self, app=None):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self, app=None):
+        await self.api.close()
+
+    async def fetch_image(self, image_url):
+        async with self.api.http.get(image_url, timeout=ClientTimeout(total=30)) as response:
+            if response.status != 200:
+                raise BadRequest('Could not fetch {}: HTTP {}'.format(image_url, response.status))
+            if not response.content_type.startswith('image'):
+                raise BadRequest('Not an image: {}'.format(image_url))
+            chunks = []
+            size = 0
+            async for chunk in response.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+                if size > MAX_IMAGE_BYTES:
+                    raise TooLarge('Image larger than {} bytes'.format(MAX_IMAGE_BYTES))
+                chunks.append(chunk)
+            return b''.join(chunks)
+
+    async def read_image_part(self, part):
+        """Read an uploaded image chunk by chunk, refusing it past MAX_IMAGE_BYTES.
+
+        aiohttp does not apply `client_max_size` to multipart reads.
+        """
+        chunks = []
+        size = 0
+        while True:
+            chunk = await part.read_chunk()
+            if not chunk:
+                return b''.join(chunks)
+            size += len(chunk)
+            if size > MAX_IMAGE_BYTES:
+                raise TooLarge('Image larger than {} bytes'.format(MAX_IMAGE_BYTES))
+            chunks.append(chunk)
+
+    async def read_query(self, request):
+        """Extract the image bytes and the search parameters of a request."""
+        params = dict(request.query)
+        content = None
+        if request.content_type.startswith('multipart/'):
+            reader = await request.multipart()
+            async for part in reader:
+                if part.name == 'image':
+                    content = await self.read_image_part(part)
+                else:
+                    params[part.name] = await part.text()
+        elif request.content_type == 'application/json':
+            try:
+                body = await request.json()
+            except ValueError:
+                raise BadRequest('Invalid JSON body')
+            if not isinstance(body, dict):
+                raise BadRequest('The JSON body must be an object')
+            params.update({key: value for key, value in body.items() if key not in ('image_url', 'image_base64')})
+            if body.get('image_base64'):
+                try:
+                    content = base64.b64decode(body['image_base64'], validate=True)
+                except (binascii.Error, TypeError, ValueError):
+                    raise BadRequest('image_base64 is not valid base64')
+            elif body.get('image_url'):
+                content = await self.fetch_image(body['image_url'])
+        if not content:
+            raise BadRequest('An image file, image_url or image_base64 is required')
+        try:
+            max_results = int(params['max_results']) if params.get('max_results') else self.max_results
+        except ValueError:
+            raise BadRequest('max_results must be an integer')
+        # Malformed filters are the client's fault, not Vision's.
+        filter = params.get('filter') or None
+        try:
+            if filter is not None:
+                if not isinstance(filter, str):
+                    raise FilterSyntaxError('the filter must be a string')
+                parse_filter(filter)
+        except FilterSyntaxError as e:
+            raise BadRequest('Invalid filter: {}'.format(e))
+        return content, {
+            'product_set_id': params.get('product_set_id') or self.product_set_id,
+            'product_category': params.get('product_category') or self.product_category,
+            'filter': filter,
+            'max_results': max_results,
+        }
+
+    async def search(self, content, product_set_id, product_category, filter, max_results):
+        """Run one product search, or join the identical one already running."""
+        if self.coalesce is None:
+            return await self._search(content, product_set_id, product_category, filter, max_results)
+        key = self.coalesce.make_key(content, product_set_id, product_category, filter, max_results)
+        return await self.coalesce.do_async(
+            key, self._search, content, product_set_id, product_category, filter, max_results)
+
+    async def _search(self, content, product_set_id, product_category, filter, max_results):
+        """Run one product search within the concurrency limit."""
+        metrics = self.metrics
+        if metrics.waiting >= self.max_waiting:
+            metrics.rejected += 1
+            raise Overloaded('Too many searches waiting')
+        metrics.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            metrics.waiting -= 1
+        metrics.in_flight += 1
+        try:
+            if self.normalize is not None:
+                with span('service.normalize'):
+                    try:
+                        content, _ = await asyncio.get_running_loop().run_in_executor(None, self.normalize, content)
+                    except OSError:
+                        raise BadRequest('The image could not be decoded')
+            with span('service.build_request'):
+                feature = vision.Feature(type_=vision.Feature.Type.PRODUCT_SEARCH, max_results=max_results)
+                request = vision.AnnotateImageRequest(
+                    image=vision.Image(content=content),
+                    features=[feature],
+                    image_context=product_search_context(self.api, product_set_id, product_category, filter))
+            try:
+                with span('service.rpc'):
+                    response = await self.api.image_annotator_client().batch_annotate_images(
+                        requests=[request], timeout=self.rpc_timeout)
+            except exceptions.InvalidArgument:
+                raise
+            except Exception:
+                metrics.upstream_errors += 1
+                raise
+            image_response = response.responses[0]
+            if image_response.error.code:
+                error = exceptions.from_grpc_status(image_response.error.code, image_response.error.message)
+                # Vision refusing the image, such as a file that is no image, is a bad request.
+                if not isinstance(error, exceptions.InvalidArgument):
+                    metrics.upstream_errors += 1
+                raise error
+            return image_response.product_search_results
+        finally:
+            metrics.in_flight -= 1
+            self._semaphore.release()
+
+    async def handle_search(self, request):
+        started = time.perf_counter()
+        status = 200
+        try:
+            content, query = await self.read_query(request)
+            product_search_results = await self.search(content, **query)
+        except web.HTTPRequestEntityTooLarge as e:
+            # Bodies over client_max_size, raised by aiohttp while reading them.
+            status = 413
+            return web.json_response({'error': e.text}, status=status)
+        except TooLarge as e:
+            status = 413
+            return web.json_response({'error': str(e)}, status=status)
+        except (BadRequest, exceptions.InvalidArgument) as e:
+            status = 400
+            return web.json_response({'error': str(e)}, status=status)
+        except Overloaded as e:
+            status = 503
+            return web.json_response({'error': str(e)}, status=status, headers={'Retry-After': '1'})
+        except Exception as e:
+            status = 502
+            return web.json_response({'error': str(e)}, status=status)
+        finally:
+            if status != 200:
+                self.metrics.observe(status, time.perf_counter() - started)
+
+        # Results are written as they are serialized instead of as one document.
+        response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+        await response.prepare(request)
+        index_time = product_search_results.index_time
+        await response.write('{{"index_time": {}, "results": ['.format(
+            json.dumps(index_time.isoformat() if index_time else None)).encode('utf-8'))
+        for index, result in enumerate(product_search_results.results):
+            chunk = json.dumps(result_to_dict(result))
+            await response.write((',' + chunk if index else chunk).encode('utf-8'))
+        await response.write(b']}')
+        await response.write_eof()
+        self.metrics.observe(status, time.perf_counter() - started)
+        return response
+
+    async def handle_health(self, request):
+        return web.json_response({'status': 'ok', 'in_flight': self.metrics.in_flight})
+
+    async def handle_metrics(self, request):
+        text = self.metrics.to_prometheus() + tracer.to_prometheus()
+        if self.coalesce is not None:
+            text += self.coalesce.to_prometheus('search_coalesced')
+        return web.Response(text=text, content_type='text/plain')
+
+    def make_app(self):
+        app = web.Application(client_max_size=MAX_IMAGE_BYTES)
+        app.router.add_post('/search', self.handle_search)
+        app.router.add_get('/healthz', self.handle_health)
+        app.router.add_get('/metrics', self.handle_metrics)
+        app.on_startup.append(self.start)
+        app.on_cleanup.append(self.close)
+        return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--project-id', default='beni-ai-engine')
+    parser.add_argument('--location', default='us-east1')
+    parser.add_argument('--product-set-id', default='BENI_CLOTH')
+    parser.add_argument('--product-category', default='apparel')
+    parser.add_argument('--max-results', type=int, default=10)
+    parser.add_argument('--max-concurrency', type=int, default=64, help='searches running at the same time')
+    parser.add_argument('--max-waiting', type=int, default=256, help='searches queued before rejecting with 503')
+    parser.add_argument('--channels', type=int, default=4, help='gRPC channels to Vision')
+    parser.add_argument('--max-edge', type=int, default=0,
+                        help='downsize query images to this many pixels, 0 sends them as they are')
+    parser.add_argument('--no-coalesce', action='store_true',
+                        help='send identical concurrent searches separately')
+    args = parser.parse_args()
+
+    normalize = None
+    if args.max_edge:
+        from preprocess import ImageNormalizer
+
+        normalize = ImageNormalizer(args.max_edge)
+    service = SearchService(args.project_id, args.location, args.product_set_id, args.product_category,
+                            args.max_results, args.max_concurrency, args.max_waiting, args.channels,
+                            normalize=normalize, coalesce=not args.no_coalesce)
+    web.run_app(service.make_app(), host=args.host, port=args.port)
@@ -0,0 +1,137 @@
+import os
+import threading
+
+from google.cloud import vision
+from google.cloud import storage
+
+
+class GoogleServices(object):
+    """Creates the real Google Cloud clients."""
+
+    def product_search_client(self):
+        return vision.ProductSearchClient()
+
+    def image_annotator_client(self):
+        return vision.ImageAnnotatorClient()
+
+    def image_annotator_async_client(self):
+        return vision.ImageAnnotatorAsyncClient()
+
+    def product_search_async_client(self):
+        return vision.ProductSearchAsyncClient()
+
+    def storage_client(self, project=None):
+        return storage.Client(project=project)
+
+    def storage_async_client(self, http):
+        from async_api import GcsAsyncClient
+
+        return GcsAsyncClient(http)
+
+
+def services_from_environment():
+    """Pick the client factories from VISION_BACKEND: `google` (default) or `fake`.
+
+    The fake services (see `fake_services`) read their latency, error and
+    quota settings from the JSON file named by VISION_FAKE_CONFIG.
+    """
+    backend = os.environ.get('VISION_BACKEND', 'google')
+    if backend == 'fake':
+        import fake_services
+
+        return fake_services.get_services(os.environ.get('VISION_FAKE_CONFIG'))
+    if backend != 'google':
+        raise ValueError('Unknown VISION_BACKEND: {}'.format(backend))
+    return GoogleServices()
+
+
+class VisionSession(object):
+    """Long-lived Vision and Storage clients for one project and location.
+
+    Clients are created on first use and then reused for the whole run, so
+    every call shares the same gRPC channels and credentials instead of
+    paying for a new channel and auth handshake per row. Resource paths and
+    bucket handles are cached as well.
+
+    The gRPC clients are thread-safe and shared by every thread. The
+    storage client wraps a `requests.Session`, which is not, so each thread
+    gets its own storage client and bucket handles.
+
+    Clients come from `services`, by default the real Google Cloud clients
+    or the fakes, depending on `services_from_environment`.
+    """
+
+    def __init__(self, project_id, location, services=None):
+        self.project_id = project_id
+        self.location = location
+        self.services = services or services_from_environment()
+        # A resource that represents Google Cloud Platform location.
+        self.location_path = f"projects/{project_id}/locations/{location}"
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._product_search_client = None
+        self._image_annotator_client = None
+        self._product_set_paths = {}
+
+    @property
+    def product_search_client(self):
+        if self._product_search_client is None:
+            with self._lock:
+                if self._product_search_client is None:
+                    self._product_search_client = self.services.product_search_client()
+        return self._product_search_client
+
+    @property
+    def image_annotator_client(self):
+        if self._image_annotator_client is None:
+            with self._lock:
+                if self._image_annotator_client is None:
+                    self._image_annotator_client = self.services.image_annotator_client()
+        return self._image_annotator_client
+
+    @property
+    def storage_client(self):
+        client = getattr(self._local, 'storage_client', None)
+        if client is None:
+            client = self._local.storage_client = self.services.storage_client(self.project_id)
+            self._local.buckets = {}
+        return client
+
+    def bucket(self, bucket_name):
+        """Return a bucket handle without the `get_bucket` metadata RPC."""
+        storage_client = self.storage_client
+        bucket = self._local.buckets.get(bucket_name)
+        if bucket is None:
+            bucket = self._local.buckets[bucket_name] = storage_client.bucket(bucket_name)
+        return bucket
+
+    def product_set_path(self, product_set_id):
+        path = self._product_set_paths.get(product_set_id)
+        if path is None:
+            path = self._product_set_paths[product_set_id] = self.product_search_client.product_set_path(
+                project=self.project_id, location=self.location, product_set=product_set_id)
+        return path
+
+    def product_path(self, product_id):
+        return self.product_search_client.product_path(
+            project=self.project_id, location=self.location, product=product_id)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(project_id=None, location=None):
+    """Return the process-wide session for a project and location.
+
+    Storage-only callers can omit both, the project is then inferred from
+    the environment.
+    """
+    key = (project_id, location)
+    session = _sessions.get(key)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = VisionSession(project_id, location)
+    return session
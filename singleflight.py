@@ -0,0 +1,135 @@
+"""Coalescing of identical concurrent calls.
+
+When the same query arrives again while a first copy is still being
+answered, the later callers wait for that first call and share its result
+instead of issuing their own. Nothing is kept once the call returns, so
+this is not a cache: a query arriving after the answer starts a new call.
+
+    coalesce = SingleFlight()
+    key = coalesce.make_key(content, product_set_id, product_category, filter, max_results)
+    results = coalesce.do(key, search)                 # from threads
+    results = await coalesce.do_async(key, search)     # from coroutines
+
+Threads and coroutines are tracked apart, a thread never waits on a
+coroutine's call nor the other way round.
+"""
+import asyncio
+import hashlib
+import threading
+
+
+class _Call(object):
+    """A call in progress from a thread, and the callers waiting on it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Share the result of a call among the callers asking for it at the same time.
+
+    An exception raised by the call is raised in every caller that waited
+    on it.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.upstream_calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._threads = {}
+        self._tasks = {}
+
+    @staticmethod
+    def make_key(content, *params):
+        """Key of a query: SHA-256 of the image bytes and the search parameters.
+
+        Exact bytes are used rather than a perceptual hash, callers sharing a
+        call must be entitled to exactly the same answer.
+        """
+        digest = hashlib.sha256(content)
+        for param in params:
+            digest.update(b'\x00' + str(param).encode('utf-8'))
+        return digest.hexdigest()
+
+    @property
+    def saved(self):
+        """Calls answered by joining another caller's call."""
+        return self.calls - self.upstream_calls
+
+    def do(self, key, fn, *args, **kwargs):
+        """Call `fn(*args, **kwargs)`, or wait for the call already running under `key`."""
+        with self._lock:
+            self.calls += 1
+            call = self._threads.get(key)
+            leader = call is None
+            if leader:
+                call = self._threads[key] = _Call()
+                self.upstream_calls += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                del self._threads[key]
+            call.done.set()
+        return call.result
+
+    async def do_async(self, key, fn, *args, **kwargs):
+        """Await `fn(*args, **kwargs)`, or the call already running under `key`.
+
+        The call runs as a task of its own, so a caller being cancelled does
+        not cancel it for the others waiting on it.
+        """
+        loop = asyncio.get_running_loop()
+        # Tasks are bound to their loop, keep the loops apart.
+        task_key = (id(loop), key)
+        with self._lock:
+            self.calls += 1
+            task = self._tasks.get(task_key)
+            if task is None:
+                task = self._tasks[task_key] = loop.create_task(fn(*args, **kwargs))
+                self.upstream_calls += 1
+                task.add_done_callback(lambda done: self._forget(task_key, done))
+        return await asyncio.shield(task)
+
+    def _forget(self, task_key, task):
+        with self._lock:
+            del self._tasks[task_key]
+            if not task.cancelled() and task.exception() is not None:
+                self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'upstream_calls': self.upstream_calls,
+                'saved': self.saved,
+                'errors': self.errors,
+                'in_flight': len(self._threads) + len(self._tasks),
+            }
+
+    def to_prometheus(self, prefix='singleflight'):
+        """Counters in the Prometheus text format."""
+        stats = self.stats()
+        return ''.join(
+            '# TYPE {0}_{1} {2}\n{0}_{1} {3}\n'.format(prefix, name, kind, stats[stat])
+            for name, kind, stat in (
+                ('calls_total', 'counter', 'calls'),
+                ('upstream_calls_total', 'counter', 'upstream_calls'),
+                ('saved_calls_total', 'counter', 'saved'),
+                ('errors_total', 'counter', 'errors'),
+                ('in_flight', 'gauge', 'in_flight'),
+            ))
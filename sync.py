@@ -0,0 +1,199 @@
+import json
+import os
+
+from google.api_core.exceptions import NotFound
+
+from catalog import open_catalog
+from main import (
+    catalog_row_labels,
+    create_reference_image,
+    delete_product,
+    delete_reference_image,
+    remove_product_from_product_set,
+    store_image,
+    update_product_labels,
+)
+from pipeline import Pipeline, Stage, build_ingest_stages, detect_colors
+from scheduler import scheduled
+from session import get_session
+
+
+# Catalog fields compared against the snapshot.
+SNAPSHOT_FIELDS = ('beni_product_id', 'updated_at', 'img_url', 'product_id')
+
+
+def load_snapshot(snapshot_path):
+    """Load the catalog state of the last sync, keyed by beni_product_id."""
+    if not os.path.exists(snapshot_path):
+        return {}
+    with open(snapshot_path, 'r', encoding='utf-8') as snapshot_file:
+        return json.load(snapshot_file)
+
+
+def save_snapshot(snapshot_path, snapshot):
+    # Write to a temporary file first so a crash never leaves half a snapshot.
+    tmp_path = snapshot_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(tmp_path, snapshot_path)
+
+
+def snapshot_entry(catalog_row):
+    return {
+        'updated_at': catalog_row['updated_at'],
+        'img_url': catalog_row['img_url'],
+        'product_id': catalog_row['product_id'],
+    }
+
+
+def diff_catalog(catalog_rows, snapshot):
+    """Compare the catalog export with the last synced snapshot.
+    Args:
+        catalog_rows: Iterable of catalog rows as returned by `read_catalog_rows`,
+            at least with the SNAPSHOT_FIELDS.
+        snapshot: Snapshot as returned by `load_snapshot`.
+    Returns:
+        A tuple with the new rows, the rows whose updated_at changed and
+        the ids of the products no longer in the catalog.
+    """
+    new_rows = []
+    changed_rows = []
+    seen = set()
+    for catalog_row in catalog_rows:
+        beni_product_id = catalog_row['beni_product_id']
+        seen.add(beni_product_id)
+        previous = snapshot.get(beni_product_id)
+        if previous is None:
+            new_rows.append(catalog_row)
+        elif previous['updated_at'] != catalog_row['updated_at']:
+            changed_rows.append(catalog_row)
+    removed_ids = [beni_product_id for beni_product_id in snapshot if beni_product_id not in seen]
+    return new_rows, changed_rows, removed_ids
+
+
+def _run(stages, jobs, queue_size, dead_letter=None):
+    """Run jobs through a pipeline and return the ids of the ones that finished."""
+    finished = []
+
+    def record(job):
+        finished.append(job['beni_product_id'])
+        return job
+
+    Pipeline(stages + [Stage('record', record)], queue_size, dead_letter).run(jobs)
+    return finished
+
+
+def sync_catalog(project_id, location, product_set_id, bucket_name, csv_path, snapshot_path, workers=8,
+                 queue_size=32, session=None, manifest=None, normalize=None, enrich=None,
+                 scheduler=None):
+    """Apply only the differences between the catalog and the last sync.
+
+    New products are ingested, changed products get their labels updated
+    and their reference image replaced when the image URL moved, and
+    products dropped from the catalog are removed. The snapshot only
+    advances for products that synced successfully, so failures are
+    retried by the next run.
+    Args:
+        project_id: Id of the project.
+        location: A compute region name.
+        product_set_id: Id of the product set.
+        bucket_name: Bucket where the images are stored.
+        csv_path: Path of the catalog CSV export.
+        snapshot_path: Path of the JSON snapshot written by the previous sync.
+        workers: Worker threads per stage.
+        queue_size: Capacity of the queue in front of each stage.
+        session: VisionSession to reuse, defaults to the process-wide one.
+        manifest: BlobManifest used to skip images already stored.
+        normalize: Optional callable applied to the images before they are uploaded.
+        enrich: Optional `colors.ColorEnricher`, the colors detected in the
+            images of new and changed products are added to their labels.
+        scheduler: Optional `scheduler.CallScheduler` the calls go through,
+            products still failing go to its dead-letter file.
+    """
+    session = session or get_session(project_id, location)
+    update_product_labels_call = scheduled(scheduler, 'update_product', update_product_labels)
+    store_image_call = scheduled(scheduler, 'gcs_upload', store_image)
+    delete_reference_image_call = scheduled(scheduler, 'delete_reference_image', delete_reference_image)
+    create_reference_image_call = scheduled(scheduler, 'create_reference_image', create_reference_image)
+    remove_product_call = scheduled(scheduler, 'remove_product_from_product_set', remove_product_from_product_set)
+    delete_product_call = scheduled(scheduler, 'delete_product', delete_product)
+    dead_letter = scheduler.dead_letter if scheduler is not None else None
+    snapshot = load_snapshot(snapshot_path)
+    catalog = open_catalog(csv_path)
+    # Only the compared fields are read for the whole catalog, full rows
+    # are then fetched by id for the products that differ.
+    new_rows, changed_rows, removed_ids = diff_catalog(catalog.rows(SNAPSHOT_FIELDS), snapshot)
+    new_rows = [catalog.get(catalog_row['beni_product_id']) for catalog_row in new_rows]
+    changed_rows = [catalog.get(catalog_row['beni_product_id']) for catalog_row in changed_rows]
+    print('Sync: {} new, {} changed, {} removed'.format(len(new_rows), len(changed_rows), len(removed_ids)))
+
+    # Changed products only touch their labels and, if it moved, their image.
+    def update_labels(job):
+        update_product_labels_call(project_id, location, job['beni_product_id'], job['product_title'],
+                                   job['product_description'], catalog_row_labels(job), session=session)
+        return job
+
+    def replace_image(job):
+        previous = snapshot[job['beni_product_id']]
+        if previous['img_url'] == job['img_url']:
+            return job
+        gcs_uri = store_image_call(bucket_name, job['img_url'], session, manifest, normalize)
+        if gcs_uri is None:
+            raise ValueError('Image could not be uploaded: {}'.format(job['img_url']))
+        try:
+            delete_reference_image_call(project_id, location, job['beni_product_id'], previous['product_id'],
+                                        session=session)
+        except NotFound:
+            pass
+        create_reference_image_call(project_id, location, job['beni_product_id'], job['product_id'], gcs_uri,
+                                        session=session)
+        return job
+
+    # Dropped products leave the set first, then are deleted one by one: a
+    # purge of the orphan products would also delete those detached by
+    # other tools or still waiting in other sets.
+    def remove(job):
+        try:
+            remove_product_call(project_id, location, job['beni_product_id'], product_set_id,
+                                session=session)
+        except NotFound:
+            pass
+        return job
+
+    def delete(job):
+        try:
+            delete_product_call(project_id, location, job['beni_product_id'], session=session)
+        except NotFound:
+            pass
+        return job
+
+    rows = {row['beni_product_id']: row for row in new_rows + changed_rows}
+    try:
+        # New products go through the regular ingestion stages.
+        if new_rows:
+            stages = build_ingest_stages(project_id, location, product_set_id, bucket_name, workers, session,
+                                         manifest=manifest, normalize=normalize, enrich=enrich,
+                                         scheduler=scheduler)
+            for beni_product_id in _run(stages, new_rows, queue_size, dead_letter):
+                snapshot[beni_product_id] = snapshot_entry(rows[beni_product_id])
+
+        if changed_rows:
+            stages = [Stage('update_labels', update_labels, workers),
+                      Stage('replace_image', replace_image, workers)]
+            if enrich is not None:
+                # Labels are replaced as a whole, the detected colors must be in them again.
+                stages.insert(0, Stage('colors', lambda job: detect_colors(job, enrich, manifest), workers))
+            for beni_product_id in _run(stages, changed_rows, queue_size, dead_letter):
+                snapshot[beni_product_id] = snapshot_entry(rows[beni_product_id])
+
+        if removed_ids:
+            stages = [Stage('remove', remove, workers), Stage('delete', delete, workers)]
+            removed = _run(stages, [{'beni_product_id': beni_product_id} for beni_product_id in removed_ids],
+                           queue_size, dead_letter)
+            for beni_product_id in removed:
+                del snapshot[beni_product_id]
+    finally:
+        save_snapshot(snapshot_path, snapshot)
+    return new_rows, changed_rows, removed_ids
@@ -0,0 +1,39 @@
+import contextlib
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.cloud import vision  # noqa: E402
+
+import bulk_import  # noqa: E402
+from benchmarks.fake_ingest import IMAGES_DIR, _serve, write_catalog  # noqa: E402
+from fake_services import FakeServices  # noqa: E402
+from session import VisionSession  # noqa: E402
+
+
+def test_import_catalog_into_fake_services(tmp_path):
+    server = _serve(IMAGES_DIR)
+    try:
+        catalog_path = str(tmp_path / 'catalog.csv')
+        write_catalog(catalog_path, 'http://127.0.0.1:{}'.format(server.server_address[1]), 12)
+        services = FakeServices()
+        session = VisionSession('fake-project', 'fake-location', services=services)
+        storage_client = services.storage_client()
+        storage_client.create_bucket(storage_client.bucket('fake-bucket'))
+        transport = bulk_import.GcsImportTransport('fake-project', 'fake-location', 'fake-bucket', session=session)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            failures = bulk_import.import_catalog(transport, catalog_path, 'FAKE', poll_interval=0)
+    finally:
+        server.shutdown()
+
+    assert failures == []
+    product_set = services.product_sets[session.product_set_path('FAKE')]
+    assert product_set['products'] == {session.product_path('FAKE-{}'.format(index)) for index in range(12)}
+    product = services.products[session.product_path('FAKE-0')]
+    assert product.product_category == 'apparel'
+    assert vision.Product.KeyValue(key='color', value='black') in product.product_labels
+    for product_name in product_set['products']:
+        assert len(services.reference_images[product_name]) == 1
@@ -0,0 +1,33 @@
+import csv
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import catalog  # noqa: E402
+
+
+def test_typed_columns(tmp_path):
+    csv_path = str(tmp_path / 'catalog.csv')
+    with open(csv_path, 'w', newline='', encoding='utf-8') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(['beni_product_id', 'price', 'in_stock', 'updated_at'])
+        writer.writerow(['A-1', '29.80 USD', 'True', '2022-01-13 11:06:25.775554-03'])
+        writer.writerow(['A-2', '', 'False', ''])
+        writer.writerow(['A-3', '5 USD', '', '2022-01-01 00:00:00'])
+
+    store = catalog.open_catalog(csv_path, str(tmp_path / 'store'))
+
+    prices = store.values('price')
+    assert prices.dtype == np.float64
+    assert prices[0] == 29.8 and np.isnan(prices[1]) and prices[2] == 5
+    assert store.values('in_stock').tolist() == [1, 0, -1]
+    updated_at = store.values('updated_at')
+    assert updated_at[0] == np.datetime64('2022-01-13T14:06:25.775554')
+    assert np.isnat(updated_at[1])
+    assert updated_at[2] == np.datetime64('2022-01-01T00:00:00')
+    # The text is kept as in the CSV.
+    assert store.get('A-1', ['price', 'updated_at']) == {'price': '29.80 USD',
+                                                          'updated_at': '2022-01-13 11:06:25.775554-03'}
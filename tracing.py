@@ -0,0 +1,229 @@
+"""Lightweight timing of the stages of ingestion and search.
+
+Stages are timed with spans, used as context managers or decorators:
+
+    from tracing import span, traced
+
+    @traced('create_product')
+    def create_product(...):
+        with span('create_product.rpc'):
+            client.create_product(...)
+
+Every span adds its duration to an in-memory histogram of its name, and
+counts an error when the block raises. `tracer.to_prometheus()` and
+`tracer.to_json()` export the histograms.
+
+Sampling is decided once per trace, by the outermost span: the spans
+nested in it, in the same thread or asyncio task, follow its decision.
+VISION_TRACE_SAMPLE sets the share of traces recorded (default 1, all of
+them); at 0 a span costs a single attribute check.
+"""
+import asyncio
+import bisect
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+
+# Upper bounds, in seconds, of the histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Sampling decision of the trace in progress, None outside of any span.
+_sampled = contextvars.ContextVar('tracing_sampled', default=None)
+
+
+class _NoopSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopSpan()
+
+
+class _UnsampledSpan(object):
+    """Outermost span of a trace left out by sampling, its children are skipped."""
+
+    __slots__ = ('token',)
+
+    def __enter__(self):
+        self.token = _sampled.set(False)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _sampled.reset(self.token)
+        return False
+
+
+class Span(object):
+    __slots__ = ('tracer', 'name', 'root', 'started', 'token')
+
+    def __init__(self, tracer, name, root):
+        self.tracer = tracer
+        self.name = name
+        self.root = root
+
+    def __enter__(self):
+        if self.root:
+            self.token = _sampled.set(True)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer.record(self.name, time.perf_counter() - self.started, exc_type is not None)
+        if self.root:
+            _sampled.reset(self.token)
+        return False
+
+
+class Histogram(object):
+    """Durations of one stage."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.errors = 0
+
+    def add(self, seconds, error):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if error:
+            self.errors += 1
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, in seconds.
+
+        None when there are no samples, or when the quantile falls past the
+        last bucket, whose durations have no upper bound.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+
+def _milliseconds(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+class Tracer(object):
+    """Collects span durations into per-stage histograms.
+    Args:
+        sample_rate: Share of traces recorded, from 0 (off) to 1 (all).
+        buckets: Upper bounds of the histogram buckets, in seconds.
+    """
+
+    def __init__(self, sample_rate=1.0, buckets=BUCKETS):
+        self.sample_rate = sample_rate
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def span(self, name):
+        """Context manager timing the block under `name`."""
+        if not self.sample_rate:
+            return _NOOP
+        sampled = _sampled.get()
+        if sampled is None:
+            if self.sample_rate < 1 and random.random() >= self.sample_rate:
+                return _UnsampledSpan()
+            return Span(self, name, True)
+        return Span(self, name, False) if sampled else _NOOP
+
+    def traced(self, name=None):
+        """Decorator timing every call of a function, or coroutine function, under `name`."""
+
+        def decorate(func):
+            span_name = name or func.__qualname__
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(span_name):
+                        return await func(*args, **kwargs)
+
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(span_name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorate
+
+    def record(self, name, seconds, error=False):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(self.buckets)
+            histogram.add(seconds, error)
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def snapshot(self):
+        """Return the statistics of every stage as a dict, times in milliseconds."""
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            return {name: {
+                'count': histogram.count,
+                'errors': histogram.errors,
+                'total_ms': histogram.sum * 1000,
+                'mean_ms': histogram.sum * 1000 / histogram.count,
+                # Bucket upper bounds, exact percentiles would need every sample.
+                # None when the quantile is past the last bucket.
+                'p50_ms_le': _milliseconds(histogram.quantile(0.5)),
+                'p95_ms_le': _milliseconds(histogram.quantile(0.95)),
+                'p99_ms_le': _milliseconds(histogram.quantile(0.99)),
+            } for name, histogram in histograms}
+
+    def to_json(self, **kwargs):
+        return json.dumps({'sample_rate': self.sample_rate, 'stages': self.snapshot()}, allow_nan=False, **kwargs)
+
+    def to_prometheus(self, prefix='vision_stage'):
+        """Histograms in the Prometheus text format."""
+        lines = ['# TYPE {}_seconds histogram'.format(prefix)]
+        errors = ['# TYPE {}_errors_total counter'.format(prefix)]
+        with self._lock:
+            for name, histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('{}_seconds_bucket{{stage="{}",le="{}"}} {}'.format(prefix, name, bound, cumulative))
+                lines += [
+                    '{}_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(prefix, name, histogram.count),
+                    '{}_seconds_sum{{stage="{}"}} {}'.format(prefix, name, histogram.sum),
+                    '{}_seconds_count{{stage="{}"}} {}'.format(prefix, name, histogram.count),
+                ]
+                errors.append('{}_errors_total{{stage="{}"}} {}'.format(prefix, name, histogram.errors))
+        return '\n'.join(lines + errors) + '\n'
+
+    def print_report(self):
+        print('{:<40} {:>7} {:>7} {:>10} {:>10} {:>10}'.format(
+            'stage', 'calls', 'errors', 'mean ms', 'p95 ms <=', 'total s'))
+        for name, stats in self.snapshot().items():
+            print('{:<40} {:>7} {:>7} {:>10.2f} {:>10.1f} {:>10.2f}'.format(
+                name[:40], stats['count'], stats['errors'], stats['mean_ms'], stats['p95_ms_le'],
+                stats['total_ms'] / 1000))
+
+
+# Process-wide tracer used by the instrumented modules.
+tracer = Tracer(float(os.environ.get('VISION_TRACE_SAMPLE', '1')))
+span = tracer.span
+traced = tracer.traced